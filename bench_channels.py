@@ -0,0 +1,91 @@
+import argparse
+import asyncio
+import random
+import time
+
+from mumble import Mumble_pb2
+from mumble import client
+
+arg_parser = argparse.ArgumentParser()
+arg_parser.add_argument('--users', type=int, default=10000)
+arg_parser.add_argument('--channels', type=int, default=1000)
+arg_parser.add_argument('--rounds', type=int, default=20,
+                        help='rounds of churn, each followed by lookups')
+arg_parser.add_argument('--moves', type=int, default=500,
+                        help='users moved per round')
+arg_parser.add_argument('--lookups', type=int, default=200,
+                        help='"who is in this channel" checks per round')
+
+
+def scan_users(c, channel):
+    # What Channel.get_users used to do.
+    return [user for user in c.users.values()
+            if user.channel_id == channel.id]
+
+
+def build(users, channels):
+    c = client.Client()
+    for channel_id in range(channels):
+        state = Mumble_pb2.ChannelState()
+        state.channel_id = channel_id
+        state.name = 'Channel {}'.format(channel_id)
+        if channel_id:
+            state.parent = random.randrange(channel_id)
+        c.control_channel_state_received(state)
+
+    for session in range(1, users + 1):
+        state = Mumble_pb2.UserState()
+        state.session = session
+        state.name = 'user{}'.format(session)
+        state.channel_id = random.randrange(channels)
+        c.control_user_state_received(state)
+    return c
+
+
+def churn(c, rounds, moves, lookups, get_users):
+    sessions = list(c.users)
+    channels = list(c.channels.values())
+    found = 0
+    for _ in range(rounds):
+        for session in random.sample(sessions, moves):
+            state = Mumble_pb2.UserState()
+            state.session = session
+            state.channel_id = random.randrange(len(channels))
+            c.control_user_state_received(state)
+        for channel in random.sample(channels, lookups):
+            found += len(get_users(c, channel))
+    return found
+
+
+def run(name, fn, operations):
+    start_wall = time.perf_counter()
+    start_cpu = time.process_time()
+    fn()
+    wall = time.perf_counter() - start_wall
+    cpu = time.process_time() - start_cpu
+
+    print('{:<10} {:>10.0f} ops/s {:>10.2f} us cpu/op'.format(
+        name, operations / wall, cpu / operations * 1e6))
+
+
+async def main(args):
+    random.seed(0)
+    c = build(args.users, args.channels)
+    operations = args.rounds * (args.moves + args.lookups)
+
+    run('scan', lambda: churn(c, args.rounds, args.moves, args.lookups,
+                              scan_users),
+        operations)
+    run('index', lambda: churn(c, args.rounds, args.moves, args.lookups,
+                               lambda c, channel: channel.get_users()),
+        operations)
+
+    # Both must agree after all that churn.
+    for channel in c.channels.values():
+        assert sorted(u.session for u in channel.get_users()) == \
+            sorted(u.session for u in scan_users(c, channel))
+
+
+if __name__ == '__main__':
+    args = arg_parser.parse_args()
+    asyncio.new_event_loop().run_until_complete(main(args))
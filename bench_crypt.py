@@ -0,0 +1,70 @@
+import argparse
+import time
+
+from mumble import crypt
+
+arg_parser = argparse.ArgumentParser()
+arg_parser.add_argument('--datagrams', type=int, default=20000,
+                        help='datagrams to process per run')
+arg_parser.add_argument('--size', type=int, default=60,
+                        help='plaintext bytes per datagram')
+arg_parser.add_argument('--batch', type=int, action='append',
+                        help='batch sizes to try (default: 8, 32, 128, 512)')
+
+KEY = bytes(range(16))
+CLIENT_NONCE = bytes([1] * 16)
+SERVER_NONCE = bytes([2] * 16)
+
+
+def make_pair():
+    client, server = crypt.CryptState(), crypt.CryptState()
+    client.set_key(KEY, CLIENT_NONCE, SERVER_NONCE)
+    server.set_key(KEY, SERVER_NONCE, CLIENT_NONCE)
+    return client, server
+
+
+def run(name, fn, datagrams):
+    start_wall = time.perf_counter()
+    start_cpu = time.process_time()
+    fn()
+    wall = time.perf_counter() - start_wall
+    cpu = time.process_time() - start_cpu
+
+    print('{:<24} {:>10.0f} datagrams/s {:>8.2f} us cpu/datagram'.format(
+        name, datagrams / wall, cpu / datagrams * 1e6))
+
+
+if __name__ == '__main__':
+    args = arg_parser.parse_args()
+    batch_sizes = args.batch or [8, 32, 128, 512]
+
+    plain = bytes(i & 0xff for i in range(args.size))
+    plains = [plain] * args.datagrams
+
+    client, server = make_pair()
+    run('encrypt', lambda: [client.encrypt(p) for p in plains],
+        args.datagrams)
+
+    client, server = make_pair()
+    encrypted = [client.encrypt(p) for p in plains]
+    run('decrypt', lambda: [server.decrypt(d) for d in encrypted],
+        args.datagrams)
+
+    if crypt.numpy is None:
+        arg_parser.exit(message='numpy is not installed, batches fall back '
+                                'to one datagram at a time\n')
+
+    for batch_size in batch_sizes:
+        batches = [plains[i:i + batch_size]
+                   for i in range(0, len(plains), batch_size)]
+
+        client, server = make_pair()
+        run('encrypt_batch({})'.format(batch_size),
+            lambda: [client.encrypt_batch(b) for b in batches],
+            args.datagrams)
+
+        client, server = make_pair()
+        encrypted = [client.encrypt_batch(b) for b in batches]
+        run('decrypt_batch({})'.format(batch_size),
+            lambda: [server.decrypt_batch(b) for b in encrypted],
+            args.datagrams)
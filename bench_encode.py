@@ -0,0 +1,62 @@
+import argparse
+import time
+
+from mumble.protocols import voice
+
+arg_parser = argparse.ArgumentParser()
+arg_parser.add_argument('--codec', choices=['alpha', 'beta'], default='alpha',
+                        help='CELT bitstream to benchmark (alpha is 0.7, '
+                             'beta is 0.11)')
+arg_parser.add_argument('--frames', type=int, default=20000,
+                        help='frames to encode per run')
+arg_parser.add_argument('--size', type=int, default=50,
+                        help='compressed bytes per frame')
+
+
+def make_inputs(frame_bytes):
+    pcm = bytes(i * 37 & 0xff for i in range(frame_bytes))
+    inputs = [('bytes', pcm),
+              ('bytearray', bytearray(pcm)),
+              ('memoryview', memoryview(bytes(frame_bytes * 2))[
+                  frame_bytes // 2:frame_bytes // 2 + frame_bytes])]
+
+    try:
+        import numpy
+    except ImportError:
+        pass
+    else:
+        inputs.append(('numpy', numpy.frombuffer(pcm, dtype='<i2').copy()))
+
+    return inputs
+
+
+def run(name, fn, frames):
+    start_wall = time.perf_counter()
+    start_cpu = time.process_time()
+    for _ in range(frames):
+        fn()
+    wall = time.perf_counter() - start_wall
+    cpu = time.process_time() - start_cpu
+
+    print('{:<24} {:>10.0f} frames/s {:>8.2f} us cpu/frame'.format(
+        name, frames / wall, cpu / frames * 1e6))
+
+
+if __name__ == '__main__':
+    args = arg_parser.parse_args()
+
+    versions = {'alpha': 0x8000000b, 'beta': 0x80000010}
+    try:
+        codec_module = voice.CELT_CODECS[versions[args.codec]]
+    except KeyError:
+        arg_parser.error('libcelt for the {} codec could not be '
+                         'loaded'.format(args.codec))
+    encoder = codec_module.Codec(voice.Protocol.SAMPLE_RATE).encoder
+
+    out = bytearray(args.size)
+
+    for input_name, pcm in make_inputs(encoder.frame_bytes):
+        run('encode({})'.format(input_name),
+            lambda: encoder.encode(pcm, args.size), args.frames)
+        run('encode_into({})'.format(input_name),
+            lambda: encoder.encode_into(pcm, args.size, out), args.frames)
@@ -0,0 +1,65 @@
+import argparse
+import array
+import asyncio
+import math
+import random
+import time
+
+from mumble.audio import metering
+
+arg_parser = argparse.ArgumentParser()
+arg_parser.add_argument('--speakers', type=int, default=500,
+                        help='speakers sending a frame every 10 ms')
+arg_parser.add_argument('--ticks', type=int, default=50,
+                        help='meter updates, each 50 ms of audio')
+
+
+def python_meter(frames):
+    # Meters frames one at a time the obvious way.
+    levels = {}
+    for session, pcm in frames:
+        samples = array.array('h', pcm)
+        total, count, peak = levels.get(session, (0, 0, 0))
+        for sample in samples:
+            total += sample * sample
+            peak = max(peak, abs(sample))
+        levels[session] = (total, count + len(samples), peak)
+    return {session: (math.sqrt(total / count) / metering.FULL_SCALE,
+                      peak / metering.FULL_SCALE)
+            for session, (total, count, peak) in levels.items()}
+
+
+def run(name, fn, frames):
+    start_wall = time.perf_counter()
+    start_cpu = time.process_time()
+    fn()
+    wall = time.perf_counter() - start_wall
+    cpu = time.process_time() - start_cpu
+
+    print('{:<8} {:>10.0f} frames/s {:>8.2f} us cpu/frame'.format(
+        name, frames / wall, cpu / frames * 1e6))
+
+
+if __name__ == '__main__':
+    args = arg_parser.parse_args()
+
+    # 5 frames of 10 ms per speaker per 50 ms tick.
+    tick = [(session, array.array('h', (random.randint(-3000, 3000)
+                                        for _ in range(480))).tobytes())
+            for session in range(args.speakers) for _ in range(5)]
+    frames = len(tick) * args.ticks
+
+    def python():
+        for _ in range(args.ticks):
+            python_meter(tick)
+
+    meter = metering.LoudnessMeter(asyncio.new_event_loop())
+
+    def vectorized():
+        for _ in range(args.ticks):
+            for session, pcm in tick:
+                meter.add(session, pcm)
+            meter.update(0.05)
+
+    run('python', python, frames)
+    run('meter', vectorized, frames)
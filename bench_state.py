@@ -0,0 +1,176 @@
+import argparse
+import asyncio
+import gc
+import random
+import time
+import tracemalloc
+
+from mumble import Mumble_pb2
+from mumble import client
+from mumble import entities
+
+arg_parser = argparse.ArgumentParser()
+arg_parser.add_argument('--users', type=int, nargs='+',
+                        default=[1000, 10000, 50000],
+                        help='server sizes to build')
+arg_parser.add_argument('--users-per-channel', type=int, default=20)
+arg_parser.add_argument('--comments', type=float, default=0.2,
+                        help='fraction of users with a comment')
+arg_parser.add_argument('--moves', type=int, default=3,
+                        help='times every user is moved in the move storm')
+
+
+def channel_states(count):
+    states = []
+    for channel_id in range(count):
+        state = Mumble_pb2.ChannelState()
+        state.channel_id = channel_id
+        state.name = 'Root' if channel_id == 0 else \
+            'Channel {}'.format(channel_id)
+        if channel_id:
+            state.parent = random.randrange(channel_id)
+            state.position = random.randrange(10)
+        states.append(state)
+    return states
+
+
+def user_states(count, channels, comments):
+    states = []
+    for session in range(1, count + 1):
+        state = Mumble_pb2.UserState()
+        state.session = session
+        state.name = 'user{}'.format(session)
+        state.user_id = session
+        state.channel_id = random.randrange(channels)
+        state.hash = '{:040x}'.format(random.getrandbits(160))
+        if random.random() < comments:
+            # Long comments come as hashes, short ones inline.
+            if random.random() < 0.5:
+                state.comment_hash = random.getrandbits(160).to_bytes(20,
+                                                                      'big')
+            else:
+                state.comment = 'Comment of user {}'.format(session)
+        states.append(state)
+    return states
+
+
+def move_states(count, channels, moves):
+    states = []
+    for _ in range(moves):
+        for session in range(1, count + 1):
+            state = Mumble_pb2.UserState()
+            state.session = session
+            state.actor = session
+            state.channel_id = random.randrange(channels)
+            states.append(state)
+    return states
+
+
+def measure(fn):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    fn()
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return after - before
+
+
+def timed(name, fn, count):
+    start_wall = time.perf_counter()
+    start_cpu = time.process_time()
+    fn()
+    wall = time.perf_counter() - start_wall
+    cpu = time.process_time() - start_cpu
+
+    print('    {:<14} {:>10.0f} updates/s {:>8.2f} us cpu/update'.format(
+        name, count / wall, cpu / count * 1e6))
+
+
+async def run(users, users_per_channel, comments, moves):
+    channels = max(1, users // users_per_channel)
+    channel_list = channel_states(channels)
+    user_list = user_states(users, channels, comments)
+    move_list = move_states(users, channels, moves)
+
+    c = client.Client()
+
+    def sync_channels():
+        for state in channel_list:
+            c.control_channel_state_received(state)
+
+    def sync_users():
+        for state in user_list:
+            c.control_user_state_received(state)
+
+    def move_users():
+        for state in move_list:
+            c.control_user_state_received(state)
+
+    channel_bytes = measure(sync_channels)
+    user_bytes = measure(sync_users)
+
+    print('{:>6} users {:>5} channels {:>7.0f} B/user {:>7.0f} B/channel '
+          '{:>8.1f} MB total'.format(
+              users, channels, user_bytes / users, channel_bytes / channels,
+              (user_bytes + channel_bytes) / 1e6))
+
+    c = client.Client()
+    timed('channel sync', sync_channels, len(channel_list))
+    timed('user sync', sync_users, len(user_list))
+    timed('move storm', move_users, len(move_list))
+
+    # The first snapshot takes in everything; later ones only what changed.
+    start = time.perf_counter()
+    c.snapshot()
+    first = time.perf_counter() - start
+    for state in move_list[:100]:
+        c.control_user_state_received(state)
+    start = time.perf_counter()
+    c.snapshot()
+    after_moves = time.perf_counter() - start
+    print('    snapshot       {:>8.2f} ms first {:>8.2f} ms after 100 '
+          'moves'.format(first * 1e3, after_moves * 1e3))
+
+
+async def blob_costs(count):
+    # What blob bookkeeping costs per user: without a comment, with one sent
+    # inline and with one known only by its hash.
+    c = client.Client()
+    kinds = [
+        ('no comment', {}),
+        ('inline', {'comment': 'A short comment'}),
+        ('hashed', {'comment_hash': bytes(20)}),
+    ]
+
+    for name, fields in kinds:
+        states = [Mumble_pb2.UserState(session=session, name='u', **fields)
+                  for session in range(count)]
+        users = []
+
+        def create():
+            for state in states:
+                user = entities.User(c, state.session)
+                user.update_from_state(state)
+                users.append(user)
+
+        start = time.process_time()
+        create()
+        cpu = time.process_time() - start
+        del users[:]
+        size = measure(create)
+
+        print('{:<10} {:>7.0f} B/user {:>8.2f} us cpu/user'.format(
+            name, size / count, cpu / count * 1e6))
+
+
+if __name__ == '__main__':
+    args = arg_parser.parse_args()
+    random.seed(0)
+
+    loop = asyncio.new_event_loop()
+    for users in args.users:
+        loop.run_until_complete(run(users, args.users_per_channel,
+                                    args.comments, args.moves))
+    loop.run_until_complete(blob_costs(max(args.users)))
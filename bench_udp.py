@@ -0,0 +1,185 @@
+import argparse
+import asyncio
+import random
+import struct
+import time
+
+from mumble import crypt
+from mumble.protocols import control
+
+arg_parser = argparse.ArgumentParser()
+arg_parser.add_argument('--packets', type=int, default=1000,
+                        help='voice packets to send on each path')
+arg_parser.add_argument('--loss', type=float, default=0.02,
+                        help='fraction of packets the network drops')
+arg_parser.add_argument('--rto', type=float, default=0.2,
+                        help='TCP retransmission timeout to model, seconds')
+arg_parser.add_argument('--interval', type=float, default=0.01,
+                        help='seconds between packets')
+
+# A voice-sized payload: sequence number, send time and padding.
+PAYLOAD = struct.Struct('!Id50x')
+
+KEY = bytes(range(16))
+CLIENT_NONCE = bytes([1] * 16)
+SERVER_NONCE = bytes([2] * 16)
+
+
+class UDPStandInServer(asyncio.DatagramProtocol):
+    # Decrypts each packet, loses some and echoes the rest back, much like a
+    # server handling voice sent to the loopback target.
+
+    def __init__(self, loss):
+        self.loss = loss
+        self.crypt = crypt.CryptState()
+        self.crypt.set_key(KEY, SERVER_NONCE, CLIENT_NONCE)
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        plain = self.crypt.decrypt(data)
+        if plain is None or random.random() < self.loss:
+            return
+        self.transport.sendto(self.crypt.encrypt(plain), addr)
+
+
+class UDPClient(asyncio.DatagramProtocol):
+    def __init__(self, latencies):
+        self.latencies = latencies
+        self.crypt = crypt.CryptState()
+        self.crypt.set_key(KEY, CLIENT_NONCE, SERVER_NONCE)
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def send(self, payload):
+        self.transport.sendto(self.crypt.encrypt(payload))
+
+    def datagram_received(self, data, addr):
+        plain = self.crypt.decrypt(data)
+        if plain is not None:
+            _, sent = PAYLOAD.unpack(plain)
+            self.latencies.append(time.perf_counter() - sent)
+
+
+class TunnelStandInServer(asyncio.Protocol):
+    # Echoes framed packets back over TCP. Loss is modelled the way TCP
+    # experiences it: the lost segment and everything queued behind it wait
+    # for a retransmission timeout.
+
+    def __init__(self, loop, loss, rto):
+        self.loop = loop
+        self.loss = loss
+        self.rto = rto
+        self.buffer = bytearray()
+        self.blocked_until = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        header = control.Protocol.PACKET_HEADER
+        self.buffer.extend(data)
+
+        while len(self.buffer) >= header.size:
+            _, length = header.unpack_from(self.buffer)
+            end = header.size + length
+            if len(self.buffer) < end:
+                break
+            frame = bytes(self.buffer[:end])
+            del self.buffer[:end]
+
+            now = self.loop.time()
+            if random.random() < self.loss:
+                self.blocked_until = max(self.blocked_until, now + self.rto)
+
+            if self.blocked_until > now:
+                self.loop.call_at(self.blocked_until, self.transport.write,
+                                  frame)
+            else:
+                self.transport.write(frame)
+
+
+class TunnelClient(asyncio.Protocol):
+    def __init__(self, latencies):
+        self.latencies = latencies
+        self.buffer = bytearray()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def send(self, payload):
+        self.transport.write(control.Protocol.PACKET_HEADER.pack(
+            control.Protocol.PACKET_NUMBERS[control.Mumble_pb2.UDPTunnel],
+            len(payload)) + payload)
+
+    def data_received(self, data):
+        header = control.Protocol.PACKET_HEADER
+        self.buffer.extend(data)
+
+        while len(self.buffer) >= header.size:
+            _, length = header.unpack_from(self.buffer)
+            end = header.size + length
+            if len(self.buffer) < end:
+                break
+            _, sent = PAYLOAD.unpack(bytes(self.buffer[header.size:end]))
+            del self.buffer[:end]
+            self.latencies.append(time.perf_counter() - sent)
+
+
+async def stream(client, args):
+    for i in range(args.packets):
+        client.send(PAYLOAD.pack(i, time.perf_counter()))
+        await asyncio.sleep(args.interval)
+    await asyncio.sleep(args.rto * 5)
+
+
+async def bench_udp(loop, args):
+    latencies = []
+    server_transport, _ = await loop.create_datagram_endpoint(
+        lambda: UDPStandInServer(args.loss), local_addr=('127.0.0.1', 0))
+    client_transport, client = await loop.create_datagram_endpoint(
+        lambda: UDPClient(latencies),
+        remote_addr=server_transport.get_extra_info('sockname'))
+
+    await stream(client, args)
+    client_transport.close()
+    server_transport.close()
+    return latencies
+
+
+async def bench_tunnel(loop, args):
+    latencies = []
+    server = await loop.create_server(
+        lambda: TunnelStandInServer(loop, args.loss, args.rto),
+        '127.0.0.1', 0)
+    client_transport, client = await loop.create_connection(
+        lambda: TunnelClient(latencies),
+        *server.sockets[0].getsockname())
+
+    await stream(client, args)
+    client_transport.close()
+    server.close()
+    return latencies
+
+
+def report(name, latencies, args):
+    latencies = sorted(latencies)
+
+    def percentile(p):
+        return latencies[min(len(latencies) - 1,
+                             int(len(latencies) * p))] * 1000
+
+    print('{:<8} delivered {:6.1%}  p50 {:7.2f} ms  p95 {:7.2f} ms  '
+          'p99 {:7.2f} ms  max {:7.2f} ms'.format(
+              name, len(latencies) / args.packets, percentile(0.5),
+              percentile(0.95), percentile(0.99), latencies[-1] * 1000))
+
+
+if __name__ == '__main__':
+    args = arg_parser.parse_args()
+    loop = asyncio.get_event_loop()
+
+    report('udp', loop.run_until_complete(bench_udp(loop, args)), args)
+    report('tunnel', loop.run_until_complete(bench_tunnel(loop, args)), args)
@@ -0,0 +1,135 @@
+import argparse
+import asyncio
+import socket
+import threading
+import time
+
+from mumble import mmsg
+
+arg_parser = argparse.ArgumentParser()
+arg_parser.add_argument('--packets', type=int, default=200000,
+                        help='datagrams to move per run')
+arg_parser.add_argument('--size', type=int, default=80,
+                        help='bytes per datagram')
+arg_parser.add_argument('--burst', type=int, default=64,
+                        help='datagrams handed to the transport at once')
+
+
+class CountingProtocol(asyncio.DatagramProtocol):
+    def __init__(self, done, packets):
+        self.done = done
+        self.packets = packets
+        self.received = 0
+
+    def datagram_received(self, data, addr):
+        self.received += 1
+        if self.received >= self.packets:
+            self.done.set()
+
+    def datagrams_received(self, datagrams):
+        self.received += len(datagrams)
+        if self.received >= self.packets:
+            self.done.set()
+
+
+def make_sink():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8 * 1024 * 1024)
+    sock.bind(('127.0.0.1', 0))
+    return sock
+
+
+def report(name, packets, wall, cpu):
+    print('{:<16} {:>10.0f} packets/s {:>8.2f} us cpu/packet'.format(
+        name, packets / wall, cpu / packets * 1e6))
+
+
+async def bench_send(loop, name, create, args):
+    sink = make_sink()
+    transport, _ = await create(lambda: asyncio.DatagramProtocol(),
+                                sink.getsockname())
+    await asyncio.sleep(0)
+
+    payload = bytes(args.size)
+    burst = [payload] * args.burst
+    sendto_many = getattr(transport, 'sendto_many', None)
+
+    start_wall = time.perf_counter()
+    start_cpu = time.thread_time()
+    for _ in range(args.packets // args.burst):
+        if sendto_many is not None:
+            sendto_many(burst)
+        else:
+            for data in burst:
+                transport.sendto(data)
+        # Let the kernel and any write buffer drain now and again.
+        await asyncio.sleep(0)
+    report(name, args.packets, time.perf_counter() - start_wall,
+           time.thread_time() - start_cpu)
+
+    transport.close()
+    sink.close()
+
+
+async def bench_recv(loop, name, create, args):
+    source = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    source.bind(('127.0.0.1', 0))
+    done = asyncio.Event()
+    transport, protocol = await create(
+        lambda: CountingProtocol(done, args.packets), source.getsockname())
+    transport.get_extra_info('socket').setsockopt(
+        socket.SOL_SOCKET, socket.SO_RCVBUF, 8 * 1024 * 1024)
+    source.connect(transport.get_extra_info('sockname'))
+    await asyncio.sleep(0)
+
+    def blast():
+        payload = bytes(args.size)
+        for i in range(args.packets):
+            source.send(payload)
+            if i % args.burst == 0:
+                # Bursts, like a server relaying a tick's worth of voice.
+                time.sleep(0.0001)
+
+    thread = threading.Thread(target=blast)
+    start_wall = time.perf_counter()
+    start_cpu = time.thread_time()
+    thread.start()
+
+    # Stop once everything arrived or nothing more is coming; the kernel
+    # drops what a slow receiver does not pick up in time.
+    received = -1
+    while not done.is_set() and (thread.is_alive() or
+                                 received != protocol.received):
+        received = protocol.received
+        try:
+            await asyncio.wait_for(done.wait(), 0.2)
+        except asyncio.TimeoutError:
+            pass
+    wall = time.perf_counter() - start_wall
+    # The sender thread is excluded: thread_time only counts the loop.
+    cpu = time.thread_time() - start_cpu
+    thread.join()
+
+    report(name, protocol.received, wall, cpu)
+    print('{:<16} {:>10.1%} delivered'.format('', protocol.received /
+                                              args.packets))
+
+    transport.close()
+    source.close()
+
+
+if __name__ == '__main__':
+    args = arg_parser.parse_args()
+    loop = asyncio.get_event_loop()
+
+    def standard(factory, addr):
+        return loop.create_datagram_endpoint(factory, remote_addr=addr)
+
+    def batched(factory, addr):
+        return mmsg.create_datagram_endpoint(loop, factory, addr)
+
+    loop.run_until_complete(bench_send(loop, 'send standard', standard, args))
+    loop.run_until_complete(bench_send(loop, 'send mmsg', batched, args))
+    loop.run_until_complete(bench_recv(loop, 'recv standard', standard,
+                                       args))
+    loop.run_until_complete(bench_recv(loop, 'recv mmsg', batched, args))
@@ -0,0 +1,146 @@
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+# Per-packet overhead in bytes, as Mumble counts it: IP and UDP headers, the
+# crypt header, the packet type and sequence number, and one header byte per
+# frame on top.
+IP_UDP_OVERHEAD = 20 + 8
+CRYPT_OVERHEAD = 4
+VOICE_OVERHEAD = 1 + 2
+# Voice through the tunnel pays for TCP and control framing instead.
+TCP_EXTRA_OVERHEAD = 12
+POSITION_OVERHEAD = 12
+
+
+def network_bandwidth(bitrate, frames_per_packet, tcp=False,
+                      positional=False):
+    # Bits per second on the wire for voice at bitrate, as Mumble's
+    # AudioInput::getNetworkBandwidth works it out.
+    overhead = IP_UDP_OVERHEAD + CRYPT_OVERHEAD + VOICE_OVERHEAD + \
+        frames_per_packet
+    if positional:
+        overhead += POSITION_OVERHEAD
+    if tcp:
+        overhead += TCP_EXTRA_OVERHEAD
+    return overhead * (800 // frames_per_packet) + bitrate
+
+
+def fit(limit, bitrate, frames_per_packet, tcp=False, positional=False,
+        min_bitrate=8000):
+    # Picks (bitrate, frames_per_packet) to stay within limit bits per
+    # second, first by sending bigger packets and then by lowering the
+    # bitrate, the way Mumble's AudioInput::adjustBandwidth does.
+    def bandwidth(bitrate, frames):
+        return network_bandwidth(bitrate, frames, tcp, positional)
+
+    if limit is not None and bandwidth(bitrate, frames_per_packet) > limit:
+        if frames_per_packet <= 4 and limit <= 32000:
+            frames_per_packet = 4
+        elif frames_per_packet == 1 and limit <= 64000:
+            frames_per_packet = 2
+        elif frames_per_packet == 2 and limit <= 48000:
+            frames_per_packet = 4
+
+        while bitrate > min_bitrate and \
+                bandwidth(bitrate, frames_per_packet) > limit:
+            bitrate -= 1000
+
+    return max(bitrate, min_bitrate), frames_per_packet
+
+
+class BandwidthController(object):
+    # Keeps a VoiceSender within the server's bandwidth limit for whichever
+    # path voice is taking, and backs off further while the UDP path shows
+    # loss or high round trip times: the usable budget shrinks by a quarter
+    # on every bad check and grows back by a tenth on every good one.
+    INTERVAL = 1
+    LOSS_HIGH = 0.05
+    LOSS_LOW = 0.01
+    RTT_HIGH = 0.25
+    MIN_SCALE = 0.25
+
+    def __init__(self, loop, sender, protocol, positional=False):
+        self.loop = loop
+        self.sender = sender
+        self.protocol = protocol
+        self.positional = positional
+
+        # What the sender was set up with is what it gets when there is
+        # room.
+        self.preferred_bitrate = sender.bitrate
+        self.preferred_frames_per_packet = sender.frames_per_packet
+
+        self.max_bandwidth = None
+        self.scale = 1.0
+        self._handle = None
+        self._path = protocol.path
+
+        self.adjustments = 0
+        self.backoffs = 0
+
+    @property
+    def limit(self):
+        if self.max_bandwidth is None:
+            if self.scale == 1.0:
+                return None
+            limit = network_bandwidth(self.preferred_bitrate,
+                                      self.preferred_frames_per_packet,
+                                      self.protocol.path is
+                                      self.protocol.Path.TUNNEL,
+                                      self.positional)
+        else:
+            limit = self.max_bandwidth
+        return int(limit * self.scale)
+
+    def set_max_bandwidth(self, max_bandwidth):
+        self.max_bandwidth = max_bandwidth or None
+        self.update()
+
+    def start(self):
+        if self._handle is None:
+            self._handle = self.loop.call_later(self.INTERVAL, self._check)
+
+    def stop(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def _check(self):
+        self._handle = self.loop.call_later(self.INTERVAL, self._check)
+
+        loss = self.protocol.udp_loss
+        rtt = self.protocol.udp_rtt
+        if self.protocol.path is self.protocol.Path.UDP and \
+           (loss is not None and loss > self.LOSS_HIGH or
+                rtt is not None and rtt > self.RTT_HIGH):
+            scale = max(self.MIN_SCALE, self.scale * 0.75)
+            if scale != self.scale:
+                self.backoffs += 1
+        elif loss is None or loss < self.LOSS_LOW:
+            scale = min(1.0, self.scale + 0.1)
+        else:
+            scale = self.scale
+
+        # Tunnelled voice costs more, so a change of path needs a new fit
+        # too.
+        if scale != self.scale or self.protocol.path is not self._path:
+            self.scale = scale
+            self.update()
+
+    def update(self):
+        self._path = self.protocol.path
+        bitrate, frames_per_packet = fit(
+            self.limit, self.preferred_bitrate,
+            self.preferred_frames_per_packet,
+            self.protocol.path is self.protocol.Path.TUNNEL, self.positional)
+
+        if (bitrate, frames_per_packet) != \
+           (self.sender.bitrate, self.sender.frames_per_packet):
+            logger.info('Voice bitrate %d, %d frames per packet (limit: %s)',
+                        bitrate, frames_per_packet, self.limit)
+            self.sender.bitrate = bitrate
+            self.sender.frames_per_packet = frames_per_packet
+            self.adjustments += 1
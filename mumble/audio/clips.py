@@ -0,0 +1,253 @@
+import asyncio
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import wave
+
+from . import sender
+
+
+logger = logging.getLogger(__name__)
+
+
+# A clip file is a header, packet_count + 1 big-endian uint32 offsets of the
+# packet bodies (the last one being the end of the file), packet_count frame
+# counts and finally the packet bodies themselves. A body is everything in a
+# voice packet after the sequence number, so playing a clip only needs to
+# prepend a fresh sequence number to each one.
+MAGIC = b'MCLP'
+FORMAT_VERSION = 1
+
+HEADER = struct.Struct('!4sBIIBI')
+OFFSET = struct.Struct('!I')
+
+
+def read_frames(path, frame_size, channels, rate):
+    # Yields PCM for one frame at a time; the last frame may be short.
+    frame_bytes = frame_size * channels * sender.VoiceSender.SAMPLE_WIDTH
+
+    if path.lower().endswith('.wav'):
+        with wave.open(path, 'rb') as f:
+            if f.getnchannels() != channels or \
+               f.getsampwidth() != sender.VoiceSender.SAMPLE_WIDTH or \
+               f.getframerate() != rate:
+                raise ValueError('{} is not {}-channel 16-bit {} Hz '
+                                 'audio'.format(path, channels, rate))
+
+            while True:
+                pcm = f.readframes(frame_size)
+                if not pcm:
+                    break
+                yield pcm
+    else:
+        with open(path, 'rb') as f:
+            while True:
+                pcm = f.read(frame_bytes)
+                if not pcm:
+                    break
+                yield pcm
+
+
+def encode_packets(frames, encoder, bitrate, frames_per_packet):
+    # Packs encoded frames exactly like VoiceSender does, ending with a
+    # terminator frame, and returns a list of (body, frame_count).
+    size = sender.VoiceSender.frame_length_for(bitrate)
+    packets = []
+    encoded = []
+
+    def pack(terminate):
+        body = bytearray()
+        for i, frame in enumerate(encoded):
+            header = len(frame)
+            if terminate or i < len(encoded) - 1:
+                header |= 0b10000000
+            body.append(header)
+            body.extend(frame)
+        if terminate:
+            body.append(0)
+        packets.append((bytes(body), len(encoded) + (1 if terminate else 0)))
+        del encoded[:]
+
+    for pcm in frames:
+        encoded.append(encoder.encode(pcm, size))
+        if len(encoded) == frames_per_packet:
+            pack(False)
+    pack(True)
+
+    return packets
+
+
+def write_clip(f, packets, bitstream_version, bitrate, frames_per_packet):
+    f.write(HEADER.pack(MAGIC, FORMAT_VERSION, bitstream_version, bitrate,
+                        frames_per_packet, len(packets)))
+
+    offset = HEADER.size + OFFSET.size * (len(packets) + 1) + len(packets)
+    for body, _ in packets:
+        f.write(OFFSET.pack(offset))
+        offset += len(body)
+    f.write(OFFSET.pack(offset))
+
+    f.write(bytes(frame_count for _, frame_count in packets))
+
+    for body, _ in packets:
+        f.write(body)
+
+
+class Clip(object):
+    def __init__(self, path):
+        self.path = path
+
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            magic, version, self.bitstream_version, self.bitrate, \
+                self.frames_per_packet, self.packet_count = \
+                HEADER.unpack_from(self._mmap)
+        except struct.error:
+            self._mmap.close()
+            raise ValueError('{} is truncated'.format(path))
+
+        if magic != MAGIC or version != FORMAT_VERSION:
+            self._mmap.close()
+            raise ValueError('{} is not a clip file'.format(path))
+
+        self._counts_offset = HEADER.size + \
+            OFFSET.size * (self.packet_count + 1)
+        if len(self._mmap) < self._counts_offset + self.packet_count:
+            self._mmap.close()
+            raise ValueError('{} is truncated'.format(path))
+
+        self._view = memoryview(self._mmap)
+
+    def __len__(self):
+        return self.packet_count
+
+    def packets(self):
+        # Yields (body, frame_count) with each body a view into the mapping.
+        start = OFFSET.unpack_from(self._mmap, HEADER.size)[0]
+        for i in range(self.packet_count):
+            end = OFFSET.unpack_from(self._mmap,
+                                     HEADER.size + OFFSET.size * (i + 1))[0]
+            yield self._view[start:end], self._mmap[self._counts_offset + i]
+            start = end
+
+    def close(self):
+        try:
+            self._view.release()
+            self._mmap.close()
+        except BufferError:
+            # A packet view is still alive somewhere; the mapping goes away
+            # once it is collected.
+            pass
+
+
+class ClipCache(object):
+    SUFFIX = '.clip'
+
+    def __init__(self, directory, max_size=64 * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _cache_path(self, path, bitstream_version, bitrate,
+                    frames_per_packet):
+        st = os.stat(path)
+        key = '\0'.join(str(x) for x in [
+            os.path.abspath(path), st.st_size, st.st_mtime_ns,
+            bitstream_version, bitrate, frames_per_packet])
+        return os.path.join(
+            self.directory,
+            hashlib.sha1(key.encode('utf-8')).hexdigest() + self.SUFFIX)
+
+    async def get(self, path, codec, bitrate, frames_per_packet, loop=None):
+        if loop is None:
+            loop = asyncio.get_event_loop()
+
+        cache_path = self._cache_path(path, codec.bitstream_version, bitrate,
+                                      frames_per_packet)
+
+        try:
+            clip = Clip(cache_path)
+        except FileNotFoundError:
+            clip = None
+        except ValueError:
+            logger.warn('Discarding corrupt clip %s', cache_path)
+            clip = None
+
+        if clip is None:
+            self.misses += 1
+            # Encoding a whole file would hold up every other stream, so it
+            # happens off the event loop.
+            await loop.run_in_executor(None, self._store, cache_path, path,
+                                       codec, bitrate, frames_per_packet)
+            clip = Clip(cache_path)
+            self.evict(keep=cache_path)
+        else:
+            self.hits += 1
+
+        try:
+            # The modification time doubles as the last use time.
+            os.utime(cache_path)
+        except FileNotFoundError:
+            pass
+
+        return clip
+
+    def _store(self, cache_path, path, codec, bitrate, frames_per_packet):
+        # Encodes with a fresh encoder so that the state of one that is in
+        # use is left alone.
+        encoder = type(codec.encoder)(codec.encoder.rate,
+                                      channels=codec.encoder.channels)
+        packets = encode_packets(
+            read_frames(path, encoder.frame_size, encoder.channels,
+                        encoder.rate),
+            encoder, bitrate, frames_per_packet)
+
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write_clip(f, packets, codec.bitstream_version, bitrate,
+                           frames_per_packet)
+            os.replace(temp_path, cache_path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    def evict(self, keep=None):
+        entries = []
+        total = 0
+
+        for name in os.listdir(self.directory):
+            if not name.endswith(self.SUFFIX):
+                continue
+            entry_path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(entry_path)
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, entry_path, st.st_size))
+            total += st.st_size
+
+        entries.sort()
+        for _, entry_path, size in entries:
+            if total <= self.max_size:
+                break
+            if entry_path == keep:
+                continue
+            try:
+                os.unlink(entry_path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            self.evictions += 1
+
+        return total
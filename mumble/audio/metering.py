@@ -0,0 +1,152 @@
+import math
+
+import numpy
+
+
+FULL_SCALE = 32768
+
+
+def to_dbfs(values, floor=-96.0):
+    # Converts linear levels, 1.0 being full scale, to dBFS.
+    with numpy.errstate(divide='ignore'):
+        return numpy.maximum(20 * numpy.log10(values), floor)
+
+
+class LoudnessMeter(object):
+    # Meters decoded voice for every speaker. Frames are only collected as
+    # they arrive; every interval all of them are measured together, and
+    # levels holds one row per session in index:
+    #
+    #   levels[index[session]] == [rms, peak, level]
+    #
+    # with everything linear, 1.0 being full scale. level follows rms with a
+    # fast attack and a slow release, for drawing meters.
+    RMS = 0
+    PEAK = 1
+    LEVEL = 2
+
+    def __init__(self, loop, interval=0.05, attack=0.025, release=0.3):
+        self.loop = loop
+        self.interval = interval
+        self.attack = attack
+        self.release = release
+
+        self.index = {}
+        self.sessions = []
+        self._levels = numpy.zeros((16, 3), dtype=numpy.float32)
+
+        self._frames = []
+        self._rows = []
+        self._handle = None
+        self._callback = None
+        self._last_tick = None
+
+        self.ticks = 0
+        self.frames_metered = 0
+
+    @property
+    def levels(self):
+        return self._levels[:len(self.sessions)]
+
+    def level(self, session):
+        return self._levels[self.index[session]]
+
+    def _row_for(self, session):
+        try:
+            return self.index[session]
+        except KeyError:
+            pass
+
+        row = len(self.sessions)
+        if row == len(self._levels):
+            levels = numpy.zeros((row * 2, 3), dtype=numpy.float32)
+            levels[:row] = self._levels
+            self._levels = levels
+        self.index[session] = row
+        self.sessions.append(session)
+        return row
+
+    def add(self, session, pcm):
+        if len(pcm) >= 2:
+            self._frames.append(pcm)
+            self._rows.append(self._row_for(session))
+
+    def remove(self, session):
+        # Keeps the rows packed by moving the last one into the gap.
+        row = self.index.pop(session, None)
+        if row is None:
+            return
+
+        last = len(self.sessions) - 1
+        if row != last:
+            moved = self.sessions[last]
+            self.sessions[row] = moved
+            self.index[moved] = row
+            self._levels[row] = self._levels[last]
+        self.sessions.pop()
+        self._levels[last] = 0
+
+        if self._frames:
+            # Frames already collected for the session are dropped.
+            keep = [i for i, r in enumerate(self._rows) if r != row]
+            self._frames = [self._frames[i] for i in keep]
+            self._rows = [row if self._rows[i] == last else self._rows[i]
+                          for i in keep]
+
+    def start(self, callback=None):
+        # callback, if given, is called with the meter after every update.
+        self._callback = callback
+        if self._handle is None:
+            self._last_tick = self.loop.time()
+            self._handle = self.loop.call_later(self.interval, self._tick)
+
+    def stop(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def _tick(self):
+        now = self.loop.time()
+        self._handle = self.loop.call_later(self.interval, self._tick)
+        self.update(now - self._last_tick)
+        self._last_tick = now
+        if self._callback is not None:
+            self._callback(self)
+
+    def update(self, elapsed):
+        count = len(self.sessions)
+        rms = numpy.zeros(count, dtype=numpy.float64)
+        peak = numpy.zeros(count, dtype=numpy.float64)
+
+        if self._frames:
+            frames, rows = self._frames, numpy.array(self._rows)
+            self._frames, self._rows = [], []
+
+            lengths = numpy.fromiter((len(frame) // 2 for frame in frames),
+                                     dtype=numpy.intp, count=len(frames))
+            samples = numpy.frombuffer(
+                b''.join(frame[:length * 2]
+                         for frame, length in zip(frames, lengths)),
+                dtype='<i2').astype(numpy.float64)
+            starts = numpy.concatenate(([0], numpy.cumsum(lengths)[:-1]))
+
+            # Per frame first, then per speaker.
+            squares = numpy.add.reduceat(samples * samples, starts)
+            peaks = numpy.maximum.reduceat(numpy.abs(samples), starts)
+            total = numpy.bincount(rows, weights=squares, minlength=count)
+            n = numpy.bincount(rows, weights=lengths, minlength=count)
+            rms = numpy.sqrt(total / numpy.maximum(n, 1)) / FULL_SCALE
+            numpy.maximum.at(peak, rows, peaks / FULL_SCALE)
+
+            self.frames_metered += len(frames)
+
+        levels = self.levels
+        level = levels[:, self.LEVEL]
+        rising = rms > level
+        attack = 1 - math.exp(-elapsed / self.attack)
+        release = 1 - math.exp(-elapsed / self.release)
+        level += (rms - level) * numpy.where(rising, attack, release)
+
+        levels[:, self.RMS] = rms
+        levels[:, self.PEAK] = peak
+        self.ticks += 1
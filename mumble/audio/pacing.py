@@ -0,0 +1,152 @@
+import bisect
+import enum
+import heapq
+import itertools
+import logging
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class PacingScheduler(object):
+    class Policy(enum.Enum):
+        CATCH_UP = 'catch_up'
+        DROP = 'drop'
+
+    HISTOGRAM_BOUNDS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05)
+
+    def __init__(self, loop, policy=Policy.CATCH_UP, max_catch_up=4):
+        self.loop = loop
+        self.policy = policy
+        self.max_catch_up = max_catch_up
+
+        self._heap = []
+        self._entries = {}
+        self._counter = itertools.count()
+        self._handle = None
+        self._handle_deadline = None
+        self._clock_resolution = time.get_clock_info('monotonic').resolution
+
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.timing_counts = [0] * (len(self.HISTOGRAM_BOUNDS) + 1)
+        self.timing_samples = 0
+        self.timing_error_total = 0.0
+        self.timing_error_max = 0.0
+        self.ticks_late = 0
+        self.packets_dropped = 0
+        self.resyncs = 0
+
+    def timing_histogram(self):
+        return list(zip(self.HISTOGRAM_BOUNDS + (None,), self.timing_counts))
+
+    @property
+    def timing_error_mean(self):
+        if not self.timing_samples:
+            return 0.0
+        return self.timing_error_total / self.timing_samples
+
+    def add_stream(self, stream, deadline=None):
+        if stream in self._entries:
+            return
+
+        if deadline is None:
+            deadline = self.loop.time()
+
+        entry = [deadline, next(self._counter), stream]
+        self._entries[stream] = entry
+        heapq.heappush(self._heap, entry)
+        self._schedule()
+
+    def remove_stream(self, stream):
+        entry = self._entries.pop(stream, None)
+        if entry is not None:
+            # Lazily deleted: _run skips entries without a stream.
+            entry[2] = None
+
+    def __contains__(self, stream):
+        return stream in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _schedule(self):
+        while self._heap and self._heap[0][2] is None:
+            heapq.heappop(self._heap)
+
+        if not self._heap:
+            if self._handle is not None:
+                self._handle.cancel()
+                self._handle = None
+            return
+
+        deadline = self._heap[0][0]
+        if self._handle is not None:
+            if self._handle_deadline <= deadline:
+                return
+            self._handle.cancel()
+
+        self._handle_deadline = deadline
+        self._handle = self.loop.call_at(deadline, self._run)
+
+    def _record(self, error):
+        magnitude = abs(error)
+        self.timing_counts[
+            bisect.bisect_left(self.HISTOGRAM_BOUNDS, magnitude)] += 1
+        self.timing_samples += 1
+        self.timing_error_total += magnitude
+        if magnitude > self.timing_error_max:
+            self.timing_error_max = magnitude
+
+    def _run(self):
+        self._handle = None
+
+        # The event loop may fire a timer up to one clock tick early, so treat
+        # anything due within that as due now.
+        now = self.loop.time()
+        horizon = now + self._clock_resolution
+
+        while self._heap and self._heap[0][0] <= horizon:
+            entry = heapq.heappop(self._heap)
+            deadline, _, stream = entry
+            if stream is None:
+                continue
+
+            self._record(now - deadline)
+
+            period = stream.packet_duration
+            missed = max(0, int((now - deadline) // period))
+            count = 1
+
+            if missed:
+                self.ticks_late += 1
+                if self.policy is self.Policy.DROP:
+                    self.packets_dropped += stream.skip(missed)
+                    deadline += missed * period
+                elif missed <= self.max_catch_up:
+                    count += missed
+                    deadline += missed * period
+                else:
+                    # Too far behind to catch up without bursting, so start
+                    # a new pacing grid from here.
+                    count += self.max_catch_up
+                    deadline = now
+                    self.resyncs += 1
+
+            try:
+                active = stream.pace(count)
+            except Exception as e:
+                logger.exception('Error pacing stream %r', stream)
+                active = False
+                stream.abort(e)
+
+            if active and self._entries.get(stream) is entry:
+                entry[0] = deadline + period
+                entry[1] = next(self._counter)
+                heapq.heappush(self._heap, entry)
+            elif self._entries.get(stream) is entry:
+                del self._entries[stream]
+
+        self._schedule()
@@ -0,0 +1,340 @@
+import asyncio
+import collections
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+class VoiceSender(object):
+    FRAME_DURATION = 0.01
+    MAX_FRAME_LENGTH = 127
+    MAX_FRAMES_PER_PACKET = 10
+    SAMPLE_WIDTH = 2
+    MAX_QUEUED_PACKETS = 5
+    MAX_IDLE_TICKS = 5
+
+    def __init__(self, protocol, scheduler, bitrate=40000,
+                 frames_per_packet=2, vad=None):
+        if not 1 <= frames_per_packet <= self.MAX_FRAMES_PER_PACKET:
+            raise ValueError('frames_per_packet must be between 1 and '
+                             '{}'.format(self.MAX_FRAMES_PER_PACKET))
+
+        self.protocol = protocol
+        self.scheduler = scheduler
+        self.bitrate = bitrate
+        self.frames_per_packet = frames_per_packet
+        self.target = protocol.Target.NORMAL
+        self.sequence = 0
+        # An audio.vad.VoiceActivityDetector; frames it rejects are neither
+        # encoded nor sent.
+        self.vad = vad
+
+        self._pcm = bytearray()
+        self._packet = bytearray(
+            self.MAX_FRAMES_PER_PACKET * (self.MAX_FRAME_LENGTH + 1) + 1)
+        self._packet_length = 0
+        self._frame_headers = []
+        self._in_spurt = False
+        self._silent_frames = 0
+        self._queue = collections.deque()
+        self._open = False
+        self._idle_ticks = 0
+        self._error = None
+        self._lock = asyncio.Lock()
+        self._queue_changed = asyncio.Event()
+
+        self.frames_encoded = 0
+        self.frames_skipped = 0
+        self.bytes_saved = 0
+        self.packets_sent = 0
+        self.silent_packets = 0
+        self.packets_dropped = 0
+        self.bytes_sent = 0
+        self.underruns = 0
+
+    @property
+    def encoder(self):
+        if self.protocol.outgoing_codec is None:
+            raise RuntimeError('no outgoing codec configured')
+        return self.protocol.outgoing_codec.encoder
+
+    @property
+    def frame_bytes(self):
+        encoder = self.encoder
+        return encoder.frame_size * encoder.channels * self.SAMPLE_WIDTH
+
+    @classmethod
+    def frame_length_for(cls, bitrate):
+        return max(1, min(bitrate // 800, cls.MAX_FRAME_LENGTH))
+
+    @property
+    def frame_length(self):
+        return self.frame_length_for(self.bitrate)
+
+    @property
+    def packet_duration(self):
+        # Queued packets keep the size they were made with, so a change to
+        # frames_per_packet only paces the packets made after it.
+        if self._queue:
+            return self._queue[0][2] * self.FRAME_DURATION
+        return self.frames_per_packet * self.FRAME_DURATION
+
+    def feed(self, pcm):
+        # Encodes as many whole frames as pcm (plus whatever was left over
+        # from the previous call) provides, queues every packet that fills up
+        # for the pacing scheduler and returns the number of packets queued.
+        encoder = self.encoder
+        frame_bytes = self.frame_bytes
+
+        view = memoryview(pcm).cast('B')
+        offset = 0
+        sent = 0
+
+        if self._pcm:
+            offset = min(frame_bytes - len(self._pcm), len(view))
+            self._pcm.extend(view[:offset])
+            if len(self._pcm) < frame_bytes:
+                return 0
+            sent += self._add_frame(encoder, self._pcm)
+            del self._pcm[:]
+
+        while len(view) - offset >= frame_bytes:
+            sent += self._add_frame(encoder,
+                                    view[offset:offset + frame_bytes])
+            offset += frame_bytes
+
+        self._pcm.extend(view[offset:])
+        return sent
+
+    def flush(self, terminate=True):
+        # Pads out any partial frame with silence and queues what is left,
+        # closing the transmission with a terminator frame.
+        if self._pcm:
+            # The encoder pads short frames with silence.
+            self._add_frame(self.encoder, self._pcm, send=False)
+            del self._pcm[:]
+
+        # Silence that never made up a full packet has nothing to keep time
+        # for any more.
+        self._silent_frames = 0
+
+        if self._frame_headers or \
+           terminate and (self.vad is None or self._in_spurt):
+            self._send_frames(terminate)
+
+    def _add_frame(self, encoder, pcm, send=True):
+        if self.vad is not None and not self.vad.is_active(pcm):
+            return self._add_silence(send)
+
+        queued = 0
+        if self._silent_frames:
+            queued += self._queue_silence()
+
+        # Frames are encoded straight into the packet being assembled, behind
+        # a one byte header that is filled in once the packet is complete.
+        header_offset = self._packet_length
+        n = encoder.encode_into(pcm, self.frame_length, self._packet,
+                                header_offset + 1)
+        self._packet[header_offset] = n
+        self._frame_headers.append(header_offset)
+        self._packet_length += n + 1
+        self.frames_encoded += 1
+        self._in_spurt = True
+
+        if send and len(self._frame_headers) >= self.frames_per_packet:
+            self._send_frames(False)
+            queued += 1
+        return queued
+
+    def _add_silence(self, send):
+        # Ends the current talk spurt, if any, with a terminator. The silent
+        # frames themselves are queued as placeholders that send nothing but
+        # still take up their time, so that pacing holds across silence and
+        # sequence numbers keep counting frames like Mumble's do.
+        queued = 0
+        if self._in_spurt:
+            self._send_frames(True)
+            queued += 1
+
+        self.frames_skipped += 1
+        self.bytes_saved += self.frame_length + 1
+
+        if send:
+            self._silent_frames += 1
+            if self._silent_frames >= self.frames_per_packet:
+                queued += self._queue_silence()
+        return queued
+
+    def _queue_silence(self):
+        self._queue_packet(None, self._silent_frames)
+        self._silent_frames = 0
+        return 1
+
+    def _send_frames(self, terminate):
+        headers = self._frame_headers
+        self._frame_headers = []
+
+        for header_offset in headers[:-1]:
+            self._packet[header_offset] |= 0b10000000
+
+        if terminate:
+            if headers:
+                self._packet[headers[-1]] |= 0b10000000
+            self._packet[self._packet_length] = 0
+            self._packet_length += 1
+
+        body = bytes(self._packet[:self._packet_length])
+        self._packet_length = 0
+        if terminate:
+            self._in_spurt = False
+
+        self._queue_packet(body, len(headers) + (1 if terminate else 0),
+                           terminate)
+
+    def _queue_packet(self, body, frame_count, terminate=False,
+                      frames_per_packet=None):
+        if frames_per_packet is None:
+            frames_per_packet = self.frames_per_packet
+        self._queue.append((body, frame_count, frames_per_packet))
+        self._open = not terminate
+        self.scheduler.add_stream(self)
+
+    def _send_packet(self, body, frame_count):
+        if body is None:
+            self.sequence += frame_count
+            self.silent_packets += 1
+            return
+
+        # Sequence numbers are assigned on the way out so that dropped packets
+        # still show up as gaps on the receiving end.
+        payload = self.protocol._encode_varint(self.sequence) + body
+        self.protocol.send_voice_data(self.protocol.outgoing_type, self.target,
+                                      payload)
+        self.sequence += frame_count
+        self.packets_sent += 1
+        self.bytes_sent += len(payload) + 1
+
+    def pace(self, count):
+        # Called by the pacing scheduler once per packet interval; returns
+        # whether the stream wants to stay scheduled.
+        for _ in range(count):
+            if not self._queue:
+                break
+            body, frame_count, _ = self._queue.popleft()
+            self._send_packet(body, frame_count)
+            self._idle_ticks = 0
+        else:
+            self._queue_changed.set()
+            return True
+
+        self._queue_changed.set()
+        if not self._open:
+            return False
+
+        if self._idle_ticks == 0:
+            self.underruns += 1
+        self._idle_ticks += 1
+
+        # A stream that has gone quiet without being flushed gives up its
+        # slot; queueing the next packet schedules it again.
+        return self._idle_ticks < self.MAX_IDLE_TICKS
+
+    def abort(self, exc=None):
+        # Drops everything not yet sent and hands exc to whoever is waiting
+        # on the queue.
+        del self._pcm[:]
+        self._frame_headers = []
+        self._packet_length = 0
+        self._in_spurt = False
+        self._silent_frames = 0
+        if self.vad is not None:
+            self.vad.reset()
+        self._queue.clear()
+        self._open = False
+        self._idle_ticks = 0
+        self._error = exc
+        self.scheduler.remove_stream(self)
+        self._queue_changed.set()
+
+    def skip(self, count):
+        # Never drops the last queued packet, which may be a terminator.
+        skipped = 0
+        while skipped < count and len(self._queue) > 1:
+            _, frame_count, _ = self._queue.popleft()
+            self.sequence += frame_count
+            skipped += 1
+
+        self.packets_dropped += skipped
+        self._queue_changed.set()
+        return skipped
+
+    async def _wait_for_queue(self, size):
+        while len(self._queue) > size and self in self.scheduler:
+            self._queue_changed.clear()
+            await self._queue_changed.wait()
+
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _check_target(self, target):
+        if target is None:
+            return self.protocol.Target.NORMAL
+
+        value = getattr(target, 'value', target)
+        if not 0 <= value <= 31:
+            raise ValueError('invalid voice target: {!r}'.format(target))
+        return self.protocol._target_to_type(value)
+
+    async def send_pcm(self, source, target=None):
+        target = self._check_target(target)
+
+        async with self._lock:
+            self.target = target
+
+            try:
+                if hasattr(source, '__aiter__'):
+                    async for chunk in source:
+                        await self._send_chunk(chunk)
+                else:
+                    await self._send_chunk(source)
+
+                self.flush()
+                await self._wait_for_queue(0)
+            except BaseException:
+                # Cancelled or failed: don't wait for the rest to play out.
+                self.abort()
+                raise
+
+    async def play_clip(self, clip, target=None):
+        target = self._check_target(target)
+
+        if clip.bitstream_version != \
+           self.protocol.outgoing_codec.bitstream_version:
+            raise ValueError('clip was encoded for a different codec')
+
+        async with self._lock:
+            self.target = target
+
+            # The clip's packets are paced by its own packing, leaving
+            # frames_per_packet to whatever the bandwidth controller sets.
+            try:
+                for i, (body, frame_count) in enumerate(clip.packets()):
+                    self._queue_packet(body, frame_count,
+                                       i == len(clip) - 1,
+                                       clip.frames_per_packet)
+                    await self._wait_for_queue(self.MAX_QUEUED_PACKETS)
+
+                await self._wait_for_queue(0)
+            except BaseException:
+                self.abort()
+                raise
+
+    async def _send_chunk(self, pcm):
+        view = memoryview(pcm).cast('B')
+        step = self.frame_bytes * self.frames_per_packet
+
+        for offset in range(0, len(view), step):
+            if self.feed(view[offset:offset + step]):
+                await self._wait_for_queue(self.MAX_QUEUED_PACKETS)
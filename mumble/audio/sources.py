@@ -0,0 +1,146 @@
+import mmap
+import os
+import struct
+
+from . import sender
+
+
+RIFF_HEADER = struct.Struct('<4sI4s')
+CHUNK_HEADER = struct.Struct('<4sI')
+FMT_CHUNK = struct.Struct('<HHIIHH')
+
+WAVE_FORMAT_PCM = 1
+WAVE_FORMAT_EXTENSIBLE = 0xfffe
+
+
+def find_wav_data(buf, channels, rate):
+    # Returns (offset, length) of the PCM samples in a RIFF/WAVE file.
+    try:
+        riff, _, wave = RIFF_HEADER.unpack_from(buf)
+    except struct.error:
+        raise ValueError('not a WAV file')
+    if riff != b'RIFF' or wave != b'WAVE':
+        raise ValueError('not a WAV file')
+
+    offset = RIFF_HEADER.size
+    format_seen = False
+
+    while offset + CHUNK_HEADER.size <= len(buf):
+        chunk_id, chunk_size = CHUNK_HEADER.unpack_from(buf, offset)
+        offset += CHUNK_HEADER.size
+
+        if chunk_id == b'fmt ':
+            format, chunk_channels, chunk_rate, _, _, bits = \
+                FMT_CHUNK.unpack_from(buf, offset)
+            if format not in (WAVE_FORMAT_PCM, WAVE_FORMAT_EXTENSIBLE) or \
+               chunk_channels != channels or chunk_rate != rate or \
+               bits != sender.VoiceSender.SAMPLE_WIDTH * 8:
+                raise ValueError('WAV file is not {}-channel 16-bit {} Hz '
+                                 'PCM'.format(channels, rate))
+            format_seen = True
+        elif chunk_id == b'data':
+            if not format_seen:
+                raise ValueError('WAV data chunk precedes its format')
+            return offset, min(chunk_size, len(buf) - offset)
+
+        # Chunks are padded to an even length.
+        offset += chunk_size + (chunk_size & 1)
+
+    raise ValueError('WAV file has no data chunk')
+
+
+class FileSource(object):
+    # Streams 16-bit PCM out of a memory-mapped WAV or raw file as views of
+    # exactly one frame each, so memory use does not grow with file length.
+
+    def __init__(self, path, frame_size=480, channels=1, rate=48000,
+                 loop=False):
+        self.path = path
+        self.rate = rate
+        self.channels = channels
+        self.frame_bytes = frame_size * channels * \
+            sender.VoiceSender.SAMPLE_WIDTH
+        self.loop = loop
+
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                raise ValueError('{} is empty'.format(path))
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            if path.lower().endswith('.wav'):
+                self._start, length = find_wav_data(self._mmap, channels,
+                                                    rate)
+            else:
+                self._start, length = 0, len(self._mmap)
+        except ValueError:
+            self._mmap.close()
+            raise
+
+        # Drop any trailing partial sample.
+        sample_bytes = channels * sender.VoiceSender.SAMPLE_WIDTH
+        self._end = self._start + length - length % sample_bytes
+        self._position = self._start
+        self._view = memoryview(self._mmap)
+
+    @property
+    def duration(self):
+        return (self._end - self._start) / (self.rate * self.channels *
+                                            sender.VoiceSender.SAMPLE_WIDTH)
+
+    def tell(self):
+        return (self._position - self._start) // self.frame_bytes
+
+    def seek_frame(self, frame):
+        position = self._start + frame * self.frame_bytes
+        if not self._start <= position <= self._end:
+            raise ValueError('frame {} is out of range'.format(frame))
+        self._position = position
+
+    def seek(self, seconds):
+        self.seek_frame(int(seconds * self.rate * self.channels *
+                            sender.VoiceSender.SAMPLE_WIDTH) //
+                        self.frame_bytes)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._position >= self._end:
+            if not self.loop or self._end == self._start:
+                raise StopIteration
+            self._position = self._start
+
+        start = self._position
+        self._position = min(start + self.frame_bytes, self._end)
+        frame = self._view[start:self._position]
+        if self.loop and len(frame) < self.frame_bytes:
+            # A short frame would put every frame after it out of step with
+            # the sender's, which would have to copy each one; pad it out
+            # with silence instead.
+            return bytes(frame) + bytes(self.frame_bytes - len(frame))
+        return frame
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return self.__next__()
+        except StopIteration:
+            raise StopAsyncIteration
+
+    def close(self):
+        try:
+            self._view.release()
+            self._mmap.close()
+        except BufferError:
+            # A frame view is still alive somewhere; the mapping goes away
+            # once it is collected.
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,87 @@
+import array
+import math
+import sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+FULL_SCALE = 32768
+
+
+def frame_energy(pcm):
+    # Mean power of a frame of 16-bit little-endian PCM in dBFS; -inf for
+    # digital silence.
+    data = bytes(pcm)
+    data = data[:len(data) - len(data) % 2]
+    if data.count(0) == len(data):
+        return -math.inf
+
+    if numpy is not None:
+        samples = numpy.frombuffer(data, dtype='<i2').astype(numpy.float64)
+        power = numpy.dot(samples, samples) / len(samples)
+    else:
+        samples = array.array('h', data)
+        if sys.byteorder == 'big':
+            samples.byteswap()
+        power = sum(sample * sample for sample in samples) / len(samples)
+
+    if power == 0:
+        return -math.inf
+    return 10 * math.log10(power / (FULL_SCALE * FULL_SCALE))
+
+
+def spectral_flatness(pcm):
+    # Between 0 for a pure tone and 1 for white noise; voiced speech sits
+    # well below broadband noise.
+    samples = numpy.frombuffer(bytes(pcm), dtype='<i2').astype(numpy.float64)
+    spectrum = numpy.abs(numpy.fft.rfft(samples *
+                                        numpy.hanning(len(samples))))[1:]
+    spectrum = spectrum * spectrum + 1e-12
+    return float(math.exp(numpy.mean(numpy.log(spectrum))) /
+                 numpy.mean(spectrum))
+
+
+class VoiceActivityDetector(object):
+    # An energy gate with hangover: a frame is active if it is louder than
+    # threshold dBFS and, with spectral, not noise-like. The hangover frames
+    # after the last active one count as active too, so that pauses between
+    # words don't cut a transmission up.
+
+    def __init__(self, threshold=-50.0, hangover=30, spectral=False,
+                 max_flatness=0.4):
+        if spectral and numpy is None:
+            raise RuntimeError('spectral voice activity detection needs '
+                               'numpy')
+
+        self.threshold = threshold
+        self.hangover = hangover
+        self.spectral = spectral
+        self.max_flatness = max_flatness
+
+        self._hangover_left = 0
+
+        self.active_frames = 0
+        self.inactive_frames = 0
+
+    def reset(self):
+        self._hangover_left = 0
+
+    def is_active(self, pcm):
+        active = frame_energy(pcm) > self.threshold
+        if active and self.spectral:
+            active = spectral_flatness(pcm) < self.max_flatness
+
+        if active:
+            self._hangover_left = self.hangover
+        elif self._hangover_left > 0:
+            self._hangover_left -= 1
+            active = True
+
+        if active:
+            self.active_frames += 1
+        else:
+            self.inactive_frames += 1
+        return active
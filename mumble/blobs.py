@@ -0,0 +1,220 @@
+import binascii
+import collections
+import hashlib
+import logging
+import os
+import tempfile
+
+
+logger = logging.getLogger(__name__)
+
+
+def blob_hash(data):
+    # What Mumble calls a blob's hash: the SHA-1 of its bytes, UTF-8 for text.
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return hashlib.sha1(data).digest()
+
+
+class BlobCache(object):
+    # Comments, textures and descriptions on disk, one file per blob named
+    # after its hash. Files are written under a temporary name and renamed
+    # into place, so processes can share a directory; modification times
+    # serve as last use times for evicting the least recently used blobs
+    # once the directory grows past max_size.
+    SUFFIX = '.blob'
+
+    def __init__(self, directory, max_size=64 * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+        os.makedirs(self.directory, exist_ok=True)
+        # What this process believes the directory holds. Other processes'
+        # blobs are only noticed when evicting, so the limit is a soft one.
+        self._size = self.evict()
+
+    def _path(self, hash):
+        return os.path.join(self.directory,
+                            binascii.hexlify(hash).decode('ascii') +
+                            self.SUFFIX)
+
+    def get(self, hash):
+        # The blob's bytes, or None if it isn't cached.
+        path = self._path(hash)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+
+        if blob_hash(data) != hash:
+            logger.warn('Discarding corrupt blob %s', path)
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            self.misses += 1
+            return None
+
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        self.hits += 1
+        return data
+
+    def put(self, hash, data):
+        # Stores data under hash unless it doesn't match, as for a blob that
+        # changed in the meantime. Returns whether it was stored.
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        if blob_hash(data) != hash:
+            return False
+
+        path = self._path(hash)
+        if os.path.exists(path):
+            return True
+
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        self.stores += 1
+
+        self._size += len(data)
+        if self._size > self.max_size:
+            self._size = self.evict(keep=path)
+        return True
+
+    def evict(self, keep=None):
+        entries = []
+        total = 0
+
+        for name in os.listdir(self.directory):
+            if not name.endswith(self.SUFFIX):
+                continue
+            entry_path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(entry_path)
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, entry_path, st.st_size))
+            total += st.st_size
+
+        entries.sort()
+        for _, entry_path, size in entries:
+            if total <= self.max_size:
+                break
+            if entry_path == keep:
+                continue
+            try:
+                os.unlink(entry_path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            self.evictions += 1
+
+        return total
+
+
+class BlobRequestScheduler(object):
+    # Gathers blob requests made close together into as few RequestBlob
+    # messages as possible. A blob that is already asked for isn't asked for
+    # again until it arrives or TIMEOUT seconds pass without an answer.
+    FIELDS = ('texture', 'comment', 'description')
+    # Blobs asked for in one message, to keep it and the answers to it from
+    # hogging the control connection.
+    MAX_PER_MESSAGE = 128
+    TIMEOUT = 10
+
+    def __init__(self, loop, send, delay=0):
+        # send(textures, comments, descriptions) requests blobs for lists
+        # of users, users and channels. Requests made within delay seconds
+        # of the first one, or in the same loop iteration by default, go
+        # out together.
+        self.loop = loop
+        self.send = send
+        self.delay = delay
+
+        # (field, entity) -> None, and -> when it was sent.
+        self._pending = collections.OrderedDict()
+        self._in_flight = {}
+        self._handle = None
+
+        self.requests = 0
+        self.deduplicated = 0
+        self.messages = 0
+        self.received_blobs = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    @property
+    def mean_latency(self):
+        if not self.received_blobs:
+            return None
+        return self.total_latency / self.received_blobs
+
+    @property
+    def in_flight(self):
+        return len(self._in_flight)
+
+    def request(self, field, entity):
+        self.requests += 1
+        key = (field, entity)
+        sent = self._in_flight.get(key)
+        if key in self._pending or \
+           sent is not None and self.loop.time() - sent < self.TIMEOUT:
+            self.deduplicated += 1
+            return
+
+        self._pending[key] = None
+        if self._handle is None:
+            if self.delay:
+                self._handle = self.loop.call_later(self.delay, self.flush)
+            else:
+                self._handle = self.loop.call_soon(self.flush)
+
+    def flush(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+        keys = list(self._pending)
+        self._pending.clear()
+        now = self.loop.time()
+
+        for start in range(0, len(keys), self.MAX_PER_MESSAGE):
+            entities = {field: [] for field in self.FIELDS}
+            for key in keys[start:start + self.MAX_PER_MESSAGE]:
+                field, entity = key
+                entities[field].append(entity)
+                self._in_flight[key] = now
+            self.send(entities['texture'], entities['comment'],
+                      entities['description'])
+            self.messages += 1
+
+    def received(self, field, entity):
+        self._pending.pop((field, entity), None)
+        sent = self._in_flight.pop((field, entity), None)
+        if sent is None:
+            return
+        latency = self.loop.time() - sent
+        self.received_blobs += 1
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+
+    def forget(self, entity):
+        # Drops everything asked for entity, which has gone away.
+        for field in self.FIELDS:
+            self._pending.pop((field, entity), None)
+            self._in_flight.pop((field, entity), None)
@@ -1,20 +1,79 @@
 import asyncio
+import logging
 import ssl
 
+from . import blobs
 from . import entities
+from . import snapshots
+from . import targets
+from . import tree
+from .audio import bandwidth
+from .audio import pacing
+from .audio import sender
+from .audio import sources
 from .protocols import control
 from .protocols import voice
 
 
+logger = logging.getLogger(__name__)
+
+try:
+    from . import mmsg
+except Exception as e:
+    logger.warn('Could not load recvmmsg/sendmmsg, voice will use the '
+                'standard UDP transport: %s', e)
+    mmsg = None
+
+
 class Client(object):
     MUMBLE_VERSION = (1, 2, 4)
 
+    # Whether to try sending voice over UDP rather than only through the
+    # control connection.
+    UDP_ENABLED = True
+
+    # Whether to move UDP voice in batches with recvmmsg/sendmmsg where they
+    # are available.
+    UDP_BATCHED_IO = True
+
+    # Whether to decode incoming voice for voice_received. Talking events and
+    # speaker statistics work either way.
+    DECODE_VOICE = True
+
     def __init__(self):
         self.channels = {}
+        # name -> every channel with that name, as they aren't unique.
         self.channels_by_name = {}
+        self.channel_tree = tree.ChannelTree()
 
         self.users = {}
         self.users_by_name = {}
+        # channel id -> {session: user} for the users in the channel.
+        self.channel_users = {}
+        # Sessions heard talking, for the channel tree's aggregates.
+        self._talking = set()
+
+        self._snapshots = snapshots.SnapshotBuilder(self)
+
+        # May be replaced before connecting to share one scheduler between
+        # several clients.
+        self.pacing_scheduler = None
+
+        # Set to an audio.clips.ClipCache to enable play_clip.
+        self.clip_cache = None
+
+        # Set to a blobs.BlobCache to keep comments, textures and channel
+        # descriptions across connections instead of requesting them again.
+        self.blob_cache = None
+        self.blob_scheduler = None
+
+        # Set to an audio.vad.VoiceActivityDetector to leave silence out of
+        # outgoing voice.
+        self.voice_activity_detector = None
+
+        # Set to an audio.metering.LoudnessMeter to meter incoming voice;
+        # voice_levels_updated is called every time it refreshes.
+        self.loudness_meter = None
 
     async def connect(self, host, port, username, password=None, ssl_ctx=None):
         if ssl_ctx is None:
@@ -28,52 +87,144 @@ class Client(object):
 
         self.control_protocol = control.Protocol(self, self.username, password)
         self.voice_protocol = voice.Protocol(self)
+        self.voice_protocol.decode_enabled = self.DECODE_VOICE
+        if self.loudness_meter is not None:
+            self.voice_protocol.meter = self.loudness_meter
+            self.loudness_meter.start(self.voice_levels_updated)
+        if self.pacing_scheduler is None:
+            self.pacing_scheduler = pacing.PacingScheduler(self.loop)
+        self.voice_targets = targets.VoiceTargets(
+            self.control_protocol.send_voice_target)
+        self.voice_sender = sender.VoiceSender(
+            self.voice_protocol, self.pacing_scheduler,
+            vad=self.voice_activity_detector)
+        self.bandwidth_controller = bandwidth.BandwidthController(
+            self.loop, self.voice_sender, self.voice_protocol)
+        self.bandwidth_controller.start()
+        self.blob_scheduler = blobs.BlobRequestScheduler(
+            self.loop, self._send_blob_request)
 
         await self.loop.create_connection(lambda: self.control_protocol,
                                           self.host, self.port, ssl=ssl_ctx)
 
+        if self.UDP_ENABLED:
+            try:
+                if self.UDP_BATCHED_IO and mmsg is not None:
+                    await mmsg.create_datagram_endpoint(
+                        self.loop, lambda: self.voice_protocol,
+                        remote_addr=(self.host, self.port))
+                else:
+                    await self.loop.create_datagram_endpoint(
+                        lambda: self.voice_protocol,
+                        remote_addr=(self.host, self.port))
+            except OSError as e:
+                logger.warn('Could not open UDP voice channel, using the TCP '
+                            'tunnel: %s', e)
+
     @property
     def me(self):
         return self.users_by_name[self.username]
 
     def _update_channel(self, state):
-        if state.channel_id not in self.channels:
-            self.channels[state.channel_id] = entities.Channel(
-                self, state.channel_id)
+        channel_id = state.channel_id
+        channel = self.channels.get(channel_id)
+        if channel is None:
+            channel = self.channels[channel_id] = entities.Channel(
+                self, channel_id)
+            old_name = None
         else:
-            # We need to delete the old channels_by_name mapping here.
-            del self.channels_by_name[self.channels[state.channel_id].name]
+            old_name = channel.name
 
-        channel = self.channels[state.channel_id]
         channel.update_from_state(state)
-        self.channels_by_name[channel.name] = channel
+        self._snapshots.channel_changed(channel_id)
+        if channel.name != old_name:
+            if old_name is not None:
+                self._forget_channel_name(channel, old_name)
+            self.channels_by_name.setdefault(channel.name, []).append(channel)
+        self.channel_tree.update(channel)
         return channel
 
+    def _forget_channel_name(self, channel, name):
+        channels = self.channels_by_name[name]
+        channels.remove(channel)
+        if not channels:
+            del self.channels_by_name[name]
+
     def _remove_channel(self, id):
         channel = self.channels[id]
         del self.channels[id]
-        del self.channels_by_name[channel.name]
+        self._forget_channel_name(channel, channel.name)
+        self.channel_tree.remove(id)
+        self._snapshots.channel_changed(id)
+        if self.blob_scheduler is not None:
+            self.blob_scheduler.forget(channel)
 
     def _update_user(self, state):
-        if state.session not in self.users:
-            self.users[state.session] = entities.User(self, state.session)
+        session = state.session
+        user = self.users.get(session)
+        if user is None:
+            user = self.users[session] = entities.User(self, session)
         else:
             # We need to delete the old users_by_name mapping here.
-            del self.users_by_name[self.users[state.session].name]
+            del self.users_by_name[user.name]
 
-        user = self.users[state.session]
         user.update_from_state(state)
         self.users_by_name[user.name] = user
+        self._snapshots.user_changed(session)
         return user
 
     def _remove_user(self, session):
         user = self.users[session]
         del self.users[session]
         del self.users_by_name[user.name]
+        self._snapshots.user_changed(session)
+
+    def _move_member(self, user, old_channel_id, new_channel_id):
+        self.channel_tree.user_moved(old_channel_id, new_channel_id,
+                                     user.session in self._talking)
+        if old_channel_id is not None:
+            members = self.channel_users[old_channel_id]
+            del members[user.session]
+            if not members:
+                del self.channel_users[old_channel_id]
+        if new_channel_id is not None:
+            self.channel_users.setdefault(new_channel_id, {})[
+                user.session] = user
 
     def get_root_channel(self):
         return self.channels[0]
 
+    def snapshot(self):
+        # An immutable snapshots.Snapshot of users, channels and their
+        # indexes, for reading from other threads. Call it from the loop;
+        # it only costs as much as what changed since the last one.
+        return self._snapshots.snapshot()
+
+    def snapshot_threadsafe(self, timeout=None):
+        # snapshot() for other threads: blocks until the loop has taken it.
+        async def take():
+            return self.snapshot()
+
+        return asyncio.run_coroutine_threadsafe(take(), self.loop).result(
+            timeout)
+
+    def channel_at(self, path):
+        # The channel at a path like '/Games/CS/Team A' from the root, or a
+        # list of names; None if there is none.
+        if isinstance(path, str):
+            path = [name for name in path.split('/') if name]
+        channel_id = self.channel_tree.find(path,
+                                            self.get_root_channel().id)
+        if channel_id is None:
+            return None
+        return self.channels[channel_id]
+
+    def speaker_stats(self):
+        # Voice receive statistics for every user heard from so far.
+        return {self.users[session]: snapshot for session, snapshot in
+                self.voice_protocol.speaker_stats().items()
+                if session in self.users}
+
     def send_text_message(self, target, message, recursive=False):
         sessions = []
         channel_ids = []
@@ -95,6 +246,47 @@ class Client(object):
         self.control_protocol.move_user(self.me.session, self.me.session,
                                         channel.id)
 
+    def voice_target(self, *audience):
+        # Returns a target for send_pcm, send_file and play_clip that reaches
+        # every user, channel, targets.ChannelTarget and group name given,
+        # registering it with the server only the first time.
+        current = self.voice_sender.target
+        busy = {current.value} \
+            if isinstance(current, voice.Protocol.VoiceTarget) else ()
+        return voice.Protocol.VoiceTarget(
+            self.voice_targets.get(audience, busy))
+
+    def _resolve_target(self, target):
+        if isinstance(target, (list, tuple, set, frozenset)):
+            return self.voice_target(*target)
+        elif isinstance(target, (entities.User, entities.Channel,
+                                 targets.ChannelTarget)):
+            return self.voice_target(target)
+        return target
+
+    async def send_pcm(self, source, target=None):
+        await self.voice_sender.send_pcm(source, self._resolve_target(target))
+
+    async def send_file(self, path, target=None, loop=False):
+        encoder = self.voice_sender.encoder
+        with sources.FileSource(path, encoder.frame_size, encoder.channels,
+                                encoder.rate, loop) as source:
+            await self.send_pcm(source, target)
+
+    async def play_clip(self, path, target=None):
+        if self.clip_cache is None:
+            raise RuntimeError('no clip cache configured')
+
+        clip = await self.clip_cache.get(
+            path, self.voice_protocol.outgoing_codec,
+            self.voice_sender.bitrate, self.voice_sender.frames_per_packet,
+            self.loop)
+        try:
+            await self.voice_sender.play_clip(clip,
+                                              self._resolve_target(target))
+        finally:
+            clip.close()
+
     def request_blobs(self, texture_for_users=None, comment_for_users=None,
                       description_for_channels=None):
         if texture_for_users is None:
@@ -106,12 +298,31 @@ class Client(object):
         if description_for_channels is None:
             description_for_channels = []
 
+        if self.blob_scheduler is None:
+            self._send_blob_request(texture_for_users, comment_for_users,
+                                    description_for_channels)
+            return
+
+        # Requests from many get_* calls at once go out together.
+        for user in texture_for_users:
+            self.blob_scheduler.request('texture', user)
+        for user in comment_for_users:
+            self.blob_scheduler.request('comment', user)
+        for channel in description_for_channels:
+            self.blob_scheduler.request('description', channel)
+
+    def _send_blob_request(self, texture_for_users, comment_for_users,
+                           description_for_channels):
         self.control_protocol.request_blobs(
             session_textures=[user.session for user in texture_for_users],
             session_comments=[user.session for user in comment_for_users],
             channel_descriptions=[channel.id
                                   for channel in description_for_channels])
 
+    def blob_received(self, entity, name):
+        if self.blob_scheduler is not None:
+            self.blob_scheduler.received(name, entity)
+
     def user_moved(self, user, source, dest):
         # Override me!
         pass
@@ -136,18 +347,61 @@ class Client(object):
         # Override me!
         pass
 
+    def voice_path_changed(self, path):
+        # Override me!
+        pass
+
+    def voice_levels_updated(self, meter):
+        # Override me!
+        pass
+
+    def user_talking_started(self, user):
+        # Override me!
+        pass
+
+    def user_talking_stopped(self, user):
+        # Override me!
+        pass
+
     def voice_packet_received(self, session, target, pcm):
         self.voice_received(self.users[session], target, pcm)
 
+    def voice_talking_started(self, session):
+        # Voice can arrive before the user's state or after their removal.
+        user = self.users.get(session)
+        if user is None:
+            return
+        self._talking.add(session)
+        self.channel_tree.talking_changed(user.channel_id, True)
+        self.user_talking_started(user)
+
+    def voice_talking_stopped(self, session):
+        user = self.users.get(session)
+        if user is None:
+            return
+        if session in self._talking:
+            self._talking.remove(session)
+            self.channel_tree.talking_changed(user.channel_id, False)
+        self.user_talking_stopped(user)
+
     def control_connection_made(self):
-        self.voice_protocol.connection_made(self.control_protocol.udp_tunnel)
+        self.voice_protocol.tunnel_made(self.control_protocol.udp_tunnel)
 
     def control_codec_version_received(self, alpha, beta, prefer_alpha, opus):
         self.voice_protocol.setup_codecs(alpha, beta, prefer_alpha, opus)
 
+    def control_max_bandwidth_received(self, max_bandwidth):
+        self.bandwidth_controller.set_max_bandwidth(max_bandwidth)
+
     def control_crypt_setup_received(self, key, client_nonce, server_nonce):
         self.voice_protocol.setup_crypt(key, client_nonce, server_nonce)
 
+    def voice_crypt_nonce_requested(self, client_nonce):
+        self.control_protocol.send_crypt_setup(client_nonce)
+
+    def voice_crypt_resync_needed(self):
+        self.control_protocol.send_crypt_setup()
+
     def control_udp_tunnel_received(self, packet):
         self.voice_protocol.plaintext_data_received(packet)
 
@@ -158,24 +412,28 @@ class Client(object):
         self._remove_channel(channel_id)
 
     def control_user_state_received(self, state):
-        if state.session not in self.users:
-            new_user = True
-        else:
-            new_user = False
-            old_chan = self.users[state.session].channel_id
-        self._update_user(state)
-        user = self.users[state.session]
-        if new_user:
+        old_user = self.users.get(state.session)
+        if old_user is not None:
+            old_chan = old_user.channel_id
+        user = self._update_user(state)
+        if old_user is None:
+            self._move_member(user, None, user.channel_id)
             self.user_connected(user)
             self.user_moved(user, None, self.channels[user.channel_id])
-        elif self.channels[old_chan] is not self.channels[user.channel_id]:
+        elif old_chan != user.channel_id:
+            self._move_member(user, old_chan, user.channel_id)
             self.user_moved(user, self.channels[old_chan], self.channels[user.channel_id])
 
     def control_user_remove_received(self, session):
         user = self.users[session]
+        self._move_member(user, user.channel_id, None)
+        self._talking.discard(session)
         self.user_moved(user, self.channels[user.channel_id], None)
         self.user_disconnected(self.users[session])
         self._remove_user(session)
+        self.voice_protocol.forget_session(session)
+        if self.blob_scheduler is not None:
+            self.blob_scheduler.forget(user)
 
     def control_text_message_received(self, actor, message, sessions,
                                       channel_ids):
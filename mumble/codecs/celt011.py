@@ -85,29 +85,71 @@ class Decoder(object):
 
 
 class Encoder(object):
+    MAX_COMPRESSED_SIZE = 1275
+
     def __init__(self, rate, channels=1):
         self.rate = rate
+        self.frame_size = FRAME_SIZE
         self.channels = channels
+        self.frame_bytes = self.frame_size * self.channels * 2
 
         self.encoder = ffi.gc(
             celt_call_errout('celt_encoder_create', self.rate, self.channels),
             libcelt.celt_encoder_destroy)
-        self.frame_buffer = ffi.new('int16_t[]', FRAME_SIZE)
+        self.frame_buffer = ffi.new('int16_t[]', self.frame_size * channels)
+        self.compressed_buffer = ffi.new('unsigned char[]',
+                                         self.MAX_COMPRESSED_SIZE)
+        self.silence = bytes(self.frame_bytes)
+
+    def _pcm_pointer(self, pcm):
+        # Returns the from_buffer object along with the pointer, as it must
+        # be kept alive for as long as the pointer is in use.
+        buf = ffi.from_buffer(pcm)
+        if len(buf) >= self.frame_bytes:
+            return buf, ffi.cast('int16_t*', buf)
+
+        # Short frames are padded with silence in the preallocated buffer.
+        ffi.memmove(self.frame_buffer, buf, len(buf))
+        ffi.memmove(ffi.cast('char*', self.frame_buffer) + len(buf),
+                    self.silence, self.frame_bytes - len(buf))
+        return buf, self.frame_buffer
+
+    def _encode(self, pcm, compressed, size):
+        if size > self.MAX_COMPRESSED_SIZE:
+            raise ValueError('compressed size must be at most {}'.format(
+                self.MAX_COMPRESSED_SIZE))
+
+        buf, pcm_pointer = self._pcm_pointer(pcm)
+        n = libcelt.celt_encode(self.encoder, pcm_pointer, FRAME_SIZE,
+                                compressed, size)
+        del buf
+
+        # celt_check_error only catches positive codes, but celt-0.11 reports
+        # errors as negative return values.
+        if n < 0:
+            raise RuntimeError('celt_encode error {}: {}'.format(
+                n, ffi.string(libcelt.celt_strerror(n)).decode('ascii')))
 
-    def encode(self, pcm, size):
-        compressed = ffi.new('char[]', size)
+        return n
 
-        n = libcelt.celt_encode(
-            self.encoder, ffi.cast('int16_t*', ffi.new('char[]', pcm)),
-            FRAME_SIZE, compressed, size)
+    def encode(self, pcm, size):
+        n = self._encode(pcm, self.compressed_buffer, size)
+        return bytes(ffi.buffer(self.compressed_buffer, n))
 
-        if n < 0:
-            celt_check_error('celt_encode', n)
+    def encode_into(self, pcm, size, out, offset=0):
+        if len(out) - offset < size:
+            raise ValueError('output buffer too small')
 
-        return bytes(ffi.buffer(compressed, n))
+        out_buf = ffi.from_buffer(out)
+        n = self._encode(pcm, ffi.cast('unsigned char*', out_buf) + offset,
+                         size)
+        del out_buf
+        return n
 
 
 class Codec(object):
+    bitstream_version = BITSTREAM_VERSION
+
     def __init__(self, rate, channels=1):
         self.encoder = Encoder(rate, channels)
         self.decoder = Decoder(rate, channels)
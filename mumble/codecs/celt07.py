@@ -91,6 +91,8 @@ class Decoder(object):
 
 
 class Encoder(object):
+    MAX_COMPRESSED_SIZE = 1275
+
     def __init__(self, rate, frame_size=None, channels=1):
         if frame_size is None:
             frame_size = rate // 100
@@ -98,26 +100,64 @@ class Encoder(object):
         self.rate = rate
         self.frame_size = frame_size
         self.channels = channels
+        self.frame_bytes = self.frame_size * self.channels * 2
 
         self.mode = create_mode(self.rate, self.frame_size)
         self.encoder = ffi.gc(
             celt_call_errout('celt_encoder_create', self.mode, self.channels),
             libcelt.celt_encoder_destroy)
 
-    def encode(self, pcm, size):
-        compressed = ffi.new('char[]', size)
-
-        n = libcelt.celt_encode(
-            self.encoder, ffi.cast('int16_t*', ffi.new('char[]', pcm)),
-            ffi.cast('int16_t*', 0), compressed, size)
+        self.frame_buffer = ffi.new('int16_t[]', self.frame_size * channels)
+        self.compressed_buffer = ffi.new('unsigned char[]',
+                                         self.MAX_COMPRESSED_SIZE)
+        self.silence = bytes(self.frame_bytes)
+
+    def _pcm_pointer(self, pcm):
+        # Returns the from_buffer object along with the pointer, as it must
+        # be kept alive for as long as the pointer is in use.
+        buf = ffi.from_buffer(pcm)
+        if len(buf) >= self.frame_bytes:
+            return buf, ffi.cast('int16_t*', buf)
+
+        # Short frames are padded with silence in the preallocated buffer.
+        ffi.memmove(self.frame_buffer, buf, len(buf))
+        ffi.memmove(ffi.cast('char*', self.frame_buffer) + len(buf),
+                    self.silence, self.frame_bytes - len(buf))
+        return buf, self.frame_buffer
+
+    def _encode(self, pcm, compressed, size):
+        if size > self.MAX_COMPRESSED_SIZE:
+            raise ValueError('compressed size must be at most {}'.format(
+                self.MAX_COMPRESSED_SIZE))
+
+        buf, pcm_pointer = self._pcm_pointer(pcm)
+        n = libcelt.celt_encode(self.encoder, pcm_pointer, ffi.NULL, compressed,
+                                size)
+        del buf
 
         if n < 0:
             celt_check_error('celt_encode', n)
 
-        return bytes(ffi.buffer(compressed, n))
+        return n
+
+    def encode(self, pcm, size):
+        n = self._encode(pcm, self.compressed_buffer, size)
+        return bytes(ffi.buffer(self.compressed_buffer, n))
+
+    def encode_into(self, pcm, size, out, offset=0):
+        if len(out) - offset < size:
+            raise ValueError('output buffer too small')
+
+        out_buf = ffi.from_buffer(out)
+        n = self._encode(pcm, ffi.cast('unsigned char*', out_buf) + offset,
+                         size)
+        del out_buf
+        return n
 
 
 class Codec(object):
+    bitstream_version = BITSTREAM_VERSION
+
     def __init__(self, rate, frame_size=None, channels=1):
         self.encoder = Encoder(rate, frame_size, channels)
         self.decoder = Decoder(rate, frame_size, channels)
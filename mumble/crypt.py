@@ -0,0 +1,474 @@
+import cffi
+import ctypes.util
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+AES_BLOCK_SIZE = 16
+
+# Batches smaller than this are cheaper to run one packet at a time.
+BATCH_THRESHOLD = 4
+
+
+ffi = cffi.FFI()
+ffi.cdef("""
+typedef ... EVP_CIPHER_CTX;
+typedef ... EVP_CIPHER;
+typedef ... ENGINE;
+
+EVP_CIPHER_CTX* EVP_CIPHER_CTX_new(void);
+void EVP_CIPHER_CTX_free(EVP_CIPHER_CTX* ctx);
+int EVP_CIPHER_CTX_set_padding(EVP_CIPHER_CTX* ctx, int padding);
+
+const EVP_CIPHER* EVP_aes_128_ecb(void);
+
+int EVP_EncryptInit_ex(EVP_CIPHER_CTX* ctx, const EVP_CIPHER* type,
+                       ENGINE* impl, const unsigned char* key,
+                       const unsigned char* iv);
+int EVP_EncryptUpdate(EVP_CIPHER_CTX* ctx, unsigned char* out, int* outl,
+                      const unsigned char* in, int inl);
+int EVP_DecryptInit_ex(EVP_CIPHER_CTX* ctx, const EVP_CIPHER* type,
+                       ENGINE* impl, const unsigned char* key,
+                       const unsigned char* iv);
+int EVP_DecryptUpdate(EVP_CIPHER_CTX* ctx, unsigned char* out, int* outl,
+                      const unsigned char* in, int inl);
+""")
+
+
+def _load_libcrypto():
+    library_names = ['libcrypto.so.3', 'libcrypto.so.1.1', 'libcrypto.so',
+                     'libcrypto.3.dylib', 'libcrypto.dylib',
+                     'libcrypto-3-x64.dll', 'libcrypto-1_1-x64.dll']
+    found = ctypes.util.find_library('crypto')
+    if found is not None:
+        library_names.append(found)
+
+    for library_name in library_names:
+        try:
+            return ffi.dlopen(library_name)
+        except OSError:
+            pass
+    else:
+        raise ImportError('could not load libcrypto')
+
+
+libcrypto = _load_libcrypto()
+
+
+class AES(object):
+    # AES-128 in ECB mode, which is all OCB needs: every call transforms any
+    # number of independent blocks in one go.
+
+    def __init__(self, key):
+        if len(key) != AES_BLOCK_SIZE:
+            raise ValueError('AES-128 keys are 16 bytes')
+
+        self._encrypt_ctx = self._create_ctx(libcrypto.EVP_EncryptInit_ex,
+                                             key)
+        self._decrypt_ctx = self._create_ctx(libcrypto.EVP_DecryptInit_ex,
+                                             key)
+        self._out_length = ffi.new('int*')
+
+    def _create_ctx(self, init, key):
+        ctx = ffi.gc(libcrypto.EVP_CIPHER_CTX_new(),
+                     libcrypto.EVP_CIPHER_CTX_free)
+        if ctx == ffi.NULL or \
+           not init(ctx, libcrypto.EVP_aes_128_ecb(), ffi.NULL, key,
+                    ffi.NULL) or \
+           not libcrypto.EVP_CIPHER_CTX_set_padding(ctx, 0):
+            raise RuntimeError('could not set up AES context')
+        return ctx
+
+    def _update(self, update, ctx, blocks):
+        if len(blocks) % AES_BLOCK_SIZE:
+            raise ValueError('input is not a multiple of the block size')
+
+        out = bytearray(len(blocks))
+        out_buf = ffi.from_buffer(out)
+        in_buf = ffi.from_buffer(blocks)
+        if not update(ctx, ffi.cast('unsigned char*', out_buf),
+                      self._out_length, ffi.cast('unsigned char*', in_buf),
+                      len(blocks)):
+            raise RuntimeError('AES operation failed')
+        del out_buf, in_buf
+        return bytes(out)
+
+    def encrypt(self, blocks):
+        return self._update(libcrypto.EVP_EncryptUpdate, self._encrypt_ctx,
+                            blocks)
+
+    def decrypt(self, blocks):
+        return self._update(libcrypto.EVP_DecryptUpdate, self._decrypt_ctx,
+                            blocks)
+
+
+def _block_to_int(block):
+    return int.from_bytes(block, 'big')
+
+
+def _int_to_block(value):
+    return value.to_bytes(AES_BLOCK_SIZE, 'big')
+
+
+def _times2(value):
+    # Doubling in GF(2^128), as used by OCB to derive offsets.
+    value <<= 1
+    if value >> 128:
+        value = (value & ((1 << 128) - 1)) ^ 0x87
+    return value
+
+
+def _times3(value):
+    return _times2(value) ^ value
+
+
+def ocb_encrypt(aes, plain, nonce):
+    # OCB2 as used by Mumble; returns (encrypted, tag).
+    delta = _block_to_int(aes.encrypt(nonce))
+    checksum = 0
+    encrypted = bytearray()
+
+    offset = 0
+    while len(plain) - offset > AES_BLOCK_SIZE:
+        delta = _times2(delta)
+        block = _block_to_int(plain[offset:offset + AES_BLOCK_SIZE])
+        checksum ^= block
+        tmp = _block_to_int(aes.encrypt(_int_to_block(block ^ delta)))
+        encrypted += _int_to_block(tmp ^ delta)
+        offset += AES_BLOCK_SIZE
+
+    remaining = len(plain) - offset
+    delta = _times2(delta)
+    pad = aes.encrypt(_int_to_block((remaining * 8) ^ delta))
+    tail = bytes(plain[offset:]) + pad[remaining:]
+    checksum ^= _block_to_int(tail)
+    encrypted += _int_to_block(_block_to_int(tail) ^
+                               _block_to_int(pad))[:remaining]
+
+    tag = aes.encrypt(_int_to_block(_times3(delta) ^ checksum))
+    return bytes(encrypted), tag
+
+
+def ocb_decrypt(aes, encrypted, nonce):
+    # Returns (plain, tag); the caller compares the tag.
+    delta = _block_to_int(aes.encrypt(nonce))
+    checksum = 0
+    plain = bytearray()
+
+    offset = 0
+    while len(encrypted) - offset > AES_BLOCK_SIZE:
+        delta = _times2(delta)
+        block = _block_to_int(encrypted[offset:offset + AES_BLOCK_SIZE])
+        tmp = _block_to_int(aes.decrypt(_int_to_block(block ^ delta)))
+        block = tmp ^ delta
+        checksum ^= block
+        plain += _int_to_block(block)
+        offset += AES_BLOCK_SIZE
+
+    remaining = len(encrypted) - offset
+    delta = _times2(delta)
+    pad = aes.encrypt(_int_to_block((remaining * 8) ^ delta))
+    tail = _block_to_int(bytes(encrypted[offset:]) +
+                         bytes(AES_BLOCK_SIZE - remaining)) ^ \
+        _block_to_int(pad)
+    checksum ^= tail
+    plain += _int_to_block(tail)[:remaining]
+
+    tag = aes.encrypt(_int_to_block(_times3(delta) ^ checksum))
+    return bytes(plain), tag
+
+
+def _times2_array(blocks):
+    # _times2 over an (n, 16) uint8 array of big-endian blocks.
+    words = blocks.view('>u8').astype(numpy.uint64)
+    hi, lo = words[:, 0], words[:, 1]
+    carry = hi >> numpy.uint64(63)
+    words[:, 0] = hi << numpy.uint64(1) | lo >> numpy.uint64(63)
+    words[:, 1] = lo << numpy.uint64(1) ^ carry * numpy.uint64(0x87)
+    return words.astype('>u8').view(numpy.uint8)
+
+
+def _ocb_batch(aes, messages, nonces, decrypt):
+    # OCB2 over many messages at once, with every AES step of the batch done
+    # in a single ECB call: one for the nonces, one for the message blocks
+    # (plus one for the pads when decrypting) and one for the tags. Returns
+    # a list of (data, tag) like ocb_encrypt and ocb_decrypt.
+    count = len(messages)
+    lengths = numpy.array([len(m) for m in messages], dtype=numpy.intp)
+    full = numpy.maximum(lengths - 1, 0) // AES_BLOCK_SIZE
+    remaining = lengths - full * AES_BLOCK_SIZE
+    width = int(full.max()) + 1
+
+    data = numpy.zeros((count, width * AES_BLOCK_SIZE), dtype=numpy.uint8)
+    for i, message in enumerate(messages):
+        data[i, :len(message)] = numpy.frombuffer(message, dtype=numpy.uint8)
+    data = data.reshape(count, width, AES_BLOCK_SIZE)
+
+    # deltas[:, i] is the offset for block i; the block after the last full
+    # one is the final, partial, block.
+    deltas = numpy.empty_like(data)
+    delta = numpy.frombuffer(aes.encrypt(b''.join(nonces)),
+                             dtype=numpy.uint8).reshape(count, AES_BLOCK_SIZE)
+    for i in range(width):
+        delta = _times2_array(delta)
+        deltas[:, i] = delta
+
+    rows = numpy.arange(count)
+    is_full = numpy.arange(width) < full[:, None]
+    final_delta = deltas[rows, full]
+    final_in = final_delta.copy()
+    final_in[:, -1] ^= (remaining * 8).astype(numpy.uint8)
+
+    full_in = (data ^ deltas)[is_full]
+    if decrypt:
+        full_out = numpy.frombuffer(aes.decrypt(full_in.tobytes()),
+                                    dtype=numpy.uint8)
+        pad = numpy.frombuffer(aes.encrypt(final_in.tobytes()),
+                               dtype=numpy.uint8)
+    else:
+        out = numpy.frombuffer(aes.encrypt(full_in.tobytes() +
+                                           final_in.tobytes()),
+                               dtype=numpy.uint8)
+        full_out, pad = out[:full_in.size], out[full_in.size:]
+    pad = pad.reshape(count, AES_BLOCK_SIZE)
+
+    result = data.copy()
+    result[is_full] = full_out.reshape(-1, AES_BLOCK_SIZE) ^ deltas[is_full]
+
+    final = data[rows, full]
+    result[rows, full] = final ^ pad
+    if decrypt:
+        tail = final ^ pad
+        plain = result
+    else:
+        beyond = numpy.arange(AES_BLOCK_SIZE) >= remaining[:, None]
+        tail = final ^ (pad & beyond * numpy.uint8(0xff))
+        plain = data
+
+    checksum = numpy.bitwise_xor.reduce(plain * is_full[:, :, None], axis=1)
+    checksum ^= tail
+    tags = aes.encrypt((_times2_array(final_delta) ^ final_delta ^
+                        checksum).tobytes())
+
+    result = result.reshape(count, -1)
+    return [(result[i, :lengths[i]].tobytes(),
+             tags[i * AES_BLOCK_SIZE:(i + 1) * AES_BLOCK_SIZE])
+            for i in range(count)]
+
+
+def ocb_encrypt_batch(aes, plains, nonces):
+    if numpy is None or len(plains) < BATCH_THRESHOLD:
+        return [ocb_encrypt(aes, plain, nonce)
+                for plain, nonce in zip(plains, nonces)]
+    return _ocb_batch(aes, plains, nonces, False)
+
+
+def ocb_decrypt_batch(aes, encrypteds, nonces):
+    if numpy is None or len(encrypteds) < BATCH_THRESHOLD:
+        return [ocb_decrypt(aes, encrypted, nonce)
+                for encrypted, nonce in zip(encrypteds, nonces)]
+    return _ocb_batch(aes, encrypteds, nonces, True)
+
+
+def _increment(iv, start=0):
+    for i in range(start, AES_BLOCK_SIZE):
+        iv[i] = (iv[i] + 1) & 0xff
+        if iv[i]:
+            break
+
+
+def _decrement(iv, start=0):
+    for i in range(start, AES_BLOCK_SIZE):
+        iv[i] = (iv[i] - 1) & 0xff
+        if iv[i] != 0xff:
+            break
+
+
+class CryptState(object):
+    # The UDP voice channel's encryption: OCB2-AES128 with a 4 byte header
+    # carrying the low byte of the nonce and the first 3 bytes of the tag,
+    # plus Mumble's replay window and good/late/lost accounting.
+
+    HEADER_SIZE = 4
+
+    def __init__(self):
+        self.aes = None
+        self.encrypt_iv = bytearray(AES_BLOCK_SIZE)
+        self.decrypt_iv = bytearray(AES_BLOCK_SIZE)
+        self.decrypt_history = bytearray(256)
+
+        self.good = 0
+        self.late = 0
+        self.lost = 0
+        self.resync = 0
+
+    def is_valid(self):
+        return self.aes is not None
+
+    def set_key(self, key, client_nonce, server_nonce):
+        self.aes = AES(key)
+        self.encrypt_iv[:] = client_nonce
+        self.decrypt_iv[:] = server_nonce
+        self.decrypt_history[:] = bytes(256)
+
+    def set_decrypt_iv(self, iv):
+        self.resync += 1
+        self.decrypt_iv[:] = iv
+
+    def encrypt(self, plain):
+        _increment(self.encrypt_iv)
+        encrypted, tag = ocb_encrypt(self.aes, plain, bytes(self.encrypt_iv))
+        return bytes([self.encrypt_iv[0]]) + tag[:3] + encrypted
+
+    def encrypt_batch(self, plains):
+        nonces = []
+        for _ in plains:
+            _increment(self.encrypt_iv)
+            nonces.append(bytes(self.encrypt_iv))
+
+        return [bytes([nonce[0]]) + tag[:3] + encrypted
+                for nonce, (encrypted, tag) in
+                zip(nonces, ocb_encrypt_batch(self.aes, plains, nonces))]
+
+    def _next_decrypt_iv(self, ivbyte):
+        # Works out the nonce for a packet from its low byte, updating
+        # decrypt_iv. Returns (saved iv, restore, late, lost), or None if
+        # the packet is a replay or too far out of order.
+        iv = self.decrypt_iv
+        saved = bytes(iv)
+        restore = False
+        late = 0
+        lost = 0
+
+        if (iv[0] + 1) & 0xff == ivbyte:
+            # In order, as expected.
+            if ivbyte > iv[0]:
+                iv[0] = ivbyte
+            elif ivbyte < iv[0]:
+                iv[0] = ivbyte
+                _increment(iv, 1)
+            else:
+                return None
+        else:
+            diff = ivbyte - iv[0]
+            if diff > 128:
+                diff -= 256
+            elif diff < -128:
+                diff += 256
+
+            if ivbyte < iv[0] and -30 < diff < 0:
+                # Late packet, without wraparound.
+                late = 1
+                lost = -1
+                iv[0] = ivbyte
+                restore = True
+            elif ivbyte > iv[0] and -30 < diff < 0:
+                # Late packet from before the last wraparound.
+                late = 1
+                lost = -1
+                iv[0] = ivbyte
+                _decrement(iv, 1)
+                restore = True
+            elif ivbyte > iv[0] and diff > 0:
+                # Some packets were lost, without wraparound.
+                lost = ivbyte - iv[0] - 1
+                iv[0] = ivbyte
+            elif ivbyte < iv[0] and diff > 0:
+                # Some packets were lost and the counter wrapped around.
+                lost = 256 - iv[0] + ivbyte - 1
+                iv[0] = ivbyte
+                _increment(iv, 1)
+            else:
+                return None
+
+            if self.decrypt_history[iv[0]] == iv[1]:
+                iv[:] = saved
+                return None
+
+        return saved, restore, late, lost
+
+    def _finish_decrypt(self, tag, header, state):
+        saved, restore, late, lost = state
+        iv = self.decrypt_iv
+
+        if tag[:3] != bytes(header[1:4]):
+            iv[:] = saved
+            return False
+
+        self.decrypt_history[iv[0]] = iv[1]
+        if restore:
+            iv[:] = saved
+
+        self.good += 1
+        self.late += late
+        self.lost += lost
+        return True
+
+    def decrypt(self, data):
+        # Returns the plaintext, or None if the packet must be dropped.
+        if len(data) < self.HEADER_SIZE or not self.is_valid():
+            return None
+
+        state = self._next_decrypt_iv(data[0])
+        if state is None:
+            return None
+
+        plain, tag = ocb_decrypt(self.aes, data[self.HEADER_SIZE:],
+                                 bytes(self.decrypt_iv))
+        if not self._finish_decrypt(tag, data, state):
+            return None
+        return plain
+
+    def decrypt_batch(self, datagrams):
+        # Like decrypt over each datagram in turn. Nonces are worked out up
+        # front as if every packet will authenticate; if one does not, the
+        # state is rolled back to it and the rest are decrypted one at a
+        # time, so that forged packets can't make the batch start over.
+        if not self.is_valid():
+            return [None] * len(datagrams)
+
+        pending = []
+        for i, data in enumerate(datagrams):
+            if len(data) < self.HEADER_SIZE:
+                continue
+            state = self._next_decrypt_iv(data[0])
+            if state is None:
+                continue
+
+            # Claim the nonce now so that a copy later in the batch is
+            # caught as a replay.
+            iv = self.decrypt_iv
+            nonce = bytes(iv)
+            history = self.decrypt_history[iv[0]]
+            self.decrypt_history[iv[0]] = iv[1]
+            if state[1]:
+                iv[:] = state[0]
+            pending.append((i, nonce, history, state))
+
+        results = ocb_decrypt_batch(
+            self.aes,
+            [datagrams[i][self.HEADER_SIZE:] for i, _, _, _ in pending],
+            [nonce for _, nonce, _, _ in pending])
+
+        plains = [None] * len(datagrams)
+        for k, ((i, _, _, state), (plain, tag)) in \
+                enumerate(zip(pending, results)):
+            if tag[:3] == bytes(datagrams[i][1:4]):
+                _, _, late, lost = state
+                self.good += 1
+                self.late += late
+                self.lost += lost
+                plains[i] = plain
+                continue
+
+            for _, later_nonce, history, _ in reversed(pending[k:]):
+                self.decrypt_history[later_nonce[0]] = history
+            self.decrypt_iv[:] = state[0]
+            for j in range(i + 1, len(datagrams)):
+                plains[j] = self.decrypt(datagrams[j])
+            break
+
+        return plains
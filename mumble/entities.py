@@ -1,51 +1,163 @@
 import asyncio
-import operator
 
 from google.protobuf import descriptor
 
 
+# The value of a blob whose hash is known but whose contents aren't.
+_UNKNOWN = object()
+
+
+class Blob(object):
+    # What an entity knows about one of its blobs: the hash the server gave
+    # for it, if any, and its value once that arrived. A future to wait on
+    # only exists while someone is waiting for the value.
+    __slots__ = ['hash', 'value', 'waiter']
+
+    def __init__(self):
+        self.hash = None
+        self.value = _UNKNOWN
+        self.waiter = None
+
+
 class Entity(object):
     FIELDS = {}
     BLOB_FIELDS = set()
+    # Blob fields that hold text rather than bytes.
+    TEXT_BLOB_FIELDS = set()
 
-    def __init__(self):
-        self._futures = {}
-        self._hashes = {}
+    # Entities have no __dict__; subclasses list their fields as slots, and
+    # a slot per blob field named in BLOB_SLOTS. Blob records are only
+    # allocated once there is a hash or a blob, as most users never have
+    # either.
+    __slots__ = []
+    BLOB_SLOTS = {}
 
+    def __init__(self):
         for k in self.FIELDS:
             setattr(self, k, None)
+        for slot in self.BLOB_SLOTS.values():
+            setattr(self, slot, None)
+
+    def _blob(self, name):
+        slot = self.BLOB_SLOTS[name]
+        blob = getattr(self, slot)
+        if blob is None:
+            blob = Blob()
+            setattr(self, slot, blob)
+        return blob
+
+    def _blob_value(self, name):
+        # Returns (known, value). Without a record the blob is empty.
+        blob = getattr(self, self.BLOB_SLOTS[name])
+        if blob is None:
+            return True, None
 
-    def _future_for_field(self, name):
-        return self._futures[name]
+        if blob.value is _UNKNOWN:
+            value = self._cached_blob(name, blob.hash)
+            if value is None:
+                return False, None
+            blob.value = value
+        return True, blob.value
+
+    def _cached_blob(self, name, hash):
+        cache = self.client.blob_cache
+        if cache is None or hash is None:
+            return None
+        value = cache.get(hash)
+        if value is not None and name in self.TEXT_BLOB_FIELDS:
+            value = value.decode('utf-8')
+        return value
+
+    async def _get_blob(self, name, **request):
+        known, value = self._blob_value(name)
+        if known:
+            return value
+
+        blob = self._blob(name)
+        if blob.waiter is None:
+            blob.waiter = asyncio.Future()
+        waiter = blob.waiter
+        self.client.request_blobs(**request)
+        return (await waiter)
+
+    def _blob_hash_received(self, name, hash):
+        blob = self._blob(name)
+        if blob.hash != hash:
+            blob.hash = hash
+            blob.value = _UNKNOWN
+            if blob.waiter is not None:
+                blob.waiter.cancel()
+                blob.waiter = None
+
+    def _blob_received(self, name, value):
+        blob = self._blob(name)
+        blob.value = value
+        if blob.waiter is not None:
+            if not blob.waiter.done():
+                blob.waiter.set_result(value)
+            blob.waiter = None
+        self.client.blob_received(self, name)
+
+        cache = self.client.blob_cache
+        if cache is not None and blob.hash is not None:
+            cache.put(blob.hash, value)
 
     def update_from_state(self, state):
-        for k, f in self.FIELDS.items():
-            if state.DESCRIPTOR.fields_by_name[f].label == \
-                descriptor.FieldDescriptor.LABEL_REPEATED:
-                v = list(getattr(state, f))
-            elif state.HasField(f):
-                v = getattr(state, f)
-            else:
-                continue
+        try:
+            update = _update_functions[type(self)]
+        except KeyError:
+            update = _update_functions[type(self)] = \
+                _compile_update(type(self), state.DESCRIPTOR)
+        update(self, state)
 
-            setattr(self, k, v)
 
-        for k in self.BLOB_FIELDS:
-            if state.HasField(k + '_hash'):
-                hash = getattr(state, k + '_hash')
-                if self._hashes.get(k) != hash and k in self._futures:
-                    self._futures[k].cancel()
-                    del self._futures[k]
-                self._hashes[k] = hash
+# The update function for each entity class, made on its first update.
+_update_functions = {}
 
-            if k not in self._futures:
-                self._futures[k] = asyncio.Future()
 
-            if not self._futures[k].done():
-                if state.HasField(k):
-                    self._futures[k].set_result(getattr(state, k))
-                elif k not in self._hashes:
-                    self._futures[k].set_result(None)
+def _compile_update(cls, message_descriptor):
+    # Works out once which message fields go where, so that an update only
+    # visits the fields actually present in the message.
+    setters = {}
+    repeated = []
+    for k, f in cls.FIELDS.items():
+        if message_descriptor.fields_by_name[f].label == \
+           descriptor.FieldDescriptor.LABEL_REPEATED:
+            setters[f] = (k, True)
+            repeated.append(k)
+        else:
+            setters[f] = (k, False)
+
+    hashes = {k + '_hash': k for k in cls.BLOB_FIELDS}
+    blobs = set(cls.BLOB_FIELDS)
+
+    def update(entity, state):
+        # Repeated fields always take the message's list, empty or not.
+        for k in repeated:
+            setattr(entity, k, [])
+
+        received = None
+        for field, value in state.ListFields():
+            name = field.name
+            try:
+                k, is_repeated = setters[name]
+            except KeyError:
+                if name in hashes:
+                    entity._blob_hash_received(hashes[name], value)
+                elif name in blobs:
+                    # Blobs go after all hashes, which may come later.
+                    if received is None:
+                        received = []
+                    received.append((name, value))
+                continue
+
+            setattr(entity, k, list(value) if is_repeated else value)
+
+        if received is not None:
+            for name, value in received:
+                entity._blob_received(name, value)
+
+    return update
 
 
 class Channel(Entity):
@@ -60,6 +172,14 @@ class Channel(Entity):
         'description'
     }
 
+    TEXT_BLOB_FIELDS = {
+        'description'
+    }
+
+    BLOB_SLOTS = {k: '_' + k + '_blob' for k in BLOB_FIELDS}
+
+    __slots__ = ['client', 'id'] + list(FIELDS) + list(BLOB_SLOTS.values())
+
     def __init__(self, client, id):
         super().__init__()
         self.client = client
@@ -74,21 +194,42 @@ class Channel(Entity):
         return [self.client.channels[link_id]
                 for link_id in self.link_ids]
 
+    def get_path(self):
+        # Where client.channel_at finds this channel.
+        return '/' + '/'.join(self.client.channel_tree.path(self.id))
+
     def get_children(self):
-        children = [channel for channel in self.client.channels.values()
-                            if channel.parent_id == self.id]
-        children.sort(key=operator.attrgetter('position'))
-        return children
+        channels = self.client.channels
+        return [channels[channel_id] for channel_id in
+                self.client.channel_tree.children(self.id)]
+
+    def walk(self):
+        # This channel and all of its subchannels, depth first in the order
+        # they are shown.
+        channels = self.client.channels
+        for channel_id in self.client.channel_tree.walk(self.id):
+            yield channels[channel_id]
 
     def get_users(self):
-        return [user for user in self.client.users.values()
-                     if user.channel_id == self.id]
+        return list(self.client.channel_users.get(self.id, {}).values())
+
+    def get_user_count(self, recursive=False):
+        # With recursive, users in subchannels count too.
+        if recursive:
+            return self.client.channel_tree.user_count(self.id)
+        return len(self.client.channel_users.get(self.id, ()))
+
+    def get_subtree_depth(self):
+        # How many levels of subchannels there are below this channel.
+        return self.client.channel_tree.height(self.id)
+
+    def has_talking_users(self):
+        # Whether anyone in this channel or its subchannels is talking.
+        return self.client.channel_tree.talking_count(self.id) > 0
 
     async def get_description(self):
-        fut = self._future_for_field('description')
-        if not fut.done():
-            self.client.request_blobs(description_for_channels=[self])
-        return (await fut)
+        return (await self._get_blob('description',
+                                     description_for_channels=[self]))
 
 
 class User(Entity):
@@ -111,6 +252,15 @@ class User(Entity):
         'texture'
     }
 
+    TEXT_BLOB_FIELDS = {
+        'comment'
+    }
+
+    BLOB_SLOTS = {k: '_' + k + '_blob' for k in BLOB_FIELDS}
+
+    __slots__ = ['client', 'session'] + list(FIELDS) + \
+        list(BLOB_SLOTS.values())
+
     def __init__(self, client, session):
         super().__init__()
         self.client = client
@@ -121,13 +271,7 @@ class User(Entity):
         return self.client.channels[self.channel_id]
 
     async def get_comment(self):
-        fut = self._future_for_field('comment')
-        if not fut.done():
-            self.client.request_blobs(comment_for_users=[self])
-        return (await fut)
+        return (await self._get_blob('comment', comment_for_users=[self]))
 
     async def get_texture(self):
-        fut = self._future_for_field('texture')
-        if not fut.done():
-            self.client.request_blobs(texture_for_users=[self])
-        return (await fut)
+        return (await self._get_blob('texture', texture_for_users=[self]))
@@ -0,0 +1,263 @@
+import asyncio
+import collections
+import errno
+import itertools
+import logging
+import socket
+import struct
+
+import cffi
+
+
+logger = logging.getLogger(__name__)
+
+# Large enough for any voice packet; Mumble caps them well below this.
+MAX_DATAGRAM_SIZE = 2048
+BATCH_SIZE = 64
+
+MSG_DONTWAIT = 0x40
+
+
+ffi = cffi.FFI()
+ffi.cdef("""
+typedef unsigned int socklen_t;
+
+struct iovec {
+    void* iov_base;
+    size_t iov_len;
+};
+
+struct msghdr {
+    void* msg_name;
+    socklen_t msg_namelen;
+    struct iovec* msg_iov;
+    size_t msg_iovlen;
+    void* msg_control;
+    size_t msg_controllen;
+    int msg_flags;
+};
+
+struct mmsghdr {
+    struct msghdr msg_hdr;
+    unsigned int msg_len;
+};
+
+int recvmmsg(int sockfd, struct mmsghdr* msgvec, unsigned int vlen,
+             int flags, void* timeout);
+int sendmmsg(int sockfd, struct mmsghdr* msgvec, unsigned int vlen,
+             int flags);
+""")
+
+
+def _load_libc():
+    libc = ffi.dlopen(None)
+    try:
+        libc.recvmmsg
+        libc.sendmmsg
+    except AttributeError:
+        raise ImportError('recvmmsg and sendmmsg are not available')
+    return libc
+
+
+libc = _load_libc()
+
+
+class _MessageVector(object):
+    # A preallocated array of mmsghdrs, each with its own iovec, and a buffer
+    # with room for a full batch of datagrams.
+
+    def __init__(self, size):
+        self.size = size
+        self.msgs = ffi.new('struct mmsghdr[]', size)
+        self.iovecs = ffi.new('struct iovec[]', size)
+        self.iovecs_view = ffi.buffer(self.iovecs)
+        self.buffer = ffi.new('char[]', size * MAX_DATAGRAM_SIZE)
+        self.view = ffi.buffer(self.buffer)
+        self.address = int(ffi.cast('uintptr_t', self.buffer))
+
+        for i in range(size):
+            self.msgs[i].msg_hdr.msg_iov = self.iovecs + i
+            self.msgs[i].msg_hdr.msg_iovlen = 1
+            self.iovecs[i].iov_base = self.buffer + i * MAX_DATAGRAM_SIZE
+            self.iovecs[i].iov_len = MAX_DATAGRAM_SIZE
+
+        # Filling in iovecs one cdata field at a time costs more than the
+        # system call saves, so they are packed in one go.
+        self._iovec_structs = {}
+
+    def pack(self, datagrams):
+        # Copies datagrams back to back into the buffer and points the
+        # iovecs at them.
+        count = len(datagrams)
+        lengths = [len(data) for data in datagrams]
+        joined = b''.join(datagrams)
+        ffi.memmove(self.buffer, joined, len(joined))
+
+        try:
+            iovec_struct = self._iovec_structs[count]
+        except KeyError:
+            iovec_struct = self._iovec_structs[count] = \
+                struct.Struct('@' + 'PN' * count)
+
+        offsets = itertools.accumulate([self.address] + lengths[:-1])
+        iovec_struct.pack_into(self.iovecs_view, 0,
+                               *itertools.chain.from_iterable(
+                                   zip(offsets, lengths)))
+
+
+class MMsgDatagramTransport(asyncio.DatagramTransport):
+    # A datagram transport for a connected socket that moves up to
+    # BATCH_SIZE datagrams per system call. Protocols with a
+    # datagrams_received method get whole batches at a time.
+
+    def __init__(self, loop, sock, protocol, batch_size=BATCH_SIZE):
+        super().__init__({'socket': sock, 'sockname': sock.getsockname(),
+                          'peername': sock.getpeername()})
+        self._loop = loop
+        self._sock = sock
+        self._fileno = sock.fileno()
+        self._protocol = protocol
+        self._closing = False
+        self._send_queue = collections.deque()
+
+        self._recv = _MessageVector(batch_size)
+        self._send = _MessageVector(batch_size)
+
+        self.packets_received = 0
+        self.packets_sent = 0
+        self.recv_calls = 0
+        self.send_calls = 0
+
+        self._loop.call_soon(self._protocol.connection_made, self)
+        self._loop.call_soon(self._loop.add_reader, self._fileno,
+                             self._read_ready)
+
+    def get_protocol(self):
+        return self._protocol
+
+    def set_protocol(self, protocol):
+        self._protocol = protocol
+
+    def is_closing(self):
+        return self._closing
+
+    def get_write_buffer_size(self):
+        return sum(len(data) for data in self._send_queue)
+
+    def _read_ready(self):
+        recv = self._recv
+        size = MAX_DATAGRAM_SIZE
+
+        while True:
+            n = libc.recvmmsg(self._fileno, recv.msgs, recv.size,
+                              MSG_DONTWAIT, ffi.NULL)
+            if n < 0:
+                err = ffi.errno
+                if err not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    self._protocol.error_received(
+                        OSError(err, 'recvmmsg failed'))
+                return
+
+            self.recv_calls += 1
+            self.packets_received += n
+            datagrams = [recv.view[i * size:i * size + recv.msgs[i].msg_len]
+                         for i in range(n)]
+            try:
+                datagrams_received = self._protocol.datagrams_received
+            except AttributeError:
+                peername = self._extra['peername']
+                for data in datagrams:
+                    self._protocol.datagram_received(data, peername)
+            else:
+                datagrams_received(datagrams)
+
+            if n < recv.size or self._closing:
+                return
+
+    def sendto(self, data, addr=None):
+        self.sendto_many([data])
+
+    def sendto_many(self, datagrams):
+        if self._closing:
+            return
+        for data in datagrams:
+            if len(data) > MAX_DATAGRAM_SIZE:
+                raise ValueError('datagram of {} bytes is over the {} byte '
+                                 'limit'.format(len(data), MAX_DATAGRAM_SIZE))
+        self._send_queue.extend(datagrams)
+        if len(self._send_queue) == len(datagrams):
+            self._write_ready()
+
+    def _write_ready(self):
+        send = self._send
+        queue = self._send_queue
+
+        while queue:
+            count = min(len(queue), send.size)
+            send.pack(list(itertools.islice(queue, count)))
+
+            n = libc.sendmmsg(self._fileno, send.msgs, count, MSG_DONTWAIT)
+            err = ffi.errno
+
+            if n < 0:
+                if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    break
+                # Like the standard transport, drop what failed and report.
+                queue.popleft()
+                self._protocol.error_received(OSError(err, 'sendmmsg failed'))
+                continue
+
+            self.send_calls += 1
+            self.packets_sent += n
+            for _ in range(n):
+                queue.popleft()
+
+        if queue:
+            self._loop.add_writer(self._fileno, self._write_ready)
+        else:
+            self._loop.remove_writer(self._fileno)
+
+    def close(self):
+        if self._closing:
+            return
+        self._closing = True
+        self._loop.remove_reader(self._fileno)
+        self._loop.remove_writer(self._fileno)
+        self._send_queue.clear()
+        self._loop.call_soon(self._call_connection_lost, None)
+
+    def abort(self):
+        self.close()
+
+    def _call_connection_lost(self, exc):
+        try:
+            self._protocol.connection_lost(exc)
+        finally:
+            self._sock.close()
+
+
+async def create_datagram_endpoint(loop, protocol_factory, remote_addr,
+                                   batch_size=BATCH_SIZE):
+    # Like loop.create_datagram_endpoint(..., remote_addr=...), but with an
+    # MMsgDatagramTransport.
+    host, port = remote_addr
+    infos = await loop.getaddrinfo(host, port, type=socket.SOCK_DGRAM)
+    if not infos:
+        raise OSError('getaddrinfo returned nothing for {}'.format(host))
+
+    exceptions = []
+    for family, type, proto, _, address in infos:
+        sock = socket.socket(family, type, proto)
+        try:
+            sock.setblocking(False)
+            sock.connect(address)
+        except OSError as e:
+            sock.close()
+            exceptions.append(e)
+            continue
+
+        protocol = protocol_factory()
+        return MMsgDatagramTransport(loop, sock, protocol, batch_size), \
+            protocol
+
+    raise exceptions[0]
@@ -0,0 +1,266 @@
+import collections.abc
+
+
+# A hash array mapped trie: every level uses 5 more bits of the key's hash to
+# pick one of 32 branches, and a node only stores the branches in use, with a
+# bitmap telling which those are. Changing a map copies the nodes on the way
+# to the key and shares everything else with the old map.
+BITS = 5
+MASK = (1 << BITS) - 1
+HASH_BITS = 64
+
+
+def _hash(key):
+    return hash(key) & ((1 << HASH_BITS) - 1)
+
+
+try:
+    _popcount = int.bit_count
+except AttributeError:
+    def _popcount(x):
+        return bin(x).count('1')
+
+
+class _BitmapNode(object):
+    # entries holds, in bit order, a (hash, key, value) tuple for a single
+    # key or a node for several.
+    __slots__ = ['bitmap', 'entries']
+
+    def __init__(self, bitmap, entries):
+        self.bitmap = bitmap
+        self.entries = entries
+
+
+class _CollisionNode(object):
+    # Keys whose hashes are entirely equal.
+    __slots__ = ['hash', 'entries']
+
+    def __init__(self, hash, entries):
+        self.hash = hash
+        self.entries = entries
+
+
+_EMPTY = _BitmapNode(0, ())
+
+
+def _pair(shift, a, b):
+    # A node holding the two (hash, key, value) entries a and b.
+    if a[0] == b[0] or shift >= HASH_BITS:
+        return _CollisionNode(a[0], (a, b))
+
+    a_bit = 1 << (a[0] >> shift & MASK)
+    b_bit = 1 << (b[0] >> shift & MASK)
+    if a_bit == b_bit:
+        return _BitmapNode(a_bit, (_pair(shift + BITS, a, b),))
+    if a_bit < b_bit:
+        return _BitmapNode(a_bit | b_bit, (a, b))
+    return _BitmapNode(a_bit | b_bit, (b, a))
+
+
+def _build(entries, shift):
+    # A node for a list of (hash, key, value) entries with distinct keys, all
+    # at once rather than one set at a time.
+    groups = {}
+    for entry in entries:
+        groups.setdefault(entry[0] >> shift & MASK, []).append(entry)
+
+    bitmap = 0
+    children = []
+    for index in sorted(groups):
+        group = groups[index]
+        bitmap |= 1 << index
+        if len(group) == 1:
+            children.append(group[0])
+        elif all(entry[0] == group[0][0] for entry in group):
+            children.append(_CollisionNode(group[0][0], tuple(group)))
+        else:
+            children.append(_build(group, shift + BITS))
+    return _BitmapNode(bitmap, tuple(children))
+
+
+def _get(node, h, key, default):
+    shift = 0
+    while True:
+        if type(node) is _CollisionNode:
+            for entry in node.entries:
+                if entry[1] is key or entry[1] == key:
+                    return entry[2]
+            return default
+
+        bit = 1 << (h >> shift & MASK)
+        if not node.bitmap & bit:
+            return default
+        entry = node.entries[_popcount(node.bitmap & (bit - 1))]
+        if type(entry) is tuple:
+            if entry[0] == h and (entry[1] is key or entry[1] == key):
+                return entry[2]
+            return default
+        node = entry
+        shift += BITS
+
+
+def _set(node, shift, new):
+    # Returns the node with new, a (hash, key, value) entry, in it and
+    # whether that added a key.
+    h, key, value = new
+
+    if type(node) is _CollisionNode:
+        if h != node.hash:
+            # Push the collision one level down, next to the new key.
+            node = _BitmapNode(1 << (node.hash >> shift & MASK), (node,))
+        else:
+            for i, entry in enumerate(node.entries):
+                if entry[1] is key or entry[1] == key:
+                    if entry[2] is value:
+                        return node, False
+                    return _CollisionNode(h, node.entries[:i] + (new,) +
+                                          node.entries[i + 1:]), False
+            return _CollisionNode(h, node.entries + (new,)), True
+
+    bit = 1 << (h >> shift & MASK)
+    index = _popcount(node.bitmap & (bit - 1))
+    entries = node.entries
+
+    if not node.bitmap & bit:
+        return _BitmapNode(node.bitmap | bit,
+                           entries[:index] + (new,) + entries[index:]), True
+
+    entry = entries[index]
+    if type(entry) is tuple:
+        if entry[0] == h and (entry[1] is key or entry[1] == key):
+            if entry[2] is value:
+                return node, False
+            child, added = new, False
+        else:
+            child, added = _pair(shift + BITS, entry, new), True
+    else:
+        child, added = _set(entry, shift + BITS, new)
+        if child is entry:
+            return node, False
+
+    return _BitmapNode(node.bitmap, entries[:index] + (child,) +
+                       entries[index + 1:]), added
+
+
+def _delete(node, shift, h, key):
+    # Returns node without key: node itself if key isn't there, None if
+    # nothing is left, or a lone (hash, key, value) entry for the parent to
+    # take in place of a node.
+    if type(node) is _CollisionNode:
+        for i, entry in enumerate(node.entries):
+            if entry[1] is key or entry[1] == key:
+                entries = node.entries[:i] + node.entries[i + 1:]
+                if len(entries) == 1:
+                    return entries[0]
+                return _CollisionNode(node.hash, entries)
+        return node
+
+    bit = 1 << (h >> shift & MASK)
+    if not node.bitmap & bit:
+        return node
+    index = _popcount(node.bitmap & (bit - 1))
+    entries = node.entries
+    entry = entries[index]
+
+    if type(entry) is tuple:
+        if entry[0] != h or not (entry[1] is key or entry[1] == key):
+            return node
+        child = None
+    else:
+        child = _delete(entry, shift + BITS, h, key)
+        if child is entry:
+            return node
+
+    if child is None:
+        bitmap = node.bitmap & ~bit
+        entries = entries[:index] + entries[index + 1:]
+        if not entries:
+            return None
+        if len(entries) == 1 and type(entries[0]) is tuple and shift:
+            return entries[0]
+        return _BitmapNode(bitmap, entries)
+
+    if type(child) is tuple and len(entries) == 1 and shift:
+        return child
+    return _BitmapNode(node.bitmap, entries[:index] + (child,) +
+                       entries[index + 1:])
+
+
+def _entries(node):
+    for entry in node.entries:
+        if type(entry) is tuple:
+            yield entry
+        else:
+            yield from _entries(entry)
+
+
+class PersistentMap(collections.abc.Mapping):
+    # An immutable mapping. set and delete return a new map sharing all but
+    # O(log n) of its nodes with this one, so old versions stay valid and
+    # cost little to keep.
+    __slots__ = ['_root', '_len']
+
+    def __init__(self, items=()):
+        items = dict(items)
+        self._root = _build([(_hash(key), key, value)
+                             for key, value in items.items()], 0)
+        self._len = len(items)
+
+    @classmethod
+    def _make(cls, root, length):
+        m = cls.__new__(cls)
+        m._root = root
+        m._len = length
+        return m
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        for entry in _entries(self._root):
+            yield entry[1]
+
+    def __getitem__(self, key):
+        value = _get(self._root, _hash(key), key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return _get(self._root, _hash(key), key, _MISSING) is not _MISSING
+
+    def get(self, key, default=None):
+        return _get(self._root, _hash(key), key, default)
+
+    def items(self):
+        return [(entry[1], entry[2]) for entry in _entries(self._root)]
+
+    def values(self):
+        return [entry[2] for entry in _entries(self._root)]
+
+    def set(self, key, value):
+        root, added = _set(self._root, 0, (_hash(key), key, value))
+        if root is self._root:
+            return self
+        return self._make(root, self._len + added)
+
+    def delete(self, key):
+        # Like set, but without key; raises KeyError if it isn't there.
+        root = _delete(self._root, 0, _hash(key), key)
+        if root is self._root:
+            raise KeyError(key)
+        if root is None:
+            root = _EMPTY
+        return self._make(root, self._len - 1)
+
+    def discard(self, key):
+        try:
+            return self.delete(key)
+        except KeyError:
+            return self
+
+    def __repr__(self):
+        return 'PersistentMap({!r})'.format(dict(self.items()))
+
+
+_MISSING = object()
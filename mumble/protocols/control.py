@@ -18,7 +18,7 @@ class UDPTunnelTransport(asyncio.DatagramTransport):
     def sendto(self, data, addr=None):
         assert addr is None
         self.control_protocol.send_payload(
-            self.client.PACKET_NUMBERS[Mumble_pb2.UDPTunnel], data)
+            self.control_protocol.PACKET_NUMBERS[Mumble_pb2.UDPTunnel], data)
 
 
 class Protocol(asyncio.Protocol):
@@ -170,8 +170,15 @@ class Protocol(asyncio.Protocol):
     def mumble_server_state_received(self, message):
         self.server_state = message
 
+    def mumble_server_sync_received(self, message):
+        self.server_sync = message
+        if message.HasField('max_bandwidth'):
+            self.client.control_max_bandwidth_received(message.max_bandwidth)
+
     def mumble_server_config_received(self, message):
         self.server_config = message
+        if message.HasField('max_bandwidth'):
+            self.client.control_max_bandwidth_received(message.max_bandwidth)
         self.client.connection_ready()
 
     def mumble_ping_received(self, message):
@@ -210,6 +217,27 @@ class Protocol(asyncio.Protocol):
         self.send_message(Mumble_pb2.UserState(actor=actor, session=session,
                                                channel_id=channel_id))
 
+    def send_crypt_setup(self, client_nonce=None):
+        msg = Mumble_pb2.CryptSetup()
+        if client_nonce is not None:
+            msg.client_nonce = client_nonce
+        self.send_message(msg)
+
+    def send_voice_target(self, id, sessions=(), channels=()):
+        # channels holds (channel_id, links, children, group) tuples.
+        msg = Mumble_pb2.VoiceTarget(id=id)
+
+        if sessions:
+            msg.targets.add().session.extend(sessions)
+
+        for channel_id, links, children, group in channels:
+            target = msg.targets.add(channel_id=channel_id, links=links,
+                                     children=children)
+            if group is not None:
+                target.group = group
+
+        self.send_message(msg)
+
     def request_blobs(self, session_textures, session_comments,
                       channel_descriptions):
         msg = Mumble_pb2.RequestBlob()
@@ -0,0 +1,134 @@
+import collections
+
+
+# Every frame is 10 ms of audio, which is also how far apart two consecutive
+# sequence numbers are.
+FRAME_DURATION = 0.01
+
+# How many sequence numbers before the highest one are remembered, to tell
+# duplicates and reordered packets apart.
+SEQUENCE_WINDOW = 64
+
+# A backwards jump beyond the window is taken as the speaker's sequence
+# starting over if their last packet ended the transmission or came this long
+# ago; otherwise the packet is just late.
+RESTART_IDLE = 1
+
+BITRATE_INTERVAL = 1
+
+
+Snapshot = collections.namedtuple('Snapshot', [
+    'packets', 'received', 'lost', 'late', 'duplicate', 'reordered',
+    'jitter', 'bitrate', 'bytes'])
+
+
+class SpeakerStats(object):
+    # Receive statistics for one speaker, updated for every voice packet.
+    # Counts are in frames, except packets; jitter is RFC 3550's interarrival
+    # jitter in seconds.
+
+    ACCEPT = 0
+    DUPLICATE = 1
+    LATE = 2
+
+    __slots__ = ['packets', 'received', 'late', 'duplicate', 'reordered',
+                 'jitter', 'bitrate', 'bytes', '_expected', '_base',
+                 '_highest', '_highest_end', '_seen', '_transit',
+                 '_last_arrival', '_terminated', '_rate_start', '_rate_bytes']
+
+    def __init__(self):
+        self.packets = 0
+        self.received = 0
+        self.late = 0
+        self.duplicate = 0
+        self.reordered = 0
+        self.jitter = 0.0
+        self.bitrate = 0
+        self.bytes = 0
+
+        # Frames expected from sequences before the current one.
+        self._expected = 0
+        self._base = None
+        self._highest = None
+        self._highest_end = None
+        self._seen = 0
+        self._transit = None
+        self._last_arrival = None
+        self._terminated = False
+        self._rate_start = None
+        self._rate_bytes = 0
+
+    @property
+    def lost(self):
+        if self._base is None:
+            return 0
+        return max(0, self._expected + self._highest_end - self._base -
+                   self.received)
+
+    def _restart(self, sequence_number):
+        if self._base is not None:
+            self._expected += self._highest_end - self._base
+        self._base = self._highest = self._highest_end = sequence_number
+        self._seen = 0
+        self._transit = None
+
+    def update(self, sequence_number, frames, size, now, terminated=False):
+        # Returns ACCEPT, or DUPLICATE or LATE if the packet must be dropped.
+        self.packets += 1
+
+        if self._base is None:
+            self._restart(sequence_number)
+        else:
+            diff = sequence_number - self._highest
+            if diff > 0 and self._terminated:
+                # A new talk spurt; the frames in between were never sent.
+                self._restart(sequence_number)
+            elif diff <= -SEQUENCE_WINDOW:
+                if self._terminated or \
+                   now - self._last_arrival > RESTART_IDLE:
+                    self._restart(sequence_number)
+                else:
+                    self.late += frames
+                    return self.LATE
+
+        diff = sequence_number - self._highest
+        if diff > 0 or self._seen == 0:
+            # In order, possibly after a gap.
+            self._seen = (self._seen << diff | 1) & \
+                ((1 << SEQUENCE_WINDOW) - 1) if diff < SEQUENCE_WINDOW else 1
+            self._highest = sequence_number
+            self._highest_end = max(self._highest_end,
+                                    sequence_number + frames)
+            self._terminated = terminated
+
+            transit = now - sequence_number * FRAME_DURATION
+            if self._transit is not None:
+                self.jitter += (abs(transit - self._transit) -
+                                self.jitter) / 16
+            self._transit = transit
+        elif self._seen >> -diff & 1:
+            self.duplicate += frames
+            return self.DUPLICATE
+        else:
+            self._seen |= 1 << -diff
+            self.reordered += 1
+
+        self.received += frames
+        self._last_arrival = now
+
+        self.bytes += size
+        if self._rate_start is None:
+            self._rate_start = now
+        self._rate_bytes += size
+        if now - self._rate_start >= BITRATE_INTERVAL:
+            self.bitrate = int(self._rate_bytes * 8 /
+                               (now - self._rate_start))
+            self._rate_start = now
+            self._rate_bytes = 0
+
+        return self.ACCEPT
+
+    def snapshot(self):
+        return Snapshot(self.packets, self.received, self.lost, self.late,
+                        self.duplicate, self.reordered, self.jitter,
+                        self.bitrate, self.bytes)
@@ -4,10 +4,21 @@ import enum
 import logging
 import re
 import struct
+import time
+
+from . import speakers
 
 
 logger = logging.getLogger(__name__)
 
+try:
+    from .. import crypt
+except Exception as e:
+    logger.warn('Could not load libcrypto, voice will only use the TCP '
+                'tunnel: %s', e)
+    crypt = None
+
+
 CELT_CODECS = {}
 
 try:
@@ -28,6 +39,25 @@ else:
 class Protocol(asyncio.DatagramProtocol):
     POSITION_FORMAT = struct.Struct('!fff')
     SAMPLE_RATE = 48000
+    CRYPT_RESYNC_INTERVAL = 5
+
+    # UDP pings go out every UDP_PING_INTERVAL seconds while the path is
+    # being probed and every UDP_PING_INTERVAL_CONNECTED once it is in use.
+    # A ping without a reply after UDP_PING_TIMEOUT counts as lost.
+    UDP_PING_INTERVAL = 1
+    UDP_PING_INTERVAL_CONNECTED = 5
+    UDP_PING_TIMEOUT = 3
+    # Voice moves to UDP after this many ping replies in a row, and back to
+    # the tunnel once nothing arrived over UDP for UDP_TIMEOUT seconds or
+    # more than UDP_MAX_LOSS of the last UDP_LOSS_WINDOW pings were lost.
+    UDP_REPLIES_NEEDED = 2
+    UDP_TIMEOUT = 12
+    UDP_LOSS_WINDOW = 10
+    UDP_MAX_LOSS = 0.5
+
+    # A speaker stops talking with a terminator, or when no audio arrived
+    # from them for this long.
+    TALK_TIMEOUT = 0.5
 
     class PacketType(enum.IntEnum):
         VOICE_CELT_ALPHA = 0
@@ -42,6 +72,10 @@ class Protocol(asyncio.DatagramProtocol):
 
     VoiceTarget = collections.namedtuple('VoiceTarget', ['value'])
 
+    class Path(enum.Enum):
+        TUNNEL = 'tunnel'
+        UDP = 'udp'
+
     @classmethod
     def _target_to_type(cls, target):
         try:
@@ -53,13 +87,169 @@ class Protocol(asyncio.DatagramProtocol):
         self.client = client
         self.codecs = {}
         self.outgoing_codec = None
+        self.outgoing_type = None
+
+        self.tunnel = None
+        self.udp_transport = None
+        self.crypt = crypt.CryptState() if crypt is not None else None
+
+        # Outgoing voice uses the tunnel until UDP pings are answered.
+        self.path = self.Path.TUNNEL
+        self.path_changes = 0
+        self.udp_rtt = None
+        self.udp_rtt_var = None
+        self.udp_packets_sent = 0
+        self.udp_packets_received = 0
+        self.udp_decrypt_failures = 0
+        self.udp_pings_sent = 0
+        self.udp_pings_lost = 0
+        self.tcp_packets_sent = 0
+        self.tcp_packets_received = 0
+        self.duplicate_packets = 0
+
+        self._last_good_decrypt = time.monotonic()
+        self._last_resync_request = 0
+        self._last_udp_received = 0
+        self._ping_handle = None
+        self._pending_pings = collections.OrderedDict()
+        self._ping_results = collections.deque(maxlen=self.UDP_LOSS_WINDOW)
+        self._udp_replies = 0
+        # SpeakerStats by session, which also tell duplicates apart.
+        self.speakers = {}
+        # When each talking session was last heard, oldest first.
+        self.talking = collections.OrderedDict()
+        self._talk_handle = None
+        # With decoding off, packets are only used for statistics and talk
+        # state.
+        self.decode_enabled = True
+        # An audio.metering.LoudnessMeter to feed decoded frames to.
+        self.meter = None
+        self._incoming = []
+        self._outgoing = []
+
+    def tunnel_made(self, tunnel):
+        self.tunnel = tunnel
 
     def connection_made(self, transport):
-        self.transport = transport
+        self.udp_transport = transport
+
+    def connection_lost(self, exc):
+        self.udp_transport = None
+        self._stop_pinging()
+        self._set_path(self.Path.TUNNEL)
+
+    def error_received(self, exc):
+        logger.debug('UDP error: %s', exc)
+
+    @property
+    def use_udp(self):
+        return self.path is self.Path.UDP and \
+               self.udp_transport is not None and self.crypt.is_valid()
+
+    @property
+    def udp_loss(self):
+        if not self._ping_results:
+            return None
+        return self._ping_results.count(False) / len(self._ping_results)
+
+    def _set_path(self, path):
+        if path is self.path:
+            return
+        logger.info('Voice path changed from %s to %s (rtt: %s, loss: %s)',
+                    self.path.value, path.value, self.udp_rtt, self.udp_loss)
+        self.path = path
+        self.path_changes += 1
+        self.client.voice_path_changed(path)
 
     def setup_crypt(self, key, client_nonce, server_nonce):
-        # TODO: cry a lot
-        return
+        if self.crypt is None:
+            return
+
+        if key and client_nonce and server_nonce:
+            self.crypt.set_key(key, client_nonce, server_nonce)
+            self._last_good_decrypt = time.monotonic()
+            self._set_path(self.Path.TUNNEL)
+            self._start_pinging()
+        elif server_nonce:
+            # Our request for a resync was answered.
+            self.crypt.set_decrypt_iv(server_nonce)
+        elif self.crypt.is_valid():
+            # The server is asking for our nonce instead.
+            self.client.voice_crypt_nonce_requested(
+                bytes(self.crypt.encrypt_iv))
+
+    def send_udp_ping(self):
+        if self.udp_transport is None or not self.crypt.is_valid():
+            return
+
+        timestamp = int(time.monotonic() * 1000000)
+        data = bytes([self.PacketType.PING << 5]) + \
+            self._encode_varint(timestamp)
+        self.udp_transport.sendto(self.crypt.encrypt(data))
+        self.udp_packets_sent += 1
+        self.udp_pings_sent += 1
+        self._pending_pings[timestamp] = None
+
+    def _start_pinging(self):
+        self._stop_pinging()
+        self._pending_pings.clear()
+        self._ping_results.clear()
+        self._udp_replies = 0
+        self._last_udp_received = time.monotonic()
+        self._ping()
+
+    def _stop_pinging(self):
+        if self._ping_handle is not None:
+            self._ping_handle.cancel()
+            self._ping_handle = None
+
+    def _ping(self):
+        now = time.monotonic()
+
+        while self._pending_pings:
+            timestamp = next(iter(self._pending_pings))
+            if now - timestamp / 1000000 < self.UDP_PING_TIMEOUT:
+                break
+            del self._pending_pings[timestamp]
+            self.udp_pings_lost += 1
+            self._ping_results.append(False)
+            self._udp_replies = 0
+
+        if self.path is self.Path.UDP:
+            loss = self.udp_loss
+            if now - self._last_udp_received > self.UDP_TIMEOUT or \
+               (len(self._ping_results) == self.UDP_LOSS_WINDOW and
+                    loss > self.UDP_MAX_LOSS):
+                self._set_path(self.Path.TUNNEL)
+
+        self.send_udp_ping()
+
+        interval = self.UDP_PING_INTERVAL_CONNECTED \
+            if self.path is self.Path.UDP else self.UDP_PING_INTERVAL
+        self._ping_handle = self.client.loop.call_later(interval, self._ping)
+
+    def _udp_ping_received(self, timestamp):
+        try:
+            del self._pending_pings[timestamp]
+        except KeyError:
+            # Already counted as lost, or not one of ours.
+            return
+
+        # Smoothed the same way as TCP's round trip time estimate.
+        rtt = time.monotonic() - timestamp / 1000000
+        if self.udp_rtt is None:
+            self.udp_rtt = rtt
+            self.udp_rtt_var = rtt / 2
+        else:
+            self.udp_rtt_var += (abs(self.udp_rtt - rtt) -
+                                 self.udp_rtt_var) / 4
+            self.udp_rtt += (rtt - self.udp_rtt) / 8
+
+        self._ping_results.append(True)
+        self._udp_replies += 1
+        if self._udp_replies >= self.UDP_REPLIES_NEEDED and \
+           self.udp_loss <= self.UDP_MAX_LOSS:
+            self._set_path(self.Path.UDP)
 
     def setup_codecs(self, alpha, beta, prefer_alpha, opus):
         if alpha:
@@ -85,91 +275,252 @@ class Protocol(asyncio.DatagramProtocol):
         if opus:
             raise Exception('opus not supported yet')
         else:
+            if prefer_alpha:
+                type = self.PacketType.VOICE_CELT_ALPHA
+            else:
+                type = self.PacketType.VOICE_CELT_BETA
+
             try:
-                if prefer_alpha:
-                    self.outgoing_codec = self.codecs[
-                        self.PacketType.VOICE_CELT_ALPHA]
-                else:
-                    self.outgoing_codec = self.codecs[
-                        self.PacketType.VOICE_CELT_BETA]
+                self.outgoing_codec = self.codecs[type]
             except KeyError:
                 logger.warn('Could not configure outgoing CELT codec (version: '
                             '%s)', 'alpha' if prefer_alpha else 'beta')
+            else:
+                self.outgoing_type = type
 
     def datagram_received(self, data, addr):
-        pass
+        # Datagrams are decrypted together once the loop gets round to it.
+        self._incoming.append(data)
+        if len(self._incoming) == 1:
+            self.client.loop.call_soon(self._flush_incoming)
 
-    def plaintext_data_received(self, data):
+    def _flush_incoming(self):
+        datagrams, self._incoming = self._incoming, []
+        self.datagrams_received(datagrams)
+
+    def datagrams_received(self, datagrams):
+        if self.crypt is not None:
+            plains = self.crypt.decrypt_batch(datagrams)
+        else:
+            plains = [None] * len(datagrams)
+
+        for plain in plains:
+            if plain is None:
+                self.udp_decrypt_failures += 1
+                now = time.monotonic()
+                if now - self._last_good_decrypt > \
+                   self.CRYPT_RESYNC_INTERVAL and \
+                   now - self._last_resync_request > \
+                   self.CRYPT_RESYNC_INTERVAL:
+                    self._last_resync_request = now
+                    self.client.voice_crypt_resync_needed()
+                continue
+
+            self._last_good_decrypt = self._last_udp_received = \
+                time.monotonic()
+            self.udp_packets_received += 1
+            self.plaintext_data_received(plain, udp=True)
+
+    def plaintext_data_received(self, data, udp=False):
         header, payload = data[0], data[1:]
 
         type = self.PacketType(header >> 5)
         target = self._target_to_type(header & 0b11111)
 
+        if not udp:
+            self.tcp_packets_received += 1
+
         if type == self.PacketType.PING:
             ts, _ = self._decode_varint(payload)
             logger.debug('<-- type: %s\ntime: %d', type, ts)
-            self.send_voice_data(type, target, payload)
-            return
-
-        if type not in self.codecs:
-            logger.debug('No codec for voice type: %s', type)
+            if udp:
+                # Over UDP this can only be our own ping coming back.
+                self._udp_ping_received(ts)
+            else:
+                self.send_voice_data(type, target, payload)
             return
 
         session, payload = self._decode_varint(payload)
         sequence_number, payload = self._decode_varint(payload)
+        size = len(payload)
 
-        # TODO: handle sequence number
-
+        frames = []
+        terminated = False
         more_frames = True
-        while more_frames:
+        while more_frames and payload:
             if type == self.PacketType.VOICE_OPUS:
                 audio_header, payload = self._decode_varint(payload)
                 length = audio_header & 0b1111111111111
                 terminated = audio_header >> 13 == 1
                 more_frames = False
-                frame, payload = payload[:length], payload[length:]
             else:
                 audio_header, payload = payload[0], payload[1:]
                 length = audio_header & 0b1111111
                 terminated = length == 0
                 more_frames = audio_header >> 7 == 1
-                frame, payload = payload[:length], payload[length:]
+            frame, payload = payload[:length], payload[length:]
+            frames.append(frame)
 
-            logger.debug('<-- type: %s\nsession: %d\nlength: %s\n'
-                         'terminated: %r\nmore_frames: %r\nframe: %d bytes',
-                         type, session, length, terminated, more_frames,
-                         len(frame))
+        logger.debug('<-- type: %s\nsession: %d\nsequence: %d\nframes: %d\n'
+                     'terminated: %r', type, session, sequence_number,
+                     len(frames), terminated)
+
+        try:
+            stats = self.speakers[session]
+        except KeyError:
+            stats = self.speakers[session] = speakers.SpeakerStats()
+        verdict = stats.update(sequence_number, len(frames), size,
+                               time.monotonic(), terminated)
+        if verdict != stats.ACCEPT:
+            if verdict == stats.DUPLICATE:
+                self.duplicate_packets += 1
+            return
+
+        self._update_talking(session, any(frames), terminated)
+
+        if not self.decode_enabled:
+            return
+
+        if type not in self.codecs:
+            logger.debug('No codec for voice type: %s', type)
+            return
 
+        for frame in frames:
             if frame:
                 pcm = self.codecs[type].decoder.decode(frame)
+                if self.meter is not None:
+                    self.meter.add(session, pcm)
                 self.client.voice_packet_received(session, target, pcm)
 
+    def _update_talking(self, session, audio, terminated):
+        if audio:
+            if session in self.talking:
+                self.talking.move_to_end(session)
+                self.talking[session] = time.monotonic()
+            else:
+                self.talking[session] = time.monotonic()
+                self.client.voice_talking_started(session)
+                if self._talk_handle is None:
+                    self._schedule_talk_timeout()
+
+        if terminated and session in self.talking:
+            del self.talking[session]
+            self.client.voice_talking_stopped(session)
+
+    def _schedule_talk_timeout(self):
+        # One timer for everyone, due when the longest quiet speaker times
+        # out.
+        if not self.talking:
+            self._talk_handle = None
+            return
+        last = next(iter(self.talking.values()))
+        self._talk_handle = self.client.loop.call_later(
+            max(0, last + self.TALK_TIMEOUT - time.monotonic()),
+            self._talk_timeout)
+
+    def _talk_timeout(self):
+        now = time.monotonic()
+        while self.talking:
+            session, last = next(iter(self.talking.items()))
+            if now - last < self.TALK_TIMEOUT:
+                break
+            del self.talking[session]
+            self.client.voice_talking_stopped(session)
+        self._schedule_talk_timeout()
+
+    def forget_session(self, session):
+        self.speakers.pop(session, None)
+        self.talking.pop(session, None)
+        if self.meter is not None:
+            self.meter.remove(session)
+
+    def speaker_stats(self):
+        return {session: stats.snapshot()
+                for session, stats in self.speakers.items()}
+
+    def speaker_totals(self):
+        # The same counters summed over every speaker, with the worst jitter.
+        snapshots = [stats.snapshot() for stats in self.speakers.values()]
+        if not snapshots:
+            return speakers.Snapshot(*[0] * len(speakers.Snapshot._fields))
+        totals = [sum(values) for values in zip(*snapshots)]
+        totals[speakers.Snapshot._fields.index('jitter')] = \
+            max(snapshot.jitter for snapshot in snapshots)
+        return speakers.Snapshot(*totals)
+
     def _decode_varint(self, payload):
-        if payload[0] & 0b10000000 == 0:
-            return payload[0] & 0b01111111, payload[1:]
-        elif payload[0] & 0b01000000 == 0:
-            return (payload[0] & 0b00111111 << 8) | payload[1], payload[2:]
-        elif payload[0] & 0b00100000 == 0:
-            return (payload[0] & 0b00011111 << 16) | (payload[1] << 8) | \
-                   payload[2], payload[3:]
-        elif payload[0] & 0b00010000 == 0:
-            return (payload[0] & 0b00001111 << 24) | (payload[1] << 16) | \
-                   (payload[2] << 8) | payload[3], payload[4:]
-        elif payload[0] & 0b00001100 == 0:
-            return (payload[1] << 16) | (payload[2] << 16) | \
-                   (payload[3] << 8) | (payload[4]), payload[5:]
-        elif payload[0] & 0b00001100 == 1:
-            return (payload[1] << 56) | (payload[2] << 48) | \
-                   (payload[3] << 40) | (payload[4] << 32) | \
-                   (payload[5] << 24) | (payload[6] << 16) | \
-                   (payload[7] << 8) |  payload[8], payload[9:]
-        elif payload[0] & 0b00001100 == 2:
+        v = payload[0]
+        if v & 0b10000000 == 0:
+            return v & 0b01111111, payload[1:]
+        elif v & 0b11000000 == 0b10000000:
+            return (v & 0b00111111) << 8 | payload[1], payload[2:]
+        elif v & 0b11100000 == 0b11000000:
+            return (v & 0b00011111) << 16 | payload[1] << 8 | payload[2], \
+                payload[3:]
+        elif v & 0b11110000 == 0b11100000:
+            return (v & 0b00001111) << 24 | payload[1] << 16 | \
+                payload[2] << 8 | payload[3], payload[4:]
+        elif v & 0b11111100 == 0b11110000:
+            return int.from_bytes(payload[1:5], 'big'), payload[5:]
+        elif v & 0b11111100 == 0b11110100:
+            return int.from_bytes(payload[1:9], 'big'), payload[9:]
+        elif v & 0b11111100 == 0b11111000:
             val, payload = self._decode_varint(payload[1:])
             return -val, payload
-        elif payload[0] & 0b00001100 == 2:
-            return -(payload[0] & 0b00000011), payload[1:]
+        else:
+            return ~(v & 0b00000011), payload[1:]
+
+    def _encode_varint(self, value):
+        if value < 0:
+            if value >= -4:
+                return bytes([0b11111100 | ~value])
+            return b'\xf8' + self._encode_varint(-value)
+        elif value < 0x80:
+            return bytes([value])
+        elif value < 0x4000:
+            return bytes([0b10000000 | value >> 8, value & 0xff])
+        elif value < 0x200000:
+            return bytes([0b11000000 | value >> 16, value >> 8 & 0xff,
+                          value & 0xff])
+        elif value < 0x10000000:
+            return bytes([0b11100000 | value >> 24, value >> 16 & 0xff,
+                          value >> 8 & 0xff, value & 0xff])
+        elif value < 0x100000000:
+            return b'\xf0' + value.to_bytes(4, 'big')
+        else:
+            return b'\xf4' + value.to_bytes(8, 'big')
 
     def send_voice_data(self, type, target, payload):
         logger.debug('--> type: %s\ntarget: %s\npayload: %d bytes',
                      type, target, len(payload))
-        self.transport.sendto(bytes([type.value << 5 | target.value]) + payload)
+        data = bytes([type.value << 5 | target.value]) + payload
+
+        if self.use_udp:
+            # Everything sent during one pass of the loop, usually a whole
+            # pacing tick, is encrypted together.
+            self._outgoing.append(data)
+            if len(self._outgoing) == 1:
+                self.client.loop.call_soon(self._flush_outgoing)
+        else:
+            self.tunnel.sendto(data)
+            self.tcp_packets_sent += 1
+
+    def _flush_outgoing(self):
+        datagrams, self._outgoing = self._outgoing, []
+
+        if self.udp_transport is None:
+            # UDP went away in the meantime.
+            for data in datagrams:
+                self.tunnel.sendto(data)
+            self.tcp_packets_sent += len(datagrams)
+            return
+
+        encrypted = self.crypt.encrypt_batch(datagrams)
+        try:
+            sendto_many = self.udp_transport.sendto_many
+        except AttributeError:
+            for data in encrypted:
+                self.udp_transport.sendto(data)
+        else:
+            sendto_many(encrypted)
+        self.udp_packets_sent += len(datagrams)
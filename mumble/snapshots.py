@@ -0,0 +1,194 @@
+import collections
+
+from . import entities
+from .persistent import PersistentMap
+
+
+# Users and channels as they were when a snapshot was taken.
+UserRecord = collections.namedtuple(
+    'UserRecord', ['session'] + list(entities.User.FIELDS))
+ChannelRecord = collections.namedtuple(
+    'ChannelRecord', ['id'] + list(entities.Channel.FIELDS))
+
+
+def user_record(user):
+    return UserRecord(user.session,
+                      *[getattr(user, k) for k in entities.User.FIELDS])
+
+
+def channel_record(channel):
+    values = [getattr(channel, k) for k in entities.Channel.FIELDS]
+    record = ChannelRecord(channel.id, *values)
+    if record.link_ids is not None:
+        record = record._replace(link_ids=tuple(record.link_ids))
+    return record
+
+
+class Snapshot(object):
+    # An immutable view of a client's users, channels and indexes, safe to
+    # read from any thread:
+    #
+    #   users:          session -> UserRecord
+    #   users_by_name:  name -> UserRecord
+    #   channels:       channel id -> ChannelRecord
+    #   channel_users:  channel id -> {session: UserRecord}
+    #   children:       channel id -> subchannel ids in display order
+    #
+    # All of them are PersistentMaps. version counts the changes to the
+    # client's state up to the snapshot.
+    __slots__ = ['version', 'users', 'users_by_name', 'channels',
+                 'channel_users', 'children']
+
+    def __init__(self, version, users, users_by_name, channels,
+                 channel_users, children):
+        self.version = version
+        self.users = users
+        self.users_by_name = users_by_name
+        self.channels = channels
+        self.channel_users = channel_users
+        self.children = children
+
+    def get_root_channel(self):
+        return self.channels[0]
+
+    def get_children(self, channel_id):
+        return [self.channels[child_id]
+                for child_id in self.children.get(channel_id, ())]
+
+    def get_users(self, channel_id):
+        return self.channel_users.get(channel_id, PersistentMap()).values()
+
+    def channel_at(self, path):
+        if isinstance(path, str):
+            path = [name for name in path.split('/') if name]
+        channel = self.get_root_channel()
+        for name in path:
+            for child in self.get_children(channel.id):
+                if child.name == name:
+                    channel = child
+                    break
+            else:
+                return None
+        return channel
+
+
+class SnapshotBuilder(object):
+    # Takes snapshots of a client. Between snapshots only the sessions and
+    # channel ids that changed are noted; a snapshot applies those to the
+    # previous one, so it costs as much as there were changes.
+
+    # Past this share of changed users or channels, building the maps from
+    # scratch is cheaper than changing them one entry at a time.
+    REBUILD_RATIO = 0.25
+
+    def __init__(self, client):
+        self.client = client
+        self.version = 0
+
+        self._users = set()
+        self._channels = set()
+        empty = PersistentMap()
+        self._last = Snapshot(0, empty, empty, empty, empty, empty)
+
+    def user_changed(self, session):
+        self._users.add(session)
+        self.version += 1
+
+    def channel_changed(self, channel_id):
+        self._channels.add(channel_id)
+        self.version += 1
+
+    def snapshot(self):
+        last = self._last
+        if last.version == self.version:
+            return last
+
+        if len(self._users) > len(last.users) * self.REBUILD_RATIO or \
+           len(self._channels) > len(last.channels) * self.REBUILD_RATIO:
+            snapshot = self._rebuild()
+        else:
+            snapshot = self._apply(last)
+
+        self._users.clear()
+        self._channels.clear()
+        self._last = snapshot
+        return snapshot
+
+    def _rebuild(self):
+        tree = self.client.channel_tree
+        channels = {channel_id: channel_record(channel)
+                    for channel_id, channel in self.client.channels.items()}
+        children = {}
+        for parent_id in [None] + list(channels):
+            child_ids = tuple(tree.children(parent_id))
+            if child_ids:
+                children[parent_id] = child_ids
+
+        users = {}
+        users_by_name = {}
+        channel_users = {}
+        for session, user in self.client.users.items():
+            record = users[session] = user_record(user)
+            users_by_name[record.name] = record
+            channel_users.setdefault(record.channel_id, {})[session] = record
+
+        return Snapshot(self.version, PersistentMap(users),
+                        PersistentMap(users_by_name), PersistentMap(channels),
+                        PersistentMap((channel_id, PersistentMap(members))
+                                      for channel_id, members in
+                                      channel_users.items()),
+                        PersistentMap(children))
+
+    def _apply(self, last):
+        channels = last.channels
+        children = last.children
+        tree = self.client.channel_tree
+        parents = set()
+        for channel_id in self._channels:
+            old = channels.get(channel_id)
+            if old is not None:
+                parents.add(old.parent_id)
+
+            channel = self.client.channels.get(channel_id)
+            if channel is None:
+                channels = channels.discard(channel_id)
+                children = children.discard(channel_id)
+            else:
+                channels = channels.set(channel_id, channel_record(channel))
+                parents.add(channel.parent_id)
+
+        for parent_id in parents:
+            child_ids = tuple(tree.children(parent_id))
+            if child_ids:
+                children = children.set(parent_id, child_ids)
+            else:
+                children = children.discard(parent_id)
+
+        users = last.users
+        users_by_name = last.users_by_name
+        channel_users = last.channel_users
+        for session in self._users:
+            old = users.get(session)
+            if old is not None:
+                members = channel_users[old.channel_id].delete(session)
+                if members:
+                    channel_users = channel_users.set(old.channel_id, members)
+                else:
+                    channel_users = channel_users.delete(old.channel_id)
+                if users_by_name.get(old.name) is old:
+                    users_by_name = users_by_name.delete(old.name)
+
+            user = self.client.users.get(session)
+            if user is None:
+                users = users.discard(session)
+            else:
+                record = user_record(user)
+                users = users.set(session, record)
+                users_by_name = users_by_name.set(record.name, record)
+                channel_users = channel_users.set(
+                    record.channel_id,
+                    channel_users.get(record.channel_id,
+                                      PersistentMap()).set(session, record))
+
+        return Snapshot(self.version, users, users_by_name, channels,
+                        channel_users, children)
@@ -0,0 +1,98 @@
+import collections
+
+from . import entities
+
+
+# A channel as a voice target: its users, optionally also those in linked
+# channels and subchannels, and optionally only members of group.
+ChannelTarget = collections.namedtuple(
+    'ChannelTarget', ['channel', 'links', 'children', 'group'])
+ChannelTarget.__new__.__defaults__ = (False, False, None)
+
+
+ROOT_CHANNEL_ID = 0
+
+
+def audience_key(audience):
+    # Reduces users, channels, ChannelTargets and group names to a hashable
+    # (sessions, channels) pair, where channels are (channel_id, links,
+    # children, group) tuples. Equal audiences give equal keys regardless of
+    # order.
+    sessions = set()
+    channels = set()
+
+    for member in audience:
+        if isinstance(member, entities.User):
+            sessions.add(member.session)
+        elif isinstance(member, entities.Channel):
+            channels.add((member.id, False, False, None))
+        elif isinstance(member, ChannelTarget):
+            channel_id = getattr(member.channel, 'id', member.channel)
+            channels.add((channel_id, bool(member.links),
+                          bool(member.children), member.group))
+        elif isinstance(member, str):
+            # A group anywhere on the server.
+            channels.add((ROOT_CHANNEL_ID, False, True, member))
+        else:
+            raise TypeError('cannot target {!r}'.format(member))
+
+    if not sessions and not channels:
+        raise ValueError('empty voice target')
+
+    return tuple(sorted(sessions)), tuple(sorted(
+        channels, key=lambda c: (c[0], c[1], c[2], c[3] or '')))
+
+
+class VoiceTargets(object):
+    # Hands out the server's voice target slots. Each distinct audience is
+    # registered once and keeps its slot until it is the least recently used
+    # one when a new audience needs room.
+    FIRST_SLOT = 1
+    LAST_SLOT = 30
+
+    def __init__(self, register):
+        # register(slot, sessions, channels) sends the definition.
+        self.register = register
+        self._slots = collections.OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._slots)
+
+    def clear(self):
+        self._slots.clear()
+
+    def get(self, audience, busy=()):
+        # Returns the slot for audience, registering it if needed without
+        # taking over a slot in busy.
+        key = audience_key(audience)
+
+        try:
+            slot = self._slots[key]
+        except KeyError:
+            pass
+        else:
+            self._slots.move_to_end(key)
+            self.hits += 1
+            return slot
+
+        self.misses += 1
+        capacity = self.LAST_SLOT - self.FIRST_SLOT + 1
+        if len(self._slots) < capacity:
+            slot = self.FIRST_SLOT + len(self._slots)
+        else:
+            for old_key, slot in self._slots.items():
+                if slot not in busy:
+                    break
+            else:
+                raise RuntimeError('every voice target slot is in use')
+            del self._slots[old_key]
+            self.evictions += 1
+
+        sessions, channels = key
+        self.register(slot, sessions, channels)
+        self._slots[key] = slot
+        return slot
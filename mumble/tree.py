@@ -0,0 +1,197 @@
+import bisect
+
+
+def sort_key(channel):
+    # Siblings are shown by position, then name.
+    return (channel.position or 0, channel.name or '', channel.id)
+
+
+class ChannelTree(object):
+    # Keeps every channel's subchannels in display order, updated as channel
+    # states come in, so that listing children costs as much as there are
+    # children rather than as much as there are channels.
+    #
+    # It also keeps aggregates over each channel's subtree: how many users
+    # are in it, how many of them are talking and how many levels of
+    # subchannels it has. A change only updates the channels on the way up
+    # to the root, and every channel's aggregates can be read directly.
+
+    def __init__(self):
+        # parent id -> sorted sort keys, and the channel ids in the same
+        # order. The root channel's parent is None.
+        self._keys = {}
+        self._ids = {}
+        # channel id -> (parent id, sort key)
+        self._entries = {}
+        # (parent id, name) -> channel id, for looking up paths. Mumble keeps
+        # the names of siblings unique.
+        self._named = {}
+
+        # channel id -> aggregate over the channel and everything below it.
+        # Counts for channels that aren't known yet are kept too, and passed
+        # up once the channel turns up.
+        self._users = {}
+        self._talking = {}
+        self._heights = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, channel_id):
+        return channel_id in self._entries
+
+    def parent(self, channel_id):
+        return self._entries[channel_id][0]
+
+    def child_named(self, channel_id, name):
+        return self._named.get((channel_id, name))
+
+    def find(self, names, channel_id):
+        # Follows names down from channel_id; None if one isn't there.
+        for name in names:
+            channel_id = self._named.get((channel_id, name))
+            if channel_id is None:
+                return None
+        return channel_id
+
+    def path(self, channel_id):
+        # The names from below the root down to channel_id.
+        names = []
+        parent_id, key = self._entries[channel_id]
+        while parent_id is not None:
+            names.append(key[1])
+            parent_id, key = self._entries[parent_id]
+        names.reverse()
+        return names
+
+    def children(self, channel_id):
+        # The ids of channel_id's subchannels in display order. Don't modify
+        # the list.
+        return self._ids.get(channel_id, ())
+
+    def update(self, channel):
+        # Adds channel, or moves it if its parent, position or name changed.
+        entry = (channel.parent_id, sort_key(channel))
+        old = self._entries.get(channel.id)
+        if old == entry:
+            return
+        moved = old is None or old[0] != entry[0]
+        if old is not None:
+            if moved:
+                self._add_subtree(channel.id, old[0], -1)
+            self._unlink(channel.id, *old)
+
+        parent_id, key = entry
+        keys = self._keys.setdefault(parent_id, [])
+        index = bisect.bisect_left(keys, key)
+        keys.insert(index, key)
+        self._ids.setdefault(parent_id, []).insert(index, channel.id)
+        self._entries[channel.id] = entry
+        self._named.setdefault((parent_id, key[1]), channel.id)
+
+        if moved:
+            if old is None:
+                self._heights[channel.id] = self._height_below(channel.id)
+            else:
+                self._update_heights(old[0])
+            self._add_subtree(channel.id, parent_id, 1)
+            self._update_heights(parent_id)
+
+    def remove(self, channel_id):
+        entry = self._entries.pop(channel_id, None)
+        if entry is not None:
+            parent_id = entry[0]
+            self._add_subtree(channel_id, parent_id, -1)
+            self._unlink(channel_id, *entry)
+            self._update_heights(parent_id)
+        self._users.pop(channel_id, None)
+        self._talking.pop(channel_id, None)
+        self._heights.pop(channel_id, None)
+
+    def _unlink(self, channel_id, parent_id, key):
+        keys = self._keys[parent_id]
+        index = bisect.bisect_left(keys, key)
+        del keys[index]
+        del self._ids[parent_id][index]
+        if self._named.get((parent_id, key[1])) == channel_id:
+            del self._named[parent_id, key[1]]
+        if not keys:
+            del self._keys[parent_id]
+            del self._ids[parent_id]
+
+    def walk(self, channel_id):
+        # Yields channel_id and everything below it, depth first in display
+        # order.
+        stack = [channel_id]
+        while stack:
+            channel_id = stack.pop()
+            yield channel_id
+            stack.extend(reversed(self.children(channel_id)))
+
+    def _add(self, counts, channel_id, delta):
+        # Adds delta to channel_id and everything above it.
+        while channel_id is not None:
+            count = counts.get(channel_id, 0) + delta
+            if count:
+                counts[channel_id] = count
+            else:
+                del counts[channel_id]
+            entry = self._entries.get(channel_id)
+            if entry is None:
+                break
+            channel_id = entry[0]
+
+    def _add_subtree(self, channel_id, parent_id, sign):
+        # Adds or takes channel_id's aggregates to or from parent_id's path.
+        users = self._users.get(channel_id, 0)
+        if users:
+            self._add(self._users, parent_id, sign * users)
+        talking = self._talking.get(channel_id, 0)
+        if talking:
+            self._add(self._talking, parent_id, sign * talking)
+
+    def _height_below(self, channel_id):
+        children = self._ids.get(channel_id)
+        if not children:
+            return 0
+        heights = self._heights
+        return 1 + max(heights.get(child, 0) for child in children)
+
+    def _update_heights(self, channel_id):
+        # Recomputes heights upwards from channel_id until one stays the
+        # same.
+        while channel_id is not None:
+            height = self._height_below(channel_id)
+            if self._heights.get(channel_id) == height:
+                break
+            self._heights[channel_id] = height
+            entry = self._entries.get(channel_id)
+            if entry is None:
+                break
+            channel_id = entry[0]
+
+    def user_moved(self, old_channel_id, new_channel_id, talking=False):
+        # A user joined new_channel_id or left old_channel_id, either of
+        # which may be None.
+        if old_channel_id is not None:
+            self._add(self._users, old_channel_id, -1)
+            if talking:
+                self._add(self._talking, old_channel_id, -1)
+        if new_channel_id is not None:
+            self._add(self._users, new_channel_id, 1)
+            if talking:
+                self._add(self._talking, new_channel_id, 1)
+
+    def talking_changed(self, channel_id, talking):
+        self._add(self._talking, channel_id, 1 if talking else -1)
+
+    def user_count(self, channel_id):
+        # Users in channel_id and all of its subchannels.
+        return self._users.get(channel_id, 0)
+
+    def talking_count(self, channel_id):
+        return self._talking.get(channel_id, 0)
+
+    def height(self, channel_id):
+        # Levels of subchannels below channel_id; 0 without any.
+        return self._heights.get(channel_id, 0)
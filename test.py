@@ -31,7 +31,7 @@ if __name__ == '__main__':
         return asyncio.run_coroutine_threadsafe(coro, c.loop).result()
 
     def run_console():
-        locals = {'self': c, 'do': do}
+        locals = {'self': c, 'do': do, 'snapshot': c.snapshot_threadsafe}
 
         try:
             from IPython.terminal import embed
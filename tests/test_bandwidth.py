@@ -0,0 +1,107 @@
+import asyncio
+
+from mumble.audio import bandwidth
+from mumble.audio import clips
+from mumble.protocols import voice
+
+from .test_clips import StubCodec, write_pcm
+from .test_sender import make_sender
+
+
+def test_network_bandwidth_matches_mumble():
+    assert bandwidth.network_bandwidth(40000, 2) == 40000 + 37 * 400
+    assert bandwidth.network_bandwidth(40000, 2, tcp=True) == \
+        40000 + 49 * 400
+    assert bandwidth.network_bandwidth(40000, 1, positional=True) == \
+        40000 + 48 * 800
+
+
+def test_fit():
+    assert bandwidth.fit(None, 40000, 2) == (40000, 2)
+    assert bandwidth.fit(72000, 40000, 1) == (40000, 1)
+    # Bigger packets first, then a lower bitrate.
+    assert bandwidth.fit(64000, 60000, 1) == (49000, 2)
+    assert bandwidth.fit(32000, 40000, 2) == (24000, 4)
+    assert bandwidth.fit(32000, 40000, 2, tcp=True) == (21000, 4)
+    assert bandwidth.fit(1000, 40000, 2) == (8000, 4)
+
+
+class StubSender(object):
+    bitrate = 40000
+    frames_per_packet = 2
+
+
+class StubProtocol(object):
+    Path = voice.Protocol.Path
+
+    def __init__(self):
+        self.path = self.Path.UDP
+        self.udp_loss = None
+        self.udp_rtt = None
+
+
+def test_controller_follows_limit_path_and_network():
+    loop = asyncio.new_event_loop()
+    sender, protocol = StubSender(), StubProtocol()
+    controller = bandwidth.BandwidthController(loop, sender, protocol)
+
+    controller.set_max_bandwidth(48000)
+    assert (sender.bitrate, sender.frames_per_packet) == (40000, 4)
+
+    protocol.path = protocol.Path.TUNNEL
+    controller._check()
+    assert (sender.bitrate, sender.frames_per_packet) == (37000, 4)
+
+    protocol.path = protocol.Path.UDP
+    protocol.udp_loss = 0.2
+    controller._check()
+    controller._check()
+    assert controller.backoffs == 2
+    assert controller.limit == 27000
+    assert (sender.bitrate, sender.frames_per_packet) == (19000, 4)
+
+    protocol.udp_loss = 0.0
+    for _ in range(10):
+        controller._check()
+    assert controller.scale == 1.0
+    assert (sender.bitrate, sender.frames_per_packet) == (40000, 4)
+
+    controller.set_max_bandwidth(0)
+    assert (sender.bitrate, sender.frames_per_packet) == (40000, 2)
+
+    controller.stop()
+    loop.close()
+
+
+def test_limit_change_during_clip_sticks(tmp_path):
+    source = str(tmp_path / 'sound.raw')
+    write_pcm(source, 8)
+    cache = clips.ClipCache(str(tmp_path / 'cache'))
+    clip = asyncio.run(cache.get(source, StubCodec(), 8000, 2))
+
+    s, transport = make_sender(frames_per_packet=1)
+    s.protocol.outgoing_codec.bitstream_version = StubCodec.bitstream_version
+    controller = bandwidth.BandwidthController(None, s, s.protocol)
+
+    async def run():
+        task = asyncio.ensure_future(s.play_clip(clip))
+        await asyncio.sleep(0)
+        assert s.packet_duration == 0.02
+
+        controller.set_max_bandwidth(32000)
+        assert s.frames_per_packet == 4
+        # Packets already queued keep their own pacing.
+        assert s.packet_duration == 0.02
+
+        while not task.done():
+            s.pace(1)
+            await asyncio.sleep(0)
+        await task
+
+    asyncio.run(run())
+    clip.close()
+
+    assert len(transport.sent) == 5
+    # The clip ending doesn't undo what the controller fitted.
+    assert (s.bitrate, s.frames_per_packet) == (21000, 4)
+    assert s.packet_duration == 0.04
@@ -0,0 +1,198 @@
+import asyncio
+import os
+import time
+
+from mumble import Mumble_pb2
+from mumble import blobs
+from mumble import client
+from mumble import entities
+
+from .test_entities import StubClient, loop, user_state
+
+
+def test_round_trip_and_sharing(tmp_path):
+    cache = blobs.BlobCache(str(tmp_path))
+    texture = b'\x89PNG' + bytes(100)
+
+    assert cache.get(blobs.blob_hash(texture)) is None
+    assert cache.put(blobs.blob_hash(texture), texture)
+    assert cache.get(blobs.blob_hash(texture)) == texture
+
+    # Text is stored as UTF-8, and another process sees it too.
+    assert cache.put(blobs.blob_hash('héllo'), 'héllo')
+    other = blobs.BlobCache(str(tmp_path))
+    assert other.get(blobs.blob_hash('héllo')) == 'héllo'.encode('utf-8')
+
+    assert (cache.hits, cache.misses, cache.stores) == (1, 1, 2)
+    assert [name for name in os.listdir(str(tmp_path))
+            if not name.endswith(cache.SUFFIX)] == []
+
+
+def test_blobs_must_match_their_hash(tmp_path):
+    cache = blobs.BlobCache(str(tmp_path))
+
+    assert not cache.put(blobs.blob_hash(b'old'), b'new')
+    assert cache.get(blobs.blob_hash(b'old')) is None
+
+    # A damaged file is thrown away.
+    cache.put(blobs.blob_hash(b'data'), b'data')
+    with open(cache._path(blobs.blob_hash(b'data')), 'wb') as f:
+        f.write(b'dat')
+    assert cache.get(blobs.blob_hash(b'data')) is None
+    assert not os.path.exists(cache._path(blobs.blob_hash(b'data')))
+
+
+def test_least_recently_used_blobs_are_evicted(tmp_path):
+    cache = blobs.BlobCache(str(tmp_path), max_size=250)
+    data = [bytes([i]) * 100 for i in range(3)]
+
+    now = time.time()
+    for i, blob in enumerate(data[:2]):
+        cache.put(blobs.blob_hash(blob), blob)
+        os.utime(cache._path(blobs.blob_hash(blob)), (now - 10 + i,) * 2)
+    # Using the first one makes the second the oldest.
+    assert cache.get(blobs.blob_hash(data[0])) == data[0]
+
+    cache.put(blobs.blob_hash(data[2]), data[2])
+    assert cache.evictions == 1
+    assert cache.get(blobs.blob_hash(data[1])) is None
+    assert cache.get(blobs.blob_hash(data[0])) == data[0]
+    assert cache.get(blobs.blob_hash(data[2])) == data[2]
+
+
+def test_entities_use_the_cache_before_the_network(tmp_path, loop):
+    async def go():
+        cache = blobs.BlobCache(str(tmp_path))
+        comment = 'A long comment ' * 20
+
+        first = entities.User(StubClient(cache), 1)
+        first.update_from_state(user_state(
+            comment_hash=blobs.blob_hash(comment)))
+        task = loop.create_task(first.get_comment())
+        await asyncio.sleep(0)
+        assert len(first.client.requests) == 1
+        first.update_from_state(user_state(comment=comment))
+        assert await task == comment
+
+        # A later connection finds it on disk.
+        second = entities.User(StubClient(cache), 1)
+        second.update_from_state(user_state(
+            comment_hash=blobs.blob_hash(comment)))
+        assert await second.get_comment() == comment
+        assert second.client.requests == []
+
+        channel = entities.Channel(StubClient(cache), 0)
+        state = Mumble_pb2.ChannelState()
+        state.description_hash = blobs.blob_hash('Welcome')
+        channel.update_from_state(state)
+        state = Mumble_pb2.ChannelState()
+        state.description = 'Welcome'
+        channel.update_from_state(state)
+        assert cache.get(blobs.blob_hash('Welcome')) == b'Welcome'
+
+    loop.run_until_complete(go())
+
+
+class StubControlProtocol(object):
+    def __init__(self):
+        self.messages = []
+
+    def request_blobs(self, session_textures, session_comments,
+                      channel_descriptions):
+        self.messages.append((session_textures, session_comments,
+                              channel_descriptions))
+
+
+def make_client(loop, users):
+    c = client.Client()
+    c.control_protocol = StubControlProtocol()
+    c.blob_scheduler = blobs.BlobRequestScheduler(loop, c._send_blob_request)
+
+    state = Mumble_pb2.ChannelState()
+    state.channel_id = 0
+    state.name = 'Root'
+    state.description_hash = blobs.blob_hash('Welcome')
+    c.control_channel_state_received(state)
+    for session in range(1, users + 1):
+        c.control_user_state_received(user_state(
+            name=str(session), session=session,
+            comment_hash=blobs.blob_hash(str(session))))
+    return c
+
+
+def test_concurrent_requests_share_messages(loop):
+    async def go():
+        c = make_client(loop, 300)
+        users = list(c.users.values())
+
+        gathered = asyncio.gather(
+            c.get_root_channel().get_description(),
+            *[user.get_comment() for user in users + users[:10]])
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+
+        messages = c.control_protocol.messages
+        assert [len(comments) + len(descriptions)
+                for _, comments, descriptions in messages] == [128, 128, 45]
+        assert sorted(s for _, comments, _ in messages for s in comments) \
+            == list(range(1, 301))
+        assert [d for _, _, descriptions in messages for d in descriptions] \
+            == [0]
+        assert c.blob_scheduler.in_flight == 301
+
+        # Asking again while the answers are on their way sends nothing.
+        again = loop.create_task(users[0].get_comment())
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        assert len(messages) == 3
+        assert c.blob_scheduler.deduplicated == 11
+
+        for user in users:
+            c.control_user_state_received(user_state(
+                session=user.session, comment=str(user.session)))
+        state = Mumble_pb2.ChannelState()
+        state.channel_id = 0
+        state.description = 'Welcome'
+        c.control_channel_state_received(state)
+
+        results = await gathered
+        assert results[0] == 'Welcome'
+        assert results[1:] == [str(u.session) for u in users + users[:10]]
+        assert await again == '1'
+
+        scheduler = c.blob_scheduler
+        assert (scheduler.requests, scheduler.messages,
+                scheduler.received_blobs, scheduler.in_flight) == \
+            (312, 3, 301, 0)
+        assert scheduler.mean_latency >= 0
+        assert scheduler.max_latency >= scheduler.mean_latency
+
+    loop.run_until_complete(go())
+
+
+def test_unanswered_requests_are_sent_again_after_a_timeout(loop):
+    async def go():
+        c = make_client(loop, 2)
+        scheduler = c.blob_scheduler
+        user = c.users[1]
+
+        scheduler.request('comment', user)
+        scheduler.flush()
+        scheduler.request('comment', user)
+        scheduler.flush()
+        assert len(c.control_protocol.messages) == 1
+
+        scheduler._in_flight['comment', user] -= scheduler.TIMEOUT
+        scheduler.request('comment', user)
+        scheduler.flush()
+        assert len(c.control_protocol.messages) == 2
+
+        # Users that leave are forgotten.
+        scheduler.request('texture', c.users[2])
+        scheduler.forget(c.users[2])
+        scheduler.forget(user)
+        scheduler.flush()
+        assert len(c.control_protocol.messages) == 2
+        assert scheduler.in_flight == 0
+
+    loop.run_until_complete(go())
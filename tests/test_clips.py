@@ -0,0 +1,120 @@
+import asyncio
+import os
+import threading
+import time
+
+from mumble.audio import clips
+
+from .test_sender import make_sender
+
+
+class StubEncoder(object):
+    frame_size = 480
+    channels = 1
+
+    threads = set()
+
+    def __init__(self, rate, channels=1):
+        self.rate = rate
+        self.calls = 0
+
+    def encode(self, pcm, size):
+        self.threads.add(threading.get_ident())
+        self.calls += 1
+        return bytes([self.calls]) * size
+
+
+class StubCodec(object):
+    bitstream_version = 0x8000000b
+
+    def __init__(self):
+        self.encoder = StubEncoder(48000)
+
+
+def write_pcm(path, frames):
+    with open(path, 'wb') as f:
+        f.write(bytes(960 * frames))
+
+
+def test_clip_round_trip(tmp_path):
+    source = str(tmp_path / 'sound.raw')
+    write_pcm(source, 5)
+
+    cache = clips.ClipCache(str(tmp_path / 'cache'))
+    clip = asyncio.run(cache.get(source, StubCodec(), 8000, 2))
+    packets = [(bytes(body), count) for body, count in clip.packets()]
+    clip.close()
+
+    assert packets == [
+        (bytes([0x80 | 10]) + b'\x01' * 10 + bytes([10]) + b'\x02' * 10, 2),
+        (bytes([0x80 | 10]) + b'\x03' * 10 + bytes([10]) + b'\x04' * 10, 2),
+        (bytes([0x80 | 10]) + b'\x05' * 10 + b'\x00', 2),
+    ]
+    assert (cache.hits, cache.misses) == (0, 1)
+    # Encoding stays off the event loop's thread.
+    assert threading.get_ident() not in StubEncoder.threads
+
+    asyncio.run(cache.get(source, StubCodec(), 8000, 2)).close()
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # A different packing is a different cache entry.
+    asyncio.run(cache.get(source, StubCodec(), 8000, 4)).close()
+    assert cache.misses == 2
+
+
+def test_eviction_drops_least_recently_used(tmp_path):
+    cache = clips.ClipCache(str(tmp_path / 'cache'))
+
+    sources = []
+    for i in range(3):
+        source = str(tmp_path / '{}.raw'.format(i))
+        write_pcm(source, 10 * (i + 1))
+        sources.append(source)
+        asyncio.run(cache.get(source, StubCodec(), 8000, 2)).close()
+
+    paths = sorted(os.listdir(cache.directory))
+    sizes = sum(os.path.getsize(os.path.join(cache.directory, p))
+                for p in paths)
+    assert len(paths) == 3
+
+    # Touch the first clip so the second one is the oldest.
+    past = time.time() - 100
+    for i, source in enumerate(sources):
+        path = cache._cache_path(source, StubCodec.bitstream_version, 8000, 2)
+        os.utime(path, (past + i, past + i))
+    os.utime(cache._cache_path(sources[0], StubCodec.bitstream_version,
+                               8000, 2))
+
+    cache.max_size = sizes - 1
+    cache.evict()
+
+    assert os.path.exists(cache._cache_path(
+        sources[0], StubCodec.bitstream_version, 8000, 2))
+    assert not os.path.exists(cache._cache_path(
+        sources[1], StubCodec.bitstream_version, 8000, 2))
+    assert cache.evictions == 1
+
+
+def test_play_clip_sends_fresh_sequence_numbers(tmp_path):
+    source = str(tmp_path / 'sound.raw')
+    write_pcm(source, 4)
+    cache = clips.ClipCache(str(tmp_path / 'cache'))
+    clip = asyncio.run(cache.get(source, StubCodec(), 8000, 2))
+
+    s, transport = make_sender()
+    s.protocol.outgoing_codec.bitstream_version = StubCodec.bitstream_version
+    s.sequence = 200
+
+    async def run():
+        task = asyncio.ensure_future(s.play_clip(clip))
+        while not task.done():
+            s.pace(1)
+            await asyncio.sleep(0)
+        await task
+
+    asyncio.run(run())
+    clip.close()
+
+    assert [data[1:3] for data in transport.sent] == [
+        b'\x80\xc8', b'\x80\xca', b'\x80\xcc']
+    assert s.sequence == 205
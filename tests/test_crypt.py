@@ -0,0 +1,225 @@
+import asyncio
+
+import pytest
+
+from mumble.protocols import voice
+
+crypt = pytest.importorskip('mumble.crypt')
+
+KEY = bytes(range(16))
+
+
+def make_pair():
+    client, server = crypt.CryptState(), crypt.CryptState()
+    client_nonce, server_nonce = bytes([1] * 16), bytes([5] * 16)
+    client.set_key(KEY, client_nonce, server_nonce)
+    server.set_key(KEY, server_nonce, client_nonce)
+    return client, server
+
+
+def test_ocb2_test_vectors():
+    aes = crypt.AES(KEY)
+
+    _, tag = crypt.ocb_encrypt(aes, b'', KEY)
+    assert tag.hex() == 'bf3108130773ad5ec70ec69e7875a7b0'
+
+    encrypted, tag = crypt.ocb_encrypt(aes, bytes(range(40)), KEY)
+    assert tag.hex() == '9db0cdf880f73e3e10d4eb3217766688'
+    assert encrypted.hex() == (
+        'f75d6bc8b4dc8d66b836a2b08b32a6369f1cd3c5228d79fd6c267f5f6aa7b231'
+        'c7dfb9d59951ae9c')
+
+
+@pytest.mark.parametrize('length', [0, 1, 15, 16, 17, 32, 33, 100])
+def test_ocb2_round_trip(length):
+    aes = crypt.AES(KEY)
+    plain = bytes(range(length))
+    encrypted, tag = crypt.ocb_encrypt(aes, plain, KEY)
+    assert crypt.ocb_decrypt(aes, encrypted, KEY) == (plain, tag)
+
+
+def test_replay_late_and_lost_accounting():
+    client, server = make_pair()
+    packets = [client.encrypt(bytes([i % 256]) * 30) for i in range(310)]
+
+    for i, packet in enumerate(packets[:300]):
+        assert server.decrypt(packet) == bytes([i % 256]) * 30
+
+    # Replays are rejected.
+    assert server.decrypt(packets[10]) is None
+    assert server.decrypt(packets[299]) is None
+
+    assert server.decrypt(packets[305]) is not None
+    assert server.decrypt(packets[302]) is not None
+    assert server.decrypt(packets[302]) is None
+
+    assert (server.good, server.late, server.lost) == (302, 1, 4)
+
+
+def test_tampered_packet_is_rejected():
+    client, server = make_pair()
+    packet = bytearray(client.encrypt(b'hello'))
+    packet[-1] ^= 1
+    assert server.decrypt(bytes(packet)) is None
+
+    # The nonce is not consumed by a forged packet.
+    assert server.decrypt(client.encrypt(b'again')) == b'again'
+
+
+@pytest.mark.parametrize('lengths', [
+    [0] * 8,
+    [1, 15, 16, 17, 32, 33, 100, 0, 5, 500],
+])
+def test_batches_match_single_packets(lengths):
+    aes = crypt.AES(KEY)
+    plains = [bytes(range(length % 256)) * (length // 256 + 1)
+              for length in lengths]
+    plains = [plain[:length] for plain, length in zip(plains, lengths)]
+    nonces = [bytes([i]) * 16 for i in range(len(plains))]
+
+    encrypted = crypt.ocb_encrypt_batch(aes, plains, nonces)
+    assert encrypted == [crypt.ocb_encrypt(aes, plain, nonce)
+                         for plain, nonce in zip(plains, nonces)]
+    assert crypt.ocb_decrypt_batch(
+        aes, [data for data, _ in encrypted], nonces) == \
+        [(plain, tag) for plain, (_, tag) in zip(plains, encrypted)]
+
+
+def test_decrypt_batch_accounting_matches_decrypt():
+    client, server = make_pair()
+    _, reference = make_pair()
+    packets = [client.encrypt(bytes([i % 256]) * 30) for i in range(40)]
+
+    forged = bytearray(packets[20])
+    forged[-1] ^= 1
+    batch = packets[:15] + [packets[3], packets[30]] + packets[15:20] + \
+        [bytes(forged)] + packets[20:30] + [packets[30], b'ab']
+
+    assert server.decrypt_batch(batch) == \
+        [reference.decrypt(data) for data in batch]
+    assert (server.good, server.late, server.lost) == \
+        (reference.good, reference.late, reference.lost)
+    assert server.decrypt_iv == reference.decrypt_iv
+    assert server.decrypt_history == reference.decrypt_history
+
+
+def test_decrypt_batch_with_many_forged_packets():
+    client, server = make_pair()
+    _, reference = make_pair()
+    batch = []
+    for i in range(1500):
+        data = client.encrypt(bytes([i % 256]) * 10)
+        forged = bytearray(data)
+        forged[-1] ^= 1
+        batch += [bytes(forged), data]
+
+    assert server.decrypt_batch(batch) == \
+        [reference.decrypt(data) for data in batch]
+    assert server.good == 1500
+    assert server.decrypt_iv == reference.decrypt_iv
+
+
+def test_encrypt_batch_matches_encrypt():
+    client, server = make_pair()
+    _, reference = make_pair()
+    plains = [bytes([i]) * i for i in range(20)]
+
+    assert server.encrypt_batch(plains) == \
+        [reference.encrypt(plain) for plain in plains]
+
+
+class StubTransport(object):
+    def __init__(self):
+        self.sent = []
+
+    def sendto(self, data, addr=None):
+        self.sent.append(data)
+
+
+class StubClient(object):
+    def __init__(self, loop):
+        self.loop = loop
+        self.resyncs = 0
+        self.paths = []
+
+    def voice_crypt_resync_needed(self):
+        self.resyncs += 1
+
+    def voice_path_changed(self, path):
+        self.paths.append(path)
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+def make_protocol(loop):
+    protocol = voice.Protocol(StubClient(loop))
+    tunnel, udp = StubTransport(), StubTransport()
+    protocol.tunnel_made(tunnel)
+    protocol.connection_made(udp)
+
+    protocol.setup_crypt(KEY, bytes([1] * 16), bytes([5] * 16))
+    server = crypt.CryptState()
+    server.set_key(KEY, bytes([5] * 16), bytes([1] * 16))
+    return protocol, server, tunnel, udp
+
+
+def echo_ping(protocol, server, udp):
+    ping = server.decrypt(udp.sent.pop())
+    assert ping[0] == protocol.PacketType.PING << 5
+    protocol.datagrams_received([server.encrypt(ping)])
+
+
+def test_voice_switches_to_udp_once_pings_are_answered(loop):
+    protocol, server, tunnel, udp = make_protocol(loop)
+
+    # Voice stays in the tunnel until enough pings came back over UDP.
+    protocol.send_voice_data(protocol.PacketType.VOICE_CELT_ALPHA,
+                             protocol.Target.NORMAL, b'\x00\x00')
+    assert tunnel.sent == [b'\x00\x00\x00']
+
+    echo_ping(protocol, server, udp)
+    assert not protocol.use_udp
+    assert protocol.udp_rtt is not None
+
+    protocol._ping()
+    echo_ping(protocol, server, udp)
+    assert protocol.use_udp
+    assert protocol.client.paths == [protocol.Path.UDP]
+    assert protocol.path_changes == 1
+    assert protocol.udp_loss == 0
+
+    protocol.send_voice_data(protocol.PacketType.VOICE_CELT_ALPHA,
+                             protocol.Target.NORMAL, b'\x01\x00')
+    assert not udp.sent
+    protocol._flush_outgoing()
+    assert server.decrypt(udp.sent.pop()) == b'\x00\x01\x00'
+
+
+def test_voice_falls_back_to_the_tunnel_when_udp_goes_quiet(loop):
+    protocol, server, tunnel, udp = make_protocol(loop)
+    echo_ping(protocol, server, udp)
+    protocol._ping()
+    echo_ping(protocol, server, udp)
+    assert protocol.use_udp
+
+    # A single unanswered ping is not enough to give up on UDP.
+    protocol._ping()
+    for timestamp in list(protocol._pending_pings):
+        protocol._pending_pings[timestamp - 10 ** 7] = \
+            protocol._pending_pings.pop(timestamp)
+    protocol._ping()
+    assert protocol.use_udp
+    assert protocol.udp_pings_lost == 1
+
+    protocol._last_udp_received -= protocol.UDP_TIMEOUT
+    protocol._ping()
+    assert not protocol.use_udp
+    assert protocol.client.paths == [protocol.Path.UDP, protocol.Path.TUNNEL]
+
+    protocol.connection_lost(None)
+    assert protocol._ping_handle is None
@@ -0,0 +1,183 @@
+import asyncio
+
+import pytest
+
+from mumble import Mumble_pb2
+from mumble import entities
+
+
+class StubClient(object):
+    def __init__(self, blob_cache=None):
+        self.requests = []
+        self.blob_cache = blob_cache
+
+    def request_blobs(self, **kwargs):
+        self.requests.append(kwargs)
+
+    def blob_received(self, entity, name):
+        pass
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+def user_state(**fields):
+    state = Mumble_pb2.UserState()
+    state.session = 1
+    for name, value in fields.items():
+        setattr(state, name, value)
+    return state
+
+
+def test_entities_have_no_dict():
+    user = entities.User(StubClient(), 1)
+    channel = entities.Channel(StubClient(), 0)
+
+    for entity in [user, channel]:
+        assert not hasattr(entity, '__dict__')
+        with pytest.raises(AttributeError):
+            entity.nickname = 'x'
+
+
+def test_fields_are_updated_only_when_present():
+    channel = entities.Channel(StubClient(), 3)
+    assert channel.name is None and channel.link_ids is None
+
+    state = Mumble_pb2.ChannelState()
+    state.channel_id = 3
+    state.name = 'Lobby'
+    state.links.extend([1, 2])
+    channel.update_from_state(state)
+    assert channel.name == 'Lobby'
+    assert channel.link_ids == [1, 2]
+
+    state = Mumble_pb2.ChannelState()
+    state.channel_id = 3
+    state.position = 5
+    channel.update_from_state(state)
+    assert channel.name == 'Lobby'
+    assert channel.position == 5
+
+
+def test_blob_bookkeeping_is_only_allocated_when_used(loop):
+    async def go():
+        user = entities.User(StubClient(), 1)
+        user.update_from_state(user_state(name='alice', channel_id=2))
+        assert user._comment_blob is None and user._texture_blob is None
+
+        # Without a hash there is no comment to fetch.
+        assert await user.get_comment() is None
+        assert user.client.requests == []
+        assert user._comment_blob is None and user._texture_blob is None
+
+    loop.run_until_complete(go())
+
+
+def test_inline_blob(loop):
+    async def go():
+        user = entities.User(StubClient(), 1)
+        user.update_from_state(user_state(comment='hello'))
+        assert await user.get_comment() == 'hello'
+
+        user.update_from_state(user_state(comment='bye'))
+        assert await user.get_comment() == 'bye'
+        assert user.client.requests == []
+
+    loop.run_until_complete(go())
+
+
+def test_hashed_blob_is_requested_and_delivered(loop):
+    async def go():
+        user = entities.User(StubClient(), 1)
+        user.update_from_state(user_state(comment_hash=b'1' * 20))
+
+        task = loop.create_task(user.get_comment())
+        await asyncio.sleep(0)
+        assert user.client.requests == [
+            {'comment_for_users': [user]}]
+        assert not task.done()
+
+        user.update_from_state(user_state(comment='long comment'))
+        assert await task == 'long comment'
+
+    loop.run_until_complete(go())
+
+
+def test_new_hash_cancels_pending_request(loop):
+    async def go():
+        user = entities.User(StubClient(), 1)
+        user.update_from_state(user_state(texture_hash=b'1' * 20))
+        task = loop.create_task(user.get_texture())
+        await asyncio.sleep(0)
+
+        # The same hash again changes nothing.
+        user.update_from_state(user_state(texture_hash=b'1' * 20))
+        await asyncio.sleep(0)
+        assert not task.done()
+
+        user.update_from_state(user_state(texture_hash=b'2' * 20))
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+        task = loop.create_task(user.get_texture())
+        await asyncio.sleep(0)
+        assert len(user.client.requests) == 2
+        user.update_from_state(user_state(texture=b'\x89PNG'))
+        assert await task == b'\x89PNG'
+
+    loop.run_until_complete(go())
+
+
+def test_blob_and_hash_in_one_message(loop):
+    async def go():
+        user = entities.User(StubClient(), 1)
+        user.update_from_state(user_state(comment_hash=b'1' * 20))
+
+        # comment comes before comment_hash in the message, but the new hash
+        # must not cancel the comment that came with it.
+        user.update_from_state(user_state(comment='new',
+                                          comment_hash=b'2' * 20))
+        assert await user.get_comment() == 'new'
+        assert user.client.requests == []
+
+    loop.run_until_complete(go())
+
+
+def test_each_class_gets_its_own_update_function():
+    user = entities.User(StubClient(), 1)
+    user.update_from_state(user_state(name='alice', self_mute=True))
+    channel = entities.Channel(StubClient(), 1)
+    state = Mumble_pb2.ChannelState()
+    state.name = 'Lobby'
+    channel.update_from_state(state)
+
+    assert (user.name, user.self_mute, user.channel_id) == ('alice', True, 0)
+    assert (channel.name, channel.link_ids) == ('Lobby', [])
+    assert entities._update_functions[entities.User] is not \
+        entities._update_functions[entities.Channel]
+
+
+def test_waiters_only_exist_while_someone_waits(loop):
+    async def go():
+        user = entities.User(StubClient(), 1)
+        user.update_from_state(user_state(comment='inline',
+                                          texture_hash=b'1' * 20))
+        assert user._comment_blob.waiter is None
+        assert user._texture_blob.waiter is None
+        assert await user.get_comment() == 'inline'
+        assert user._comment_blob.waiter is None
+
+        task = loop.create_task(user.get_texture())
+        await asyncio.sleep(0)
+        assert user._texture_blob.waiter is not None
+        user.update_from_state(user_state(texture=b'data'))
+        assert await task == b'data'
+        assert user._texture_blob.waiter is None
+        assert await user.get_texture() == b'data'
+        assert len(user.client.requests) == 1
+
+    loop.run_until_complete(go())
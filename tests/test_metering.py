@@ -0,0 +1,65 @@
+import asyncio
+import struct
+
+import pytest
+
+numpy = pytest.importorskip('numpy')
+
+from mumble.audio import metering
+
+
+def pcm(samples):
+    return struct.pack('<{}h'.format(len(samples)), *samples)
+
+
+@pytest.fixture
+def meter():
+    loop = asyncio.new_event_loop()
+    yield metering.LoudnessMeter(loop)
+    loop.close()
+
+
+def test_rms_and_peak_per_speaker(meter):
+    meter.add(1, pcm([16384, -16384] * 240))
+    meter.add(2, pcm([0] * 479 + [-32768]))
+    meter.add(1, pcm([0] * 480))
+    meter.update(0.05)
+
+    assert meter.sessions == [1, 2]
+    assert meter.level(1)[meter.RMS] == pytest.approx(0.5 / 2 ** 0.5)
+    assert meter.level(1)[meter.PEAK] == pytest.approx(0.5)
+    assert meter.level(2)[meter.PEAK] == pytest.approx(1.0)
+    assert meter.level(2)[meter.RMS] == pytest.approx((1 / 480) ** 0.5)
+    assert meter.frames_metered == 3
+
+
+def test_level_attacks_fast_and_releases_slowly(meter):
+    meter.add(1, pcm([16384] * 480))
+    meter.update(0.05)
+    attacked = meter.level(1)[meter.LEVEL]
+    assert 0.4 < attacked < 0.5
+
+    meter.update(0.05)
+    assert meter.level(1)[meter.RMS] == 0
+    assert 0.3 < meter.level(1)[meter.LEVEL] < attacked
+
+
+def test_removing_keeps_rows_packed(meter):
+    for session in [1, 2, 3]:
+        meter.add(session, pcm([session * 1000] * 480))
+    meter.remove(1)
+    meter.update(0.05)
+
+    assert meter.sessions == [3, 2]
+    assert meter.index == {3: 0, 2: 1}
+    assert meter.levels[:, meter.PEAK] * metering.FULL_SCALE == \
+        pytest.approx([3000, 2000])
+
+
+def test_many_speakers_grow_the_array(meter):
+    for session in range(100):
+        meter.add(session, pcm([session] * 480))
+    meter.update(0.05)
+    assert meter.levels.shape == (100, 3)
+    assert meter.level(99)[meter.PEAK] * metering.FULL_SCALE == \
+        pytest.approx(99)
@@ -0,0 +1,98 @@
+import asyncio
+import socket
+
+import pytest
+
+mmsg = pytest.importorskip('mumble.mmsg')
+
+
+class BatchProtocol(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.batches = []
+        self.lost = None
+
+    def datagrams_received(self, datagrams):
+        self.batches.append(datagrams)
+
+    def connection_lost(self, exc):
+        self.lost = exc
+
+
+class SingleProtocol(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.received = []
+
+    def datagram_received(self, data, addr):
+        self.received.append((data, addr))
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture
+def peer():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    sock.settimeout(5)
+    yield sock
+    sock.close()
+
+
+async def wait_for(predicate):
+    for _ in range(500):
+        if predicate():
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError('timed out')
+
+
+def test_batches_in_both_directions(loop, peer):
+    async def run():
+        transport, protocol = await mmsg.create_datagram_endpoint(
+            loop, BatchProtocol, peer.getsockname(), batch_size=4)
+        await asyncio.sleep(0)
+
+        # Nothing reads until the loop runs again, so these queue up.
+        for i in range(10):
+            peer.sendto(bytes([i]) * (i + 1), transport.get_extra_info(
+                'sockname'))
+        await wait_for(lambda: sum(map(len, protocol.batches)) == 10)
+
+        assert [d for batch in protocol.batches for d in batch] == \
+            [bytes([i]) * (i + 1) for i in range(10)]
+        assert max(map(len, protocol.batches)) == 4
+        assert transport.recv_calls < 10
+
+        transport.sendto_many([b'a', b'bb', b'ccc', b'dddd', b'e'])
+        assert [peer.recv(100) for _ in range(5)] == \
+            [b'a', b'bb', b'ccc', b'dddd', b'e']
+        assert transport.send_calls == 2
+
+        transport.close()
+        await asyncio.sleep(0)
+        assert protocol.lost is None
+        assert transport.get_extra_info('socket').fileno() == -1
+
+    loop.run_until_complete(run())
+
+
+def test_single_datagram_protocols_still_work(loop, peer):
+    async def run():
+        transport, protocol = await mmsg.create_datagram_endpoint(
+            loop, SingleProtocol, peer.getsockname())
+        await asyncio.sleep(0)
+
+        peer.sendto(b'hello', transport.get_extra_info('sockname'))
+        await wait_for(lambda: protocol.received)
+        assert protocol.received == [(b'hello', peer.getsockname())]
+
+        transport.sendto(b'world')
+        assert peer.recv(100) == b'world'
+        transport.close()
+        await asyncio.sleep(0)
+
+    loop.run_until_complete(run())
@@ -0,0 +1,92 @@
+import random
+
+import pytest
+
+from mumble.persistent import PersistentMap
+
+
+class Key(object):
+    # A key with a chosen hash, to force collisions.
+    def __init__(self, value, hash):
+        self.value = value
+        self.hash = hash
+
+    def __hash__(self):
+        return self.hash
+
+    def __eq__(self, other):
+        return isinstance(other, Key) and other.value == self.value
+
+    def __repr__(self):
+        return 'Key({})'.format(self.value)
+
+
+def test_basic_operations():
+    m = PersistentMap({'a': 1})
+    m2 = m.set('b', 2)
+
+    assert dict(m.items()) == {'a': 1}
+    assert dict(m2.items()) == {'a': 1, 'b': 2}
+    assert m2['b'] == 2 and 'b' not in m
+    assert m2.get('c') is None and len(m2) == 2
+    assert m.set('a', 1) is m
+    assert m2.discard('c') is m2
+
+    m3 = m2.delete('a')
+    assert dict(m3.items()) == {'b': 2}
+    with pytest.raises(KeyError):
+        m3['a']
+    with pytest.raises(KeyError):
+        m3.delete('a')
+    assert len(m3.delete('b')) == 0
+
+
+@pytest.mark.parametrize('collide', [False, True])
+def test_matches_a_dict_and_keeps_old_versions(collide):
+    random.seed(4)
+    if collide:
+        keys = [Key(i, random.choice([i, i % 5, -1, 1 << 62 | i % 3]))
+                for i in range(200)]
+    else:
+        keys = list(range(-300, 3000, 11))
+
+    m = PersistentMap()
+    d = {}
+    versions = []
+    for step in range(4000):
+        key = random.choice(keys)
+        if random.random() < 0.6:
+            value = random.random()
+            m = m.set(key, value)
+            d[key] = value
+        elif key in d:
+            m = m.delete(key)
+            del d[key]
+        else:
+            assert m.discard(key) is m
+
+        if step % 400 == 0:
+            versions.append((m, dict(d)))
+
+    for version, expected in versions + [(m, d)]:
+        assert len(version) == len(expected)
+        assert dict(version.items()) == expected
+        assert set(version) == set(expected)
+        for key in keys:
+            assert version.get(key, 'missing') == expected.get(key, 'missing')
+
+
+def test_built_maps_equal_incrementally_built_ones():
+    random.seed(5)
+    keys = [Key(i, random.choice([i, i % 5, -1])) for i in range(100)] + \
+        list(range(1000))
+    items = {key: random.random() for key in keys}
+
+    built = PersistentMap(items)
+    assert len(built) == len(items)
+    assert dict(built.items()) == items
+
+    m = built
+    for key in keys[::2]:
+        m = m.delete(key)
+    assert dict(m.items()) == {key: items[key] for key in keys[1::2]}
@@ -0,0 +1,184 @@
+import asyncio
+
+import pytest
+
+from mumble.audio import pacing
+from mumble.audio import sender
+from mumble.protocols import voice
+
+
+class StubEncoder(object):
+    frame_size = 480
+    channels = 1
+
+    def __init__(self):
+        self.calls = 0
+
+    def encode_into(self, pcm, size, out, offset=0):
+        assert len(memoryview(pcm).cast('B')) <= self.frame_size * 2
+        self.calls += 1
+        out[offset:offset + size] = bytes([self.calls]) * size
+        return size
+
+
+class StubCodec(object):
+    def __init__(self):
+        self.encoder = StubEncoder()
+
+
+class StubScheduler(object):
+    def __init__(self):
+        self.streams = set()
+
+    def add_stream(self, stream):
+        self.streams.add(stream)
+
+    def remove_stream(self, stream):
+        self.streams.discard(stream)
+
+    def __contains__(self, stream):
+        return stream in self.streams
+
+
+class StubTransport(object):
+    def __init__(self):
+        self.sent = []
+
+    def sendto(self, data, addr=None):
+        self.sent.append(data)
+
+
+def make_sender(**kwargs):
+    protocol = voice.Protocol(None)
+    protocol.outgoing_codec = StubCodec()
+    protocol.outgoing_type = protocol.PacketType.VOICE_CELT_ALPHA
+    transport = StubTransport()
+    protocol.tunnel_made(transport)
+    return sender.VoiceSender(protocol, StubScheduler(), **kwargs), transport
+
+
+def drain(s):
+    while s._queue:
+        s.pace(1)
+
+
+VARINTS = [
+    (0, '00'),
+    (0x7f, '7f'),
+    (0x80, '8080'),
+    (0x3fff, 'bfff'),
+    (0x4000, 'c04000'),
+    (0x200000, 'e0200000'),
+    (0x10000000, 'f010000000'),
+    (0x100000000, 'f40000000100000000'),
+    (-1, 'fc'),
+    (-4, 'ff'),
+    (-5, 'f805'),
+]
+
+
+@pytest.mark.parametrize('value, encoded', VARINTS)
+def test_encode_varint(value, encoded):
+    assert voice.Protocol(None)._encode_varint(value).hex() == encoded
+
+
+@pytest.mark.parametrize('value, encoded', VARINTS)
+def test_decode_varint(value, encoded):
+    assert voice.Protocol(None)._decode_varint(
+        bytes.fromhex(encoded) + b'rest') == (value, b'rest')
+
+
+def test_packets_are_framed_with_continuation_bits():
+    s, transport = make_sender(bitrate=8000, frames_per_packet=2)
+    assert s.feed(bytes(960 * 4)) == 2
+    drain(s)
+
+    # header, sequence, then (more | length) + frame for each frame
+    assert transport.sent == [
+        bytes([0x00, 0, 0x80 | 10]) + b'\x01' * 10 + bytes([10]) +
+        b'\x02' * 10,
+        bytes([0x00, 2, 0x80 | 10]) + b'\x03' * 10 + bytes([10]) +
+        b'\x04' * 10,
+    ]
+    assert s.sequence == 4
+
+
+def test_flush_pads_partial_frame_and_terminates():
+    s, transport = make_sender(bitrate=8000, frames_per_packet=4)
+    s.feed(bytes(960 + 100))
+    s.flush()
+    drain(s)
+
+    assert transport.sent == [
+        bytes([0x00, 0, 0x80 | 10]) + b'\x01' * 10 + bytes([0x80 | 10]) +
+        b'\x02' * 10 + b'\x00',
+    ]
+    # Two audio frames plus the terminator.
+    assert s.sequence == 3
+
+
+def test_lone_terminator():
+    s, transport = make_sender()
+    s.flush()
+    drain(s)
+
+    assert transport.sent == [b'\x00\x00\x00']
+    assert s.sequence == 1
+
+
+def test_send_pcm_rejects_invalid_target():
+    s, transport = make_sender()
+
+    with pytest.raises(ValueError):
+        asyncio.run(s.send_pcm(bytes(960), target=32))
+    assert not s._queue
+
+
+def test_send_pcm_accepts_int_target():
+    s, transport = make_sender()
+    assert s._check_target(5) == voice.Protocol.VoiceTarget(5)
+    assert s._check_target(31) is voice.Protocol.Target.SERVER_LOOPBACK
+
+
+def test_idle_stream_leaves_schedule():
+    s, transport = make_sender()
+    s.feed(bytes(960 * 2))
+    assert s.pace(1)
+
+    ticks = 1
+    while s.pace(1):
+        ticks += 1
+    assert ticks == s.MAX_IDLE_TICKS
+    assert s.underruns == 1
+
+
+class FailingTransport(object):
+    def sendto(self, data, addr=None):
+        raise OSError('unreachable')
+
+
+def test_send_pcm_raises_pacing_errors():
+    async def run():
+        s, transport = make_sender()
+        s.scheduler = pacing.PacingScheduler(asyncio.get_event_loop())
+        s.protocol.tunnel_made(FailingTransport())
+        await asyncio.wait_for(s.send_pcm(bytes(960 * 20)), 2)
+
+    with pytest.raises(OSError):
+        asyncio.run(run())
+
+
+def test_cancelled_send_pcm_drops_queue():
+    async def run():
+        s, transport = make_sender()
+        s.scheduler = pacing.PacingScheduler(asyncio.get_event_loop())
+        task = asyncio.ensure_future(s.send_pcm(bytes(960 * 200)))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await asyncio.wait_for(task, 2)
+        return s
+
+    s = asyncio.run(run())
+    assert not s._queue
+    assert s not in s.scheduler
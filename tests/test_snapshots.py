@@ -0,0 +1,110 @@
+import asyncio
+import threading
+
+import pytest
+
+from mumble import Mumble_pb2
+from mumble import client
+
+
+class StubVoiceProtocol(object):
+    def forget_session(self, session):
+        pass
+
+
+def channel_state(channel_id, **fields):
+    state = Mumble_pb2.ChannelState()
+    state.channel_id = channel_id
+    for name, value in fields.items():
+        setattr(state, name, value)
+    return state
+
+
+def user_state(session, **fields):
+    state = Mumble_pb2.UserState()
+    state.session = session
+    for name, value in fields.items():
+        setattr(state, name, value)
+    return state
+
+
+def make_client():
+    c = client.Client()
+    c.voice_protocol = StubVoiceProtocol()
+    for state in [channel_state(0, name='Root'),
+                  channel_state(1, parent=0, name='Games', position=1),
+                  channel_state(2, parent=0, name='AFK'),
+                  channel_state(3, parent=1, name='CS')]:
+        c.control_channel_state_received(state)
+    for session, channel_id in [(1, 0), (2, 1), (3, 3)]:
+        c.control_user_state_received(user_state(
+            session, name='user{}'.format(session), channel_id=channel_id))
+    return c
+
+
+def assert_matches(snapshot, c):
+    assert set(snapshot.users) == set(c.users)
+    for session, user in c.users.items():
+        assert snapshot.users[session].name == user.name
+        assert snapshot.users[session].channel_id == user.channel_id
+        assert snapshot.users_by_name[user.name].session == session
+    assert len(snapshot.users_by_name) == len(c.users_by_name)
+
+    assert set(snapshot.channels) == set(c.channels)
+    for channel_id, channel in c.channels.items():
+        assert [r.id for r in snapshot.get_children(channel_id)] == \
+            [ch.id for ch in channel.get_children()]
+        assert sorted(r.session for r in snapshot.get_users(channel_id)) == \
+            sorted(u.session for u in channel.get_users())
+
+
+@pytest.mark.parametrize('incremental', [True, False])
+def test_snapshots_follow_changes_and_stay_unchanged(incremental):
+    c = make_client()
+    if incremental:
+        # Otherwise a client this small is rebuilt every time.
+        c._snapshots.REBUILD_RATIO = float('inf')
+    first = c.snapshot()
+    assert_matches(first, c)
+    assert c.snapshot() is first
+    assert first.channel_at('/Games/CS').id == 3
+
+    c.control_user_state_received(user_state(1, channel_id=3))
+    c.control_user_state_received(user_state(2, name='renamed'))
+    c.control_user_state_received(user_state(4, name='new', channel_id=2))
+    c.control_user_remove_received(3)
+    c.control_channel_state_received(channel_state(2, position=-1))
+    c.control_channel_state_received(channel_state(3, parent=2))
+
+    second = c.snapshot()
+    assert second.version > first.version
+    assert_matches(second, c)
+    assert second.channel_at('/AFK/CS').id == 3
+    assert second.channel_at('/Games/CS') is None
+
+    # The first snapshot is as it was.
+    assert first.users[1].channel_id == 0
+    assert first.users_by_name['user2'].session == 2
+    assert 4 not in first.users and 3 in first.users
+    assert [r.name for r in first.get_children(0)] == ['AFK', 'Games']
+    assert [r.name for r in second.get_children(0)] == ['AFK', 'Games']
+    assert second.get_children(1) == []
+
+    if incremental:
+        # Untouched parts are shared.
+        assert second.channels[1] is first.channels[1]
+
+
+def test_snapshot_from_another_thread():
+    c = make_client()
+    loop = asyncio.new_event_loop()
+    c.loop = loop
+    thread = threading.Thread(target=loop.run_forever)
+    thread.start()
+    try:
+        snapshot = c.snapshot_threadsafe(timeout=5)
+        assert_matches(snapshot, c)
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
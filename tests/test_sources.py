@@ -0,0 +1,77 @@
+import asyncio
+import wave
+
+import pytest
+
+from mumble.audio import sources
+
+
+def write_wav(path, pcm, channels=1, rate=48000):
+    with wave.open(path, 'wb') as f:
+        f.setnchannels(channels)
+        f.setsampwidth(2)
+        f.setframerate(rate)
+        f.writeframes(pcm)
+
+
+def test_wav_frames_are_views(tmp_path):
+    path = str(tmp_path / 'a.wav')
+    pcm = bytes(range(256)) * 9
+    write_wav(path, pcm)
+
+    with sources.FileSource(path) as source:
+        frames = list(source)
+        assert all(isinstance(frame, memoryview) for frame in frames)
+        assert [len(frame) for frame in frames] == [960, 960, 384]
+        assert b''.join(frames) == pcm
+        del frames
+
+
+def test_seek_and_loop(tmp_path):
+    path = str(tmp_path / 'a.raw')
+    with open(path, 'wb') as f:
+        f.write(b'\x01' * 960 + b'\x02' * 960 + b'\x03' * 960)
+
+    with sources.FileSource(path, loop=True) as source:
+        source.seek(0.02)
+        assert source.tell() == 2
+        assert [bytes(next(source))[:1] for _ in range(4)] == \
+            [b'\x03', b'\x01', b'\x02', b'\x03']
+
+        with pytest.raises(ValueError):
+            source.seek_frame(4)
+
+
+def test_looping_pads_the_last_frame(tmp_path):
+    path = str(tmp_path / 'a.raw')
+    with open(path, 'wb') as f:
+        f.write(b'\x01' * 960 + b'\x02' * 100)
+
+    with sources.FileSource(path, loop=True) as source:
+        frames = [next(source) for _ in range(4)]
+        assert [len(frame) for frame in frames] == [960] * 4
+        assert bytes(frames[1]) == b'\x02' * 100 + bytes(860)
+        # The next pass stays on frame boundaries, as views.
+        assert isinstance(frames[2], memoryview)
+        assert bytes(frames[2]) == b'\x01' * 960
+        del frames
+
+
+def test_async_iteration_stops(tmp_path):
+    path = str(tmp_path / 'a.raw')
+    with open(path, 'wb') as f:
+        f.write(bytes(960 * 2))
+
+    async def collect(source):
+        return [len(frame) async for frame in source]
+
+    with sources.FileSource(path) as source:
+        assert asyncio.run(collect(source)) == [960, 960]
+
+
+def test_rejects_mismatched_wav(tmp_path):
+    path = str(tmp_path / 'a.wav')
+    write_wav(path, bytes(960), rate=44100)
+
+    with pytest.raises(ValueError):
+        sources.FileSource(path)
@@ -0,0 +1,68 @@
+from mumble.protocols import speakers
+
+
+def feed(stats, packets, start=0.0):
+    # packets are (sequence_number, frames) arriving 20 ms apart.
+    return [stats.update(sequence_number, frames, 10,
+                         start + i * 0.02)
+            for i, (sequence_number, frames) in enumerate(packets)]
+
+
+def test_in_order_packets():
+    stats = speakers.SpeakerStats()
+    assert feed(stats, [(i * 2, 2) for i in range(10)]) == \
+        [stats.ACCEPT] * 10
+
+    snapshot = stats.snapshot()
+    assert (snapshot.packets, snapshot.received, snapshot.lost,
+            snapshot.late, snapshot.duplicate, snapshot.reordered) == \
+        (10, 20, 0, 0, 0, 0)
+    assert snapshot.jitter < 1e-9
+
+
+def test_loss_reordering_and_duplicates():
+    stats = speakers.SpeakerStats()
+    verdicts = feed(stats, [(0, 2), (2, 2), (6, 2), (8, 2), (4, 2), (4, 2),
+                            (12, 2)])
+    assert verdicts == [stats.ACCEPT] * 5 + [stats.DUPLICATE, stats.ACCEPT]
+
+    snapshot = stats.snapshot()
+    assert snapshot.received == 12
+    assert snapshot.lost == 2
+    assert snapshot.reordered == 1
+    assert snapshot.duplicate == 2
+
+
+def test_late_packets_and_restarts():
+    stats = speakers.SpeakerStats()
+    feed(stats, [(i, 1) for i in range(100, 200)])
+
+    # Far behind while the speaker is still going: late.
+    assert stats.update(10, 1, 10, 2.0) == stats.LATE
+    assert stats.late == 1
+
+    # The same jump after a pause means the sequence started over.
+    assert stats.update(0, 1, 10, 5.0) == stats.ACCEPT
+    assert stats.update(1, 1, 10, 5.01) == stats.ACCEPT
+    assert stats.lost == 0
+    assert stats.received == 102
+
+
+def test_jitter_and_bitrate():
+    stats = speakers.SpeakerStats()
+    # Every other packet is 10 ms late.
+    for i in range(200):
+        stats.update(i * 2, 2, 100, i * 0.02 + (i % 2) * 0.01)
+
+    assert 0.008 < stats.jitter < 0.011
+    assert stats.bitrate == 40000
+
+
+def test_gaps_between_talk_spurts_are_not_loss():
+    stats = speakers.SpeakerStats()
+    stats.update(0, 2, 10, 0.0)
+    stats.update(2, 1, 1, 0.02, terminated=True)
+    # The sender skipped 50 frames of silence.
+    stats.update(53, 2, 10, 0.53)
+    assert stats.lost == 0
+    assert stats.received == 5
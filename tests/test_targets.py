@@ -0,0 +1,97 @@
+import pytest
+
+from mumble import entities
+from mumble import targets
+from mumble.protocols import control
+
+
+class Recorder(object):
+    def __init__(self):
+        self.registered = []
+
+    def __call__(self, slot, sessions, channels):
+        self.registered.append((slot, sessions, channels))
+
+
+def user(session):
+    return entities.User(None, session)
+
+
+def channel(id):
+    return entities.Channel(None, id)
+
+
+def test_audience_key_is_order_independent():
+    a = targets.audience_key([user(3), channel(5), user(1), 'admin'])
+    b = targets.audience_key(['admin', user(1), channel(5), user(3)])
+    assert a == b == ((1, 3), ((0, False, True, 'admin'),
+                               (5, False, False, None)))
+
+    assert targets.audience_key([targets.ChannelTarget(channel(2),
+                                                       children=True)]) == \
+        ((), ((2, False, True, None),))
+
+    with pytest.raises(ValueError):
+        targets.audience_key([])
+    with pytest.raises(TypeError):
+        targets.audience_key([object()])
+
+
+def test_same_audience_reuses_its_slot():
+    recorder = Recorder()
+    voice_targets = targets.VoiceTargets(recorder)
+
+    assert voice_targets.get([user(1), user(2)]) == 1
+    assert voice_targets.get([channel(4)]) == 2
+    assert voice_targets.get([user(2), user(1)]) == 1
+
+    assert recorder.registered == [(1, (1, 2), ()),
+                                   (2, (), ((4, False, False, None),))]
+    assert (voice_targets.hits, voice_targets.misses) == (1, 2)
+
+
+def test_least_recently_used_slot_is_reused():
+    recorder = Recorder()
+    voice_targets = targets.VoiceTargets(recorder)
+
+    for session in range(30):
+        voice_targets.get([user(session)])
+    # Slot 1 is used again, so slot 2 is the oldest.
+    voice_targets.get([user(0)])
+
+    assert voice_targets.get([user(100)]) == 2
+    # Slot 3 is busy, so slot 4 goes next.
+    assert voice_targets.get([user(101)], busy={3}) == 4
+    assert voice_targets.evictions == 2
+    assert len(voice_targets) == 30
+
+    with pytest.raises(RuntimeError):
+        voice_targets.get([user(102)], busy=set(range(1, 31)))
+
+
+class StubTransport(object):
+    def __init__(self):
+        self.written = bytearray()
+
+    def write(self, data):
+        self.written.extend(data)
+
+
+def test_voice_target_message():
+    protocol = control.Protocol(None, 'bot', None)
+    protocol.transport = StubTransport()
+    protocol.send_voice_target(7, sessions=(1, 2),
+                               channels=[(5, True, False, 'admin')])
+
+    header = control.Protocol.PACKET_HEADER
+    type, length = header.unpack_from(protocol.transport.written)
+    assert control.Protocol.PACKET_TYPES[type] is \
+        control.Mumble_pb2.VoiceTarget
+
+    msg = control.Mumble_pb2.VoiceTarget()
+    msg.ParseFromString(bytes(protocol.transport.written[header.size:]))
+    assert msg.id == 7
+    assert list(msg.targets[0].session) == [1, 2]
+    assert (msg.targets[1].channel_id, msg.targets[1].links,
+            msg.targets[1].children, msg.targets[1].group) == \
+        (5, True, False, 'admin')
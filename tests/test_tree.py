@@ -0,0 +1,263 @@
+import random
+
+from mumble import Mumble_pb2
+from mumble import client
+
+
+def channel_state(channel_id, **fields):
+    state = Mumble_pb2.ChannelState()
+    state.channel_id = channel_id
+    for name, value in fields.items():
+        setattr(state, name, value)
+    return state
+
+
+def make_client(*states):
+    c = client.Client()
+    c.control_channel_state_received(channel_state(0, name='Root'))
+    for state in states:
+        c.control_channel_state_received(state)
+    return c
+
+
+def user_state(session, **fields):
+    state = Mumble_pb2.UserState()
+    state.session = session
+    for name, value in fields.items():
+        setattr(state, name, value)
+    return state
+
+
+class StubVoiceProtocol(object):
+    def forget_session(self, session):
+        pass
+
+
+def names(channels):
+    return [channel.name for channel in channels]
+
+
+def test_children_are_ordered_by_position_then_name():
+    c = make_client(channel_state(1, parent=0, name='b', position=1),
+                    channel_state(2, parent=0, name='a', position=1),
+                    channel_state(3, parent=0, name='c', position=0),
+                    channel_state(4, parent=3, name='d'))
+
+    assert names(c.get_root_channel().get_children()) == ['c', 'a', 'b']
+    assert names(c.channels[3].get_children()) == ['d']
+    assert c.channels[1].get_children() == []
+
+
+def test_position_rename_and_parent_changes_reorder():
+    c = make_client(channel_state(1, parent=0, name='a'),
+                    channel_state(2, parent=0, name='b'),
+                    channel_state(3, parent=0, name='c'))
+
+    c.control_channel_state_received(channel_state(1, position=5))
+    assert names(c.get_root_channel().get_children()) == ['b', 'c', 'a']
+
+    c.control_channel_state_received(channel_state(3, name='0'))
+    assert names(c.get_root_channel().get_children()) == ['0', 'b', 'a']
+
+    c.control_channel_state_received(channel_state(2, parent=1))
+    assert names(c.get_root_channel().get_children()) == ['0', 'a']
+    assert names(c.channels[1].get_children()) == ['b']
+    assert c.channel_tree.parent(2) == 1
+
+
+def test_removed_channels_leave_the_tree():
+    c = make_client(channel_state(1, parent=0, name='a'),
+                    channel_state(2, parent=1, name='b'))
+
+    c.control_channel_remove_received(2)
+    c.control_channel_remove_received(1)
+    assert c.get_root_channel().get_children() == []
+    assert 1 not in c.channel_tree and 2 not in c.channel_tree
+    assert len(c.channel_tree) == 1
+
+
+def test_walk_is_depth_first_in_display_order():
+    c = make_client(channel_state(1, parent=0, name='A'),
+                    channel_state(2, parent=0, name='B'),
+                    channel_state(3, parent=1, name='A2', position=2),
+                    channel_state(4, parent=1, name='A1', position=1),
+                    channel_state(5, parent=4, name='A1x'))
+
+    assert names(c.get_root_channel().walk()) == \
+        ['Root', 'A', 'A1', 'A1x', 'A2', 'B']
+    assert names(c.channels[4].walk()) == ['A1', 'A1x']
+
+
+def sessions(channel):
+    return sorted(user.session for user in channel.get_users())
+
+
+def test_membership_follows_moves_and_disconnects():
+    c = make_client(channel_state(1, parent=0, name='a'),
+                    channel_state(2, parent=0, name='b'))
+    c.voice_protocol = StubVoiceProtocol()
+    moves = []
+    c.user_moved = lambda user, source, dest: moves.append(
+        (user.session, sessions(source) if source else None,
+         sessions(dest) if dest else None))
+
+    c.control_user_state_received(user_state(1, name='x', channel_id=1))
+    c.control_user_state_received(user_state(2, name='y', channel_id=1))
+    c.control_user_state_received(user_state(3, name='z'))
+    assert sessions(c.channels[1]) == [1, 2]
+    assert sessions(c.get_root_channel()) == [3]
+
+    c.control_user_state_received(user_state(1, channel_id=2))
+    c.control_user_state_received(user_state(2, self_mute=True))
+    assert sessions(c.channels[1]) == [2]
+    assert sessions(c.channels[2]) == [1]
+    assert c.channels[2].get_user_count() == 1
+
+    c.control_user_remove_received(2)
+    assert c.channels[1].get_users() == []
+    assert c.channels[1].get_user_count() == 0
+
+    # Handlers already see the users where they went.
+    assert moves[3] == (1, [2], [1])
+    assert moves[4] == (2, [], None)
+
+
+def test_aggregates_follow_users_talking_and_reparenting():
+    c = make_client(channel_state(1, parent=0, name='a'),
+                    channel_state(2, parent=1, name='b'),
+                    channel_state(3, parent=0, name='c'))
+    c.voice_protocol = StubVoiceProtocol()
+    root = c.get_root_channel()
+    a, b, cc = c.channels[1], c.channels[2], c.channels[3]
+
+    assert [ch.get_subtree_depth() for ch in [root, a, b, cc]] == \
+        [2, 1, 0, 0]
+
+    c.control_user_state_received(user_state(1, name='x', channel_id=2))
+    c.control_user_state_received(user_state(2, name='y', channel_id=3))
+    assert [ch.get_user_count(recursive=True) for ch in [root, a, b, cc]] \
+        == [2, 1, 1, 1]
+    assert a.get_user_count() == 0
+
+    c.voice_talking_started(1)
+    assert root.has_talking_users() and a.has_talking_users()
+    assert not cc.has_talking_users()
+
+    # Moving a talking user moves their talking with them.
+    c.control_user_state_received(user_state(1, channel_id=3))
+    assert not a.has_talking_users() and cc.has_talking_users()
+    c.voice_talking_stopped(1)
+    assert not root.has_talking_users()
+
+    # b moves under c with nobody in it; then a moves under b.
+    c.control_channel_state_received(channel_state(2, parent=3))
+    c.control_channel_state_received(channel_state(1, parent=2))
+    c.control_user_state_received(user_state(2, channel_id=1))
+    assert [ch.get_subtree_depth() for ch in [root, cc, b, a]] == \
+        [3, 2, 1, 0]
+    assert [ch.get_user_count(recursive=True) for ch in [root, cc, b, a]] \
+        == [2, 2, 1, 1]
+
+    c.control_user_remove_received(2)
+    c.control_channel_remove_received(1)
+    assert [ch.get_subtree_depth() for ch in [root, cc, b]] == [2, 1, 0]
+    assert [ch.get_user_count(recursive=True) for ch in [root, cc, b]] == \
+        [1, 1, 0]
+
+
+def test_talking_from_unknown_sessions_is_ignored():
+    c = make_client()
+    c.voice_protocol = StubVoiceProtocol()
+
+    # Voice from before a user's state arrives, or after they left.
+    c.voice_talking_started(1)
+    c.control_user_state_received(user_state(1, name='x', channel_id=0))
+    c.control_user_remove_received(1)
+    c.voice_talking_stopped(1)
+    assert not c.get_root_channel().has_talking_users()
+    assert not c._talking
+
+
+def test_aggregates_match_a_full_recount_after_random_changes():
+    random.seed(1)
+    c = make_client(*[channel_state(i, parent=random.randrange(i),
+                                    name=str(i)) for i in range(1, 40)])
+    c.voice_protocol = StubVoiceProtocol()
+
+    for session in range(1, 200):
+        c.control_user_state_received(user_state(
+            session, name=str(session), channel_id=random.randrange(40)))
+
+    for _ in range(500):
+        session = random.choice(list(c.users))
+        action = random.random()
+        if action < 0.5:
+            c.control_user_state_received(user_state(
+                session, channel_id=random.choice(list(c.channels))))
+        elif action < 0.7:
+            if session in c._talking:
+                c.voice_talking_stopped(session)
+            else:
+                c.voice_talking_started(session)
+        else:
+            # Move a channel anywhere outside its own subtree.
+            channel = c.channels[random.randrange(1, 40)]
+            subtree = {ch.id for ch in channel.walk()}
+            parent = random.choice([i for i in c.channels
+                                    if i not in subtree])
+            c.control_channel_state_received(channel_state(
+                channel.id, parent=parent))
+
+    for channel in c.channels.values():
+        subtree = list(channel.walk())
+        users = [u for ch in subtree for u in ch.get_users()]
+
+        def depth(ch):
+            return max([1 + depth(child) for child in ch.get_children()],
+                       default=0)
+
+        assert channel.get_user_count(recursive=True) == len(users)
+        assert channel.has_talking_users() == \
+            any(u.session in c._talking for u in users)
+        assert channel.get_subtree_depth() == depth(channel)
+
+
+def test_paths_survive_renames_and_reparenting():
+    c = make_client(channel_state(1, parent=0, name='Games'),
+                    channel_state(2, parent=1, name='CS'),
+                    channel_state(3, parent=2, name='Team A'),
+                    channel_state(4, parent=0, name='Music'))
+
+    assert c.channel_at('/') is c.get_root_channel()
+    assert c.channel_at('/Games/CS/Team A') is c.channels[3]
+    assert c.channel_at(['Games', 'CS']) is c.channels[2]
+    assert c.channel_at('/Games/Team A') is None
+    assert c.channels[3].get_path() == '/Games/CS/Team A'
+
+    c.control_channel_state_received(channel_state(2, name='Counter-Strike'))
+    assert c.channel_at('/Games/CS') is None
+    assert c.channel_at('/Games/Counter-Strike/Team A') is c.channels[3]
+
+    c.control_channel_state_received(channel_state(2, parent=4))
+    assert c.channel_at('/Games/Counter-Strike') is None
+    assert c.channels[3].get_path() == '/Music/Counter-Strike/Team A'
+
+    c.control_channel_remove_received(3)
+    assert c.channel_at('/Music/Counter-Strike/Team A') is None
+
+
+def test_channels_by_name_keeps_every_channel_with_a_name():
+    c = make_client(channel_state(1, parent=0, name='Games'),
+                    channel_state(2, parent=0, name='Music'),
+                    channel_state(3, parent=1, name='AFK'),
+                    channel_state(4, parent=2, name='AFK'))
+
+    assert c.channels_by_name['AFK'] == [c.channels[3], c.channels[4]]
+    assert c.channel_at('/Music/AFK') is c.channels[4]
+
+    c.control_channel_state_received(channel_state(3, name='Away'))
+    assert c.channels_by_name['AFK'] == [c.channels[4]]
+    assert c.channels_by_name['Away'] == [c.channels[3]]
+
+    c.control_channel_remove_received(4)
+    assert 'AFK' not in c.channels_by_name
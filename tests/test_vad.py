@@ -0,0 +1,80 @@
+import math
+import random
+import struct
+
+import pytest
+
+from mumble.audio import vad
+
+from .test_sender import drain, make_sender
+
+
+def pcm(samples):
+    return struct.pack('<{}h'.format(len(samples)), *samples)
+
+
+LOUD = pcm([8000, -8000] * 240)
+QUIET = pcm([3, -3] * 240)
+SILENCE = bytes(960)
+
+
+def test_frame_energy():
+    assert vad.frame_energy(SILENCE) == -math.inf
+    assert vad.frame_energy(pcm([32767, -32767] * 240)) == \
+        pytest.approx(0, abs=0.01)
+    assert vad.frame_energy(QUIET) < -70
+
+
+def test_hangover_bridges_short_pauses():
+    detector = vad.VoiceActivityDetector(hangover=3)
+    frames = [LOUD, QUIET, QUIET, LOUD, QUIET, QUIET, QUIET, QUIET, QUIET]
+    assert [detector.is_active(f) for f in frames] == \
+        [True] * 7 + [False] * 2
+
+
+def test_spectral_gate_rejects_noise():
+    pytest.importorskip('numpy')
+    detector = vad.VoiceActivityDetector(hangover=0, spectral=True)
+
+    tone = pcm([int(8000 * math.sin(2 * math.pi * 200 * i / 48000))
+                for i in range(480)])
+    rng = random.Random(1)
+    noise = pcm([rng.randint(-8000, 8000) for _ in range(480)])
+
+    assert detector.is_active(tone)
+    assert not detector.is_active(noise)
+
+
+def test_silence_is_skipped_and_spurts_are_terminated():
+    s, transport = make_sender(bitrate=8000, frames_per_packet=2,
+                               vad=vad.VoiceActivityDetector(hangover=0))
+
+    s.feed(LOUD * 2 + SILENCE * 6 + LOUD * 2)
+    s.flush()
+    drain(s)
+
+    assert transport.sent == [
+        bytes([0x00, 0, 0x80 | 10]) + b'\x01' * 10 + bytes([10]) +
+        b'\x02' * 10,
+        # The spurt is closed as soon as silence starts.
+        bytes([0x00, 2, 0x00]),
+        # The skipped frames still count towards the sequence.
+        bytes([0x00, 9, 0x80 | 10]) + b'\x03' * 10 + bytes([10]) +
+        b'\x04' * 10,
+        bytes([0x00, 11, 0x00]),
+    ]
+    assert s.encoder.calls == 4
+    assert s.frames_skipped == 6
+    assert s.bytes_saved == 6 * 11
+    assert s.silent_packets == 3
+    assert s.sequence == 12
+
+
+def test_trailing_silence_needs_no_terminator():
+    s, transport = make_sender(vad=vad.VoiceActivityDetector(hangover=0))
+    s.feed(SILENCE * 4)
+    s.flush()
+    drain(s)
+
+    assert transport.sent == []
+    assert s.encoder.calls == 0
@@ -0,0 +1,147 @@
+import asyncio
+
+import pytest
+
+from mumble.protocols import voice
+
+
+class StubDecoder(object):
+    def decode(self, frame):
+        return bytes(frame)
+
+
+class StubCodec(object):
+    decoder = StubDecoder()
+
+
+class StubClient(object):
+    def __init__(self, loop):
+        self.loop = loop
+        self.received = []
+        self.talking = []
+
+    def voice_packet_received(self, session, target, pcm):
+        self.received.append((session, pcm))
+
+    def voice_talking_started(self, session):
+        self.talking.append(('started', session))
+
+    def voice_talking_stopped(self, session):
+        self.talking.append(('stopped', session))
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+def make_protocol(loop):
+    client = StubClient(loop)
+    protocol = voice.Protocol(client)
+    protocol.codecs[protocol.PacketType.VOICE_CELT_ALPHA] = StubCodec()
+    return protocol, client
+
+
+def packet(protocol, session, sequence_number, frame):
+    return bytes([protocol.PacketType.VOICE_CELT_ALPHA << 5]) + \
+        protocol._encode_varint(session) + \
+        protocol._encode_varint(sequence_number) + \
+        bytes([len(frame)]) + frame
+
+
+def test_packets_arriving_over_both_paths_are_delivered_once(loop):
+    protocol, client = make_protocol(loop)
+
+    for sequence_number in [0, 2, 4]:
+        data = packet(protocol, 7, sequence_number,
+                      bytes([sequence_number]))
+        protocol.plaintext_data_received(data, udp=True)
+        protocol.plaintext_data_received(data)
+
+    assert client.received == [(7, b'\x00'), (7, b'\x02'), (7, b'\x04')]
+    assert protocol.duplicate_packets == 3
+
+
+def test_late_packets_are_delivered_and_sessions_are_independent(loop):
+    protocol, client = make_protocol(loop)
+
+    protocol.plaintext_data_received(packet(protocol, 1, 10, b'a'))
+    protocol.plaintext_data_received(packet(protocol, 1, 6, b'b'))
+    protocol.plaintext_data_received(packet(protocol, 2, 6, b'c'))
+    protocol.plaintext_data_received(packet(protocol, 1, 6, b'b'))
+
+    assert [pcm for _, pcm in client.received] == [b'a', b'b', b'c']
+
+
+def test_a_restarted_sequence_is_not_mistaken_for_duplicates(loop):
+    protocol, client = make_protocol(loop)
+
+    protocol.plaintext_data_received(packet(protocol, 1, 1000, b'a'))
+    protocol.plaintext_data_received(packet(protocol, 1, 1001, b''))
+    protocol.plaintext_data_received(packet(protocol, 1, 0, b'b'))
+    protocol.plaintext_data_received(packet(protocol, 1, 2, b'c'))
+
+    protocol.forget_session(1)
+    protocol.plaintext_data_received(packet(protocol, 1, 2, b'd'))
+
+    assert [pcm for _, pcm in client.received] == [b'a', b'b', b'c', b'd']
+
+
+def test_speaker_stats_without_a_codec(loop):
+    protocol, client = make_protocol(loop)
+    del protocol.codecs[protocol.PacketType.VOICE_CELT_ALPHA]
+
+    for sequence_number in [0, 1, 3, 2, 2]:
+        protocol.plaintext_data_received(packet(protocol, 5, sequence_number,
+                                                b'xy'))
+
+    stats = protocol.speaker_stats()[5]
+    assert (stats.packets, stats.received, stats.lost, stats.duplicate,
+            stats.reordered) == (5, 4, 0, 1, 1)
+    assert stats.bytes == 4 * 3
+    assert protocol.speaker_totals().received == 4
+    assert client.received == []
+
+
+def test_talking_follows_packets_and_terminators(loop):
+    protocol, client = make_protocol(loop)
+    protocol.decode_enabled = False
+
+    protocol.plaintext_data_received(packet(protocol, 1, 0, b'a'))
+    protocol.plaintext_data_received(packet(protocol, 2, 0, b'a'))
+    protocol.plaintext_data_received(packet(protocol, 1, 1, b'b'))
+    assert client.talking == [('started', 1), ('started', 2)]
+    assert list(protocol.talking) == [2, 1]
+
+    protocol.plaintext_data_received(packet(protocol, 1, 2, b''))
+    assert client.talking[-1] == ('stopped', 1)
+
+    # A lone terminator from someone who was not talking means nothing.
+    protocol.plaintext_data_received(packet(protocol, 3, 0, b''))
+    assert client.talking == [('started', 1), ('started', 2), ('stopped', 1)]
+    assert client.received == []
+
+
+def test_talking_times_out(loop, monkeypatch):
+    protocol, client = make_protocol(loop)
+    now = [100.0]
+    monkeypatch.setattr(voice.time, 'monotonic', lambda: now[0])
+
+    protocol.plaintext_data_received(packet(protocol, 1, 0, b'a'))
+    now[0] += 0.3
+    protocol.plaintext_data_received(packet(protocol, 2, 0, b'a'))
+    assert protocol._talk_handle.when() == pytest.approx(100.5)
+
+    now[0] += 0.3
+    protocol._talk_timeout()
+    assert client.talking == [('started', 1), ('started', 2),
+                              ('stopped', 1)]
+    # Next due when 2 has been quiet for TALK_TIMEOUT.
+    assert protocol._talk_handle.when() == pytest.approx(100.8)
+
+    now[0] += 0.2
+    protocol._talk_timeout()
+    assert client.talking[-1] == ('stopped', 2)
+    assert protocol._talk_handle is None